@@ -2,7 +2,8 @@
 from __future__ import unicode_literals
 
 from django.contrib import admin
-from cosinnus_message.models import CosinnusMailbox
+from cosinnus_message.models import CosinnusMailbox, RocketChatUserLink,\
+    RocketChatGroupRoomLink, RocketChatContactRoomLink
 from django_mailbox.admin import get_new_mail
 from django_mailbox.models import Mailbox
 
@@ -18,3 +19,27 @@ class CosinnusMailboxAdmin(admin.ModelAdmin):
 
 admin.site.register(CosinnusMailbox, CosinnusMailboxAdmin)
 admin.site.unregister(Mailbox)
+
+
+class RocketChatUserLinkAdmin(admin.ModelAdmin):
+    list_display = ('user', 'rocket_user_id', 'rocket_username')
+    search_fields = ('rocket_user_id', 'rocket_username', 'user__email')
+    raw_id_fields = ('user',)
+
+admin.site.register(RocketChatUserLink, RocketChatUserLinkAdmin)
+
+
+class RocketChatGroupRoomLinkAdmin(admin.ModelAdmin):
+    list_display = ('group', 'room_key', 'room_id')
+    search_fields = ('room_id', 'group__slug', 'group__name')
+    raw_id_fields = ('group',)
+
+admin.site.register(RocketChatGroupRoomLink, RocketChatGroupRoomLinkAdmin)
+
+
+class RocketChatContactRoomLinkAdmin(admin.ModelAdmin):
+    list_display = ('user', 'group', 'room_name', 'room_id')
+    search_fields = ('room_id', 'room_name', 'user__email', 'group__slug')
+    raw_id_fields = ('user', 'group')
+
+admin.site.register(RocketChatContactRoomLink, RocketChatContactRoomLinkAdmin)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Async variants of the rocketchat views, used in place of the sync ones by `cosinnus_message.urls`
+if `COSINNUS_CHAT_ASYNC_VIEWS` is enabled. They keep the same URL names and templates.
+
+Requires Django >= 3.1, and only frees up the worker while waiting on rocketchat when served via ASGI.
+Under WSGI, every request to them is run through `async_to_sync`, which makes them slower than the sync
+views, so the setting should only be enabled for the ASGI processes.
+"""
+from __future__ import unicode_literals
+
+import asyncio
+from functools import update_wrapper
+
+from asgiref.sync import sync_to_async
+from django.http.response import Http404
+from django.shortcuts import redirect
+from django.urls import reverse
+
+from cosinnus.models.group import CosinnusGroup
+from cosinnus_message.rocket_async import AsyncRocketChatConnection
+from cosinnus_message.views import RocketChatWriteView, RocketChatWriteGroupView,\
+    RocketChatWriteGroupComposeView
+
+
+class AsyncViewMixin(object):
+    """ Makes `as_view()` return a coroutine function for a class-based view with async handlers,
+        which Django only detects by itself for class-based views from Django 4.1 on. """
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+
+        async def async_view(request, *args, **kwargs):
+            response = view(request, *args, **kwargs)
+            # the sync responses for disallowed methods are returned as they are
+            if asyncio.iscoroutine(response):
+                response = await response
+            return response
+        update_wrapper(async_view, view)
+        return async_view
+
+    async def options(self, request, *args, **kwargs):
+        return super().options(request, *args, **kwargs)
+
+    async def get_request_user(self):
+        """ Loads the lazy request user outside of the event loop.
+            @return: the user if it is logged in, else None """
+        def _get_user():
+            user = self.request.user
+            return user if user and user.is_authenticated else None
+        return await sync_to_async(_get_user)()
+
+
+class AsyncRocketChatWriteView(AsyncViewMixin, RocketChatWriteView):
+
+    async def get(self, request, *args, **kwargs):
+        context = await sync_to_async(self.get_context_data)(**kwargs)
+        return self.render_to_response(context)
+
+
+class AsyncRocketChatWriteGroupView(AsyncViewMixin, RocketChatWriteGroupView):
+
+    rocket_chat_url = None
+
+    def __init__(self, **kwargs):
+        # skip building the queryset on init, which may hit the database inside the event loop
+        super(RocketChatWriteGroupView, self).__init__(**kwargs)
+
+    def get_object(self):
+        if self.queryset is None:
+            self.queryset = CosinnusGroup.objects.all_in_portal()
+        return super().get_object()
+
+    async def get(self, request, *args, **kwargs):
+        self.object = await sync_to_async(self.get_object)()
+        self.rocket_chat_url = await self.aget_rocket_chat_url()
+        context = await sync_to_async(self.get_context_data)(object=self.object)
+        if not context.get('url'):
+            return redirect(reverse('cosinnus:message-write-group-compose', kwargs={'slug': self.object.slug}))
+        return self.render_to_response(context)
+
+    async def aget_rocket_chat_url(self):
+        """ Async version of `get_rocket_chat_url()` """
+        group = self.object
+        if not group:
+            return self.base_url
+        user = await self.get_request_user()
+        group_name = ''
+        if user:
+            group_name = await AsyncRocketChatConnection().groups_request(group, user, force_sync_membership=True)
+
+        if group_name:
+            return f'{self.base_url}/group/{group_name}/'
+        return None
+
+    def get_rocket_chat_url(self):
+        # resolved asynchronously in `get()` before the context is built
+        return self.rocket_chat_url
+
+
+class AsyncRocketChatWriteGroupComposeView(AsyncViewMixin, RocketChatWriteGroupComposeView):
+
+    async def get(self, request, *args, **kwargs):
+        self.group = await sync_to_async(self.get_group_object)()
+        context = await sync_to_async(self.get_context_data)()
+        return self.render_to_response(context)
+
+    async def post(self, request, *args, **kwargs):
+        form = await sync_to_async(self.get_form)()
+        if not await sync_to_async(form.is_valid)():
+            self.group = await sync_to_async(self.get_group_object)()
+            return await sync_to_async(self.form_invalid)(form)
+        return await self.aform_valid(form)
+
+    async def put(self, *args, **kwargs):
+        return await self.post(*args, **kwargs)
+
+    async def aform_valid(self, form):
+        """ Async version of `form_valid()` """
+        contact_message = form.cleaned_data.get('contact_message')
+        group = await sync_to_async(self.get_group_object)()
+        user = await self.get_request_user()
+        if user is None:
+            raise Http404
+        # trigger room creation
+        await AsyncRocketChatConnection().groups_request(group, user, first_message=contact_message,
+                                                         force_sync_membership=True, create=True)
+        return redirect(reverse('cosinnus:message-write-group', kwargs={'slug': group.slug}))
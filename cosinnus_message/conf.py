@@ -146,6 +146,62 @@ class CosinnusMessageDefaultSettings(AppConf):
     # rocket authentication timeout is 30 days  by default
     COSINNUS_CHAT_CONNECTION_CACHE_TIMEOUT = 60 * 60 * 24 * 30
     
+    # how long a resolved rocketchat room name for a group room is cached.
+    # the cache is invalidated explicitly on room creation, rename and deletion,
+    # so this only serves as a safety net for changes made directly in rocketchat
+    COSINNUS_CHAT_ROOM_NAME_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+    
+    # after a user's room memberships for a group have been re-synced (on opening the group chat),
+    # they will not be re-synced again for this many seconds. set to 0 to re-sync on every visit
+    COSINNUS_CHAT_MEMBERSHIP_VERIFICATION_INTERVAL = 60 * 60 * 6
+    
+    # after a successful rocketchat account sanity check on login, users will not be checked again
+    # on login for this many seconds. failed checks are always retried on the next login.
+    # set to 0 to check on every login
+    COSINNUS_CHAT_USER_SANITY_CHECK_INTERVAL = 60 * 60 * 24
+    # fraction of the sanity check interval by which each user's interval is randomly shortened,
+    # to spread out re-checks of users that logged in at the same time
+    COSINNUS_CHAT_USER_SANITY_CHECK_JITTER = 0.25
+    
+    # the maximum number of members a group room is created with. any further members
+    # are invited in chunks after the room has been created. set to None for no limit
+    COSINNUS_CHAT_ROOM_CREATE_MAX_INITIAL_MEMBERS = 200
+    # how many users are invited into a room with a single request during bulk invites
+    COSINNUS_CHAT_BULK_INVITE_CHUNK_SIZE = 100
+    # how often a failed bulk invite chunk is retried before falling back to single invites,
+    # and the delay in seconds before the first retry (doubled for each further retry)
+    COSINNUS_CHAT_BULK_INVITE_RETRIES = 2
+    COSINNUS_CHAT_BULK_INVITE_RETRY_DELAY = 2
+    # page size for listing room members from rocketchat
+    COSINNUS_CHAT_BULK_PAGE_SIZE = 500
+    
+    # if True, rocketchat operations triggered by changes inside a database transaction
+    # are collected, de-duplicated and only run once the transaction has been committed.
+    # note that the room ids of groups created in a transaction (e.g. with ATOMIC_REQUESTS)
+    # are then only saved to the database after the commit, not to the saved group instance
+    COSINNUS_CHAT_TRANSACTION_BATCH_ENABLED = False
+    # if True, the collected operations of a transaction are run in a thread after the commit
+    COSINNUS_CHAT_TRANSACTION_BATCH_ASYNC = False
+    
+    # the local mirror of a user's rocketchat email notification preference is re-fetched
+    # by the refresh cronjob once it is older than this many seconds. the cronjob
+    # `cosinnus_message.cron.RefreshRocketChatEmailPreferences` must be added to `CRON_CLASSES`
+    COSINNUS_CHAT_EMAIL_PREFERENCE_REFRESH_INTERVAL = 60 * 60 * 24
+    # the maximum number of users whose email notification preference is re-fetched per cronjob run
+    COSINNUS_CHAT_EMAIL_PREFERENCE_REFRESH_BATCH_SIZE = 200
+    
+    # the token of the rocketchat outgoing webhook integrations that post events to
+    # `cosinnus:message-rocketchat-webhook`. the webhook endpoint is disabled if this is empty
+    COSINNUS_CHAT_WEBHOOK_TOKEN = None
+    
+    # if True, the rocketchat redirect views are served by their async variants, which wait on
+    # rocketchat without blocking the worker. requires Django >= 3.1 (ignored otherwise). only enable
+    # this in the settings of processes served via ASGI: under WSGI, Django runs every request to
+    # an async view through `async_to_sync`, which makes them slower than the sync views
+    COSINNUS_CHAT_ASYNC_VIEWS = False
+    # the maximum number of concurrent rocketchat requests of the async views per process
+    COSINNUS_CHAT_ASYNC_MAX_WORKERS = 20
+    
     # enables the read-only mode for the legacy postman messages system and shows an
     # "archived messages button" in the user profile
     COSINNUS_POSTMAN_ARCHIVE_MODE = False 
@@ -5,10 +5,13 @@ import logging
 
 from django_cron import CronJobBase, Schedule
 
+from cosinnus.conf import settings
 from cosinnus.cron import CosinnusCronJobBase
 from cosinnus_message.utils.utils import update_mailboxes,\
     process_direct_reply_messages
 from django.utils.encoding import force_text
+from django.utils.timezone import now
+from datetime import timedelta
 
 logger = logging.getLogger('cosinnus')
 
@@ -26,4 +29,62 @@ class ProcessDirectReplyMails(CosinnusCronJobBase):
             process_direct_reply_messages()
         except Exception as e:
             logger.error('Process_direct_reply_messages() threw an exception! (in extra)', extra={'exception': force_text(e)})
-            
\ No newline at end of file
+            
+
+
+class RefreshRocketChatEmailPreferences(CosinnusCronJobBase):
+    """ Re-fetches the rocketchat email notification preferences of the users whose local
+        mirror of it is older than `COSINNUS_CHAT_EMAIL_PREFERENCE_REFRESH_INTERVAL`, to pick up
+        changes made inside rocketchat. Only runs if added to the `CRON_CLASSES` setting. """
+    
+    RUN_EVERY_MINS = 10 # every 10 minutes
+    schedule = Schedule(run_every_mins=RUN_EVERY_MINS)
+    
+    cosinnus_code = 'message.refresh_rocketchat_email_preferences'
+    
+    def do(self):
+        if not settings.COSINNUS_ROCKET_ENABLED:
+            return
+        from cosinnus_message.rocket_chat import RocketChatConnection
+        synced_before = now() - timedelta(seconds=settings.COSINNUS_CHAT_EMAIL_PREFERENCE_REFRESH_INTERVAL)
+        refreshed, failed = RocketChatConnection().refresh_user_email_preferences(
+            limit=settings.COSINNUS_CHAT_EMAIL_PREFERENCE_REFRESH_BATCH_SIZE, synced_before=synced_before)
+        return 'Refreshed %d, failed %d' % (refreshed, failed)
+
+
+class ReconcilePostmanFolderCounters(CosinnusCronJobBase):
+    """ Recounts the stored unread and folder counters of the postman messages and fixes those
+        that have drifted from the messages, e.g. after moderation in the admin.
+        Only runs if added to the `CRON_CLASSES` setting, which is needed with `POSTMAN_FOLDER_COUNTERS`. """
+    
+    RUN_EVERY_MINS = 60 * 6 # every 6 hours
+    schedule = Schedule(run_every_mins=RUN_EVERY_MINS)
+    
+    cosinnus_code = 'message.reconcile_postman_folder_counters'
+    
+    def do(self):
+        if not getattr(settings, 'POSTMAN_FOLDER_COUNTERS', False):
+            return
+        from postman.models import FolderCounters
+        checked, fixed = FolderCounters.objects.reconcile()
+        return 'Checked %d, fixed %d' % (checked, fixed)
+
+
+class SendPostmanOutgoingMessages(CosinnusCronJobBase):
+    """ Sends the postman messages to many recipients that were stored to be sent in the background,
+        see `POSTMAN_SEND_LATER_THRESHOLD`. Only runs if added to the `CRON_CLASSES` setting,
+        which is required with `POSTMAN_SEND_LATER_THRESHOLD`, otherwise the messages are never sent. """
+    
+    RUN_EVERY_MINS = 1 # every 1 minute
+    schedule = Schedule(run_every_mins=RUN_EVERY_MINS)
+    
+    cosinnus_code = 'message.send_postman_outgoing_messages'
+    
+    def do(self):
+        if getattr(settings, 'POSTMAN_SEND_LATER_THRESHOLD', None) is None:
+            return
+        from django.contrib.sites.models import Site
+        from postman.models import OutgoingMessage
+        site = Site.objects.get_current() if Site._meta.installed else None
+        count = OutgoingMessage.objects.send_pending(getattr(settings, 'POSTMAN_SEND_LATER_BATCH_SIZE', 500), site=site)
+        return 'Sent %d' % count
@@ -5,7 +5,9 @@ from django.dispatch import receiver
 from oauth2_provider.signals import app_authorized
 
 from cosinnus_message.rocket_chat import RocketChatConnection,\
-    delete_cached_rocket_connection
+    delete_cached_rocket_connection, get_user_sanity_verified_at, save_group_room_links
+from cosinnus_message.rocket_batch import record_membership_change,\
+    defer_to_transaction, defer_membership_change_to_transaction
 from cosinnus.models import UserProfile, CosinnusGroupMembership, MEMBERSHIP_PENDING, MEMBERSHIP_INVITED_PENDING, \
     MEMBERSHIP_ADMIN
 from cosinnus.models.group_extra import CosinnusSociety, CosinnusProject,\
@@ -48,7 +50,10 @@ if settings.COSINNUS_ROCKET_ENABLED:
     
     @receiver(user_logged_in)
     def handle_user_logged_in(sender, user, request, **kwargs):
-        """ Checks if the user exists in rocketchat, and if not, attempts to create them """
+        """ Checks if the user exists in rocketchat, and if not, attempts to create them.
+            Users whose account was successfully checked recently are skipped. """
+        if get_user_sanity_verified_at(user):
+            return
         # we're Threading this entire hook as it might take a while
         class UserSanityCheck(Thread):
             def run(self):
@@ -92,63 +97,75 @@ if settings.COSINNUS_ROCKET_ENABLED:
     @receiver(pre_save, sender=CosinnusSociety)
     def handle_cosinnus_society_updated(sender, instance, **kwargs):
         try:
-            rocket = RocketChatConnection()
             if instance.id:
                 old_instance = get_object_or_None(CosinnusSociety, pk=instance.id)
                 if old_instance and instance.slug != old_instance.slug:
-                    rocket.groups_rename(instance)
-            else:
-                rocket.groups_create(instance)
+                    if not defer_to_transaction('group', 'update', instance):
+                        RocketChatConnection().groups_rename(instance)
+            elif not defer_to_transaction('group', 'create', instance):
+                RocketChatConnection().groups_create(instance)
         except Exception as e:
             logger.exception(e)
 
     @receiver(pre_save, sender=CosinnusProject)
     def handle_cosinnus_project_updated(sender, instance, **kwargs):
         try:
-            rocket = RocketChatConnection()
             if instance.id:
                 old_instance = get_object_or_None(CosinnusProject, pk=instance.id)
                 if old_instance and instance.slug != old_instance.slug:
-                    rocket.groups_rename(instance)
-            else:
-                rocket.groups_create(instance)
+                    if not defer_to_transaction('group', 'update', instance):
+                        RocketChatConnection().groups_rename(instance)
+            elif not defer_to_transaction('group', 'create', instance):
+                RocketChatConnection().groups_create(instance)
         except Exception as e:
             logger.exception(e)
             
     @receiver(pre_save, sender=CosinnusConference)
     def handle_cosinnus_conference_updated(sender, instance, **kwargs):
         try:
-            rocket = RocketChatConnection()
             if instance.id:
                 old_instance = get_object_or_None(CosinnusConference, pk=instance.id)
                 if old_instance and instance.slug != old_instance.slug:
-                    rocket.groups_rename(instance)
-            else:
-                rocket.groups_create(instance)
+                    if not defer_to_transaction('group', 'update', instance):
+                        RocketChatConnection().groups_rename(instance)
+            elif not defer_to_transaction('group', 'create', instance):
+                RocketChatConnection().groups_create(instance)
+        except Exception as e:
+            logger.exception(e)
+
+    @receiver(post_save, sender=CosinnusSociety)
+    @receiver(post_save, sender=CosinnusProject)
+    @receiver(post_save, sender=CosinnusConference)
+    def handle_cosinnus_group_created(sender, instance, created, **kwargs):
+        """ Links the rooms that were created in the pre_save hook, before the group had a pk """
+        if not created:
+            return
+        try:
+            save_group_room_links(instance)
         except Exception as e:
             logger.exception(e)
 
     @receiver(post_delete, sender=CosinnusSociety)
     def handle_cosinnus_society_deleted(sender, instance, **kwargs):
         try:
-            rocket = RocketChatConnection()
-            rocket.groups_delete(instance)
+            if not defer_to_transaction('group', 'delete', instance):
+                RocketChatConnection().groups_delete(instance)
         except Exception as e:
             logger.exception(e)
             
     @receiver(post_delete, sender=CosinnusProject)
     def handle_cosinnus_project_deleted(sender, instance, **kwargs):
         try:
-            rocket = RocketChatConnection()
-            rocket.groups_delete(instance)
+            if not defer_to_transaction('group', 'delete', instance):
+                RocketChatConnection().groups_delete(instance)
         except Exception as e:
             logger.exception(e)
             
     @receiver(post_delete, sender=CosinnusConference)
     def handle_cosinnus_conference_deleted(sender, instance, **kwargs):
         try:
-            rocket = RocketChatConnection()
-            rocket.groups_delete(instance)
+            if not defer_to_transaction('group', 'delete', instance):
+                RocketChatConnection().groups_delete(instance)
         except Exception as e:
             logger.exception(e)
 
@@ -156,8 +173,8 @@ if settings.COSINNUS_ROCKET_ENABLED:
     def handle_cosinnus_group_deactivated(sender, group, **kwargs):
         """ Archive a group that gets deactivated """
         try:
-            rocket = RocketChatConnection()
-            rocket.groups_archive(group)
+            if not defer_to_transaction('group', 'archive', group):
+                RocketChatConnection().groups_archive(group)
         except Exception as e:
             logger.exception(e)
     
@@ -165,8 +182,8 @@ if settings.COSINNUS_ROCKET_ENABLED:
     def handle_cosinnus_group_reactivated(sender, group, **kwargs):
         """ Unarchive a group that gets reactivated """
         try:
-            rocket = RocketChatConnection()
-            rocket.groups_unarchive(group)
+            if not defer_to_transaction('group', 'unarchive', group):
+                RocketChatConnection().groups_unarchive(group)
         except Exception as e:
             logger.exception(e)
             
@@ -175,8 +192,8 @@ if settings.COSINNUS_ROCKET_ENABLED:
     def user_deactivated(sender, user, **kwargs):
         """ Deactivate a rocketchat user account """
         try:
-            rocket = RocketChatConnection()
-            rocket.users_disable(user)
+            if not defer_to_transaction('user', 'disable', user):
+                RocketChatConnection().users_disable(user)
         except Exception as e:
             logger.exception(e)
     
@@ -184,14 +201,17 @@ if settings.COSINNUS_ROCKET_ENABLED:
     def user_activated(sender, user, **kwargs):
         """ Activate a rocketchat user account """
         try:
-            rocket = RocketChatConnection()
-            rocket.users_enable(user)
+            if not defer_to_transaction('user', 'enable', user):
+                RocketChatConnection().users_enable(user)
         except Exception as e:
             logger.exception(e)
         
     @receiver(pre_save, sender=CosinnusGroupMembership)
     def handle_membership_updated(sender, instance, **kwargs):
         try:
+            # inside a `bulk_membership_sync` block, the change is synced in one go at the end
+            if record_membership_change(instance) or defer_membership_change_to_transaction(instance):
+                return
             rocket = RocketChatConnection()
             is_pending = instance.status in (MEMBERSHIP_PENDING, MEMBERSHIP_INVITED_PENDING)
             # do a threaded call
@@ -234,6 +254,8 @@ if settings.COSINNUS_ROCKET_ENABLED:
     @receiver(post_delete, sender=CosinnusGroupMembership)
     def handle_membership_deleted(sender, instance, **kwargs):
         try:
+            if record_membership_change(instance) or defer_membership_change_to_transaction(instance):
+                return
             rocket = RocketChatConnection()
             # do a threaded call
             class CosinnusRocketMembershipDeletedThread(Thread):
@@ -246,6 +268,8 @@ if settings.COSINNUS_ROCKET_ENABLED:
     @receiver(post_save, sender=Note)
     def handle_note_updated(sender, instance, created, **kwargs):
         try:
+            if defer_to_transaction('note', 'create' if created else 'update', instance):
+                return
             rocket = RocketChatConnection()
             if created:
                 rocket.notes_create(instance)
@@ -256,6 +280,8 @@ if settings.COSINNUS_ROCKET_ENABLED:
 
     @receiver(post_delete, sender=Note)
     def handle_note_deleted(sender, instance, **kwargs):
+        if defer_to_transaction('note', 'delete', instance):
+            return
         rocket = RocketChatConnection()
         rocket.notes_delete(instance)
 
@@ -2,8 +2,7 @@ from __future__ import print_function
 from builtins import object
 import logging
 
-from django.core.management.base import BaseCommand
-
+from cosinnus_message.utils.profiling import ProfilableCommand
 from cosinnus_message.utils.utils import process_direct_reply_messages,\
     update_mailboxes
 
@@ -12,7 +11,7 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
-class Command(BaseCommand):
+class Command(ProfilableCommand):
     """ Downloads all mail for mailboxes in this portal, then processes direct replies as answers. """
     
     def add_arguments(self, parser):
@@ -1,7 +1,6 @@
 import logging
 
-from django.core.management.base import BaseCommand
-
+from cosinnus_message.utils.profiling import ProfilableCommand
 from cosinnus_message.utils.utils import process_direct_reply_messages,\
     update_mailboxes
 
@@ -10,7 +9,7 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
-class Command(BaseCommand):
+class Command(ProfilableCommand):
     """ Downloads all mail for mailboxes in this portal, then processes direct replies as answers. """
     
     def handle(self, *args, **options):
@@ -0,0 +1,39 @@
+import logging
+
+from cosinnus_message.utils.profiling import ProfilableCommand
+from cosinnus_message.rocket_chat import RocketChatConnection
+from cosinnus.utils.group import get_cosinnus_group_model
+from cosinnus.models.group import CosinnusPortal
+from cosinnus.conf import settings
+
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+class Command(ProfilableCommand):
+    """
+    Invites all active members of groups into their group rooms, using chunked bulk invites.
+    Members that are already in the rooms are skipped, so this can be re-run safely,
+    e.g. after mass onboarding participants to a large conference.
+    """
+    
+    def add_arguments(self, parser):
+        parser.add_argument('group_ids', nargs='*', type=int,
+                            help='IDs of the groups to invite members for. Default: all active groups of the portal')
+        parser.add_argument('--chunk-size', type=int, default=None,
+                            help='Number of users invited per request. Default: COSINNUS_CHAT_BULK_INVITE_CHUNK_SIZE')
+
+    def handle(self, *args, **options):
+        if not settings.COSINNUS_CHAT_USER:
+            return
+        
+        rocket = RocketChatConnection(stdout=self.stdout, stderr=self.stderr)
+        current_portal = CosinnusPortal.get_current()
+        groups = get_cosinnus_group_model().objects.filter(portal=current_portal, is_active=True)
+        if options['group_ids']:
+            groups = groups.filter(id__in=options['group_ids'])
+        count = len(groups)
+        for i, group in enumerate(groups):
+            invited, skipped, failed = rocket.groups_invite_members_bulk(group, chunk_size=options['chunk_size'])
+            self.stdout.write(f'Group {i+1}/{count} {group.slug}: invited {invited}, already members {skipped}, failed {failed}')
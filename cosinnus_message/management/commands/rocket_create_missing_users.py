@@ -1,7 +1,6 @@
 import logging
 
-from django.core.management.base import BaseCommand
-
+from cosinnus_message.utils.profiling import ProfilableCommand
 from cosinnus_message.rocket_chat import RocketChatConnection
 from cosinnus.conf import settings
 
@@ -9,7 +8,7 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
-class Command(BaseCommand):
+class Command(ProfilableCommand):
     """
     Create missing user accounts in rocketchat (and verify that ones with an existing
     connection still exist in rocketchat properly).
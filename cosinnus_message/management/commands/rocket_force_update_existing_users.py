@@ -1,7 +1,6 @@
 import logging
 
-from django.core.management.base import BaseCommand
-
+from cosinnus_message.utils.profiling import ProfilableCommand
 from cosinnus_message.rocket_chat import RocketChatConnection
 from cosinnus.conf import settings
 from cosinnus.utils.user import filter_active_users, filter_portal_users
@@ -12,7 +11,7 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
-class Command(BaseCommand):
+class Command(ProfilableCommand):
     """
     Sync users with Rocket.Chat
     """
@@ -0,0 +1,188 @@
+import logging
+import math
+from queue import Queue, Empty
+from threading import Thread, local
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import CommandError
+from django.db import connection
+
+from cosinnus_message.utils.profiling import ProfilableCommand
+from cosinnus_message.rocket_chat import RocketChatConnection, get_login_count
+from cosinnus.models.group import CosinnusPortal
+from cosinnus.models.profile import PROFILE_SETTING_ROCKET_CHAT_ID
+from cosinnus.utils.group import get_cosinnus_group_model
+from cosinnus.conf import settings
+
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+HEALTHCHECK_CALLS = ('me', 'users.info', 'groups.info', 'subscriptions.get')
+
+
+def percentile(sorted_values, percent):
+    """ Returns the nearest-rank percentile of a sorted list of values """
+    if not sorted_values:
+        return None
+    index = max(0, int(math.ceil(percent / 100.0 * len(sorted_values))) - 1)
+    return sorted_values[index]
+
+
+class Command(ProfilableCommand):
+    """
+    Probes the latency and health of the rocketchat API with read-only calls. Each of the
+    selected calls is made `--iterations` times, spread over `--concurrency` threads, and the
+    p50/p95/p99 latencies, error rates and the number of logins made are reported per call.
+    Exits with an error if any of the given thresholds is exceeded, for use in monitoring and
+    for comparing rocketchat versions before and after an upgrade.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('-c', '--calls', default=','.join(HEALTHCHECK_CALLS),
+                            help=f'Comma-separated calls to make (default: all of {", ".join(HEALTHCHECK_CALLS)})')
+        parser.add_argument('-n', '--iterations', type=int, default=20, help='Number of times each call is made (default: 20)')
+        parser.add_argument('-w', '--concurrency', type=int, default=4, help='Number of calls made in parallel (default: 4)')
+        parser.add_argument('-u', '--user', default=None,
+                            help='Username of the test user for users.info and subscriptions.get (these are skipped if not given)')
+        parser.add_argument('-g', '--group', default=None,
+                            help='Slug of the group whose room is used for groups.info (default: any group with a room)')
+        parser.add_argument('--max-p95', type=float, default=None, help='Maximum p95 latency in ms for any call')
+        parser.add_argument('--max-p99', type=float, default=None, help='Maximum p99 latency in ms for any call')
+        parser.add_argument('--max-error-rate', type=float, default=None, help='Maximum error rate (0.0 - 1.0) for any call')
+
+    def get_rocket(self):
+        """ Returns a rocketchat connection for the current worker thread """
+        if not hasattr(self._worker_state, 'rocket'):
+            self._worker_state.rocket = RocketChatConnection(stdout=self.stdout, stderr=self.stderr)
+        return self._worker_state.rocket
+
+    def get_user_connection(self):
+        """ Returns a connection of the test user for the current worker thread """
+        if not hasattr(self._worker_state, 'user_connection'):
+            self._worker_state.user_connection = self.get_rocket()._get_user_connection(self.test_user)
+        return self._worker_state.user_connection
+
+    def get_test_room_id(self, group_slug):
+        groups = get_cosinnus_group_model().objects.filter(portal=CosinnusPortal.get_current(), is_active=True)
+        if group_slug:
+            groups = groups.filter(slug=group_slug)
+        room_key = settings.COSINNUS_ROCKET_GROUP_ROOM_KEYS[0]
+        for group in groups:
+            room_id = group.settings.get(f'{PROFILE_SETTING_ROCKET_CHAT_ID}_{room_key}', None)
+            if room_id:
+                return room_id
+        return None
+
+    def make_call(self, call):
+        """ Makes a single call. Runs in a worker thread. The connections of the thread are
+            opened before the call is timed, so that logins are not counted as latency.
+            @return: a tuple of (call, duration in ms or None if the call could not be made, success) """
+        start, duration = None, None
+        success = False
+        try:
+            rocket = self.get_rocket().rocket
+            user_connection = self.get_user_connection() if call == 'subscriptions.get' else None
+            start = time.time()
+            if call == 'me':
+                response = rocket.me()
+            elif call == 'users.info':
+                response = rocket.users_info(username=self.test_user.cosinnus_profile.rocket_username)
+            elif call == 'groups.info':
+                response = rocket.groups_info(room_id=self.test_room_id)
+            elif call == 'subscriptions.get':
+                response = user_connection.subscriptions_get() if user_connection else None
+            duration = (time.time() - start) * 1000.0
+            success = response is not None and response.status_code == 200 and response.json().get('success', False)
+        except Exception as e:
+            if start is not None and duration is None:
+                duration = (time.time() - start) * 1000.0
+            logger.warning(f'Rocketchat healthcheck call {call} failed: {e}')
+        return call, duration, success
+
+    def run_worker(self, calls, results):
+        """ Makes calls from the queue until it is empty. Runs in a worker thread. """
+        try:
+            while True:
+                try:
+                    call = calls.get_nowait()
+                except Empty:
+                    return
+                results.put(self.make_call(call))
+        finally:
+            # database connections are per thread, don't leave them open
+            connection.close()
+
+    def handle(self, *args, **options):
+        if not settings.COSINNUS_CHAT_USER:
+            return
+
+        calls = [call.strip() for call in options['calls'].split(',') if call.strip()]
+        unknown = [call for call in calls if call not in HEALTHCHECK_CALLS]
+        if unknown:
+            raise CommandError(f'Unknown calls: {", ".join(unknown)}')
+
+        self.test_user = None
+        if options['user']:
+            self.test_user = get_user_model().objects.filter(username=options['user']).first()
+            if not self.test_user:
+                raise CommandError(f'User "{options["user"]}" not found')
+        elif 'users.info' in calls or 'subscriptions.get' in calls:
+            self.stdout.write('No test user given, skipping users.info and subscriptions.get.')
+            calls = [call for call in calls if call not in ('users.info', 'subscriptions.get')]
+
+        self.test_room_id = None
+        if 'groups.info' in calls:
+            self.test_room_id = self.get_test_room_id(options['group'])
+            if not self.test_room_id:
+                self.stdout.write('No group with a rocketchat room found, skipping groups.info.')
+                calls.remove('groups.info')
+
+        self._worker_state = local()
+        logins_before = get_login_count()
+        counts = dict([(call, 0) for call in calls])
+        durations = dict([(call, []) for call in calls])
+        errors = dict([(call, 0) for call in calls])
+        queued_calls = Queue()
+        for call in calls:
+            for __ in range(max(1, options['iterations'])):
+                queued_calls.put(call)
+        total = queued_calls.qsize()
+        results = Queue()
+        started = time.time()
+        workers = [Thread(target=self.run_worker, args=(queued_calls, results))
+                   for __ in range(max(1, min(options['concurrency'], total)))]
+        for worker in workers:
+            worker.start()
+        for __ in range(total):
+            call, duration, success = results.get()
+            counts[call] += 1
+            if duration is not None:
+                durations[call].append(duration)
+            if not success:
+                errors[call] += 1
+        for worker in workers:
+            worker.join()
+        total_time = time.time() - started
+        logins = get_login_count() - logins_before
+
+        failures = []
+        for call in calls:
+            values = sorted(durations[call])
+            error_rate = errors[call] / float(counts[call]) if counts[call] else 0.0
+            if not values:
+                self.stdout.write(f'{call}: n={counts[call]} no call could be made, errors={errors[call]} ({error_rate:.1%})')
+            else:
+                p50, p95, p99 = percentile(values, 50), percentile(values, 95), percentile(values, 99)
+                self.stdout.write(f'{call}: n={counts[call]} p50={p50:.0f}ms p95={p95:.0f}ms p99={p99:.0f}ms errors={errors[call]} ({error_rate:.1%})')
+            if options['max_p95'] is not None and values and p95 > options['max_p95']:
+                failures.append(f'{call} p95 {p95:.0f}ms > {options["max_p95"]:.0f}ms')
+            if options['max_p99'] is not None and values and p99 > options['max_p99']:
+                failures.append(f'{call} p99 {p99:.0f}ms > {options["max_p99"]:.0f}ms')
+            if options['max_error_rate'] is not None and error_rate > options['max_error_rate']:
+                failures.append(f'{call} error rate {error_rate:.1%} > {options["max_error_rate"]:.1%}')
+        self.stdout.write(f'Made {sum(counts.values())} calls in {total_time:.1f}s with {logins} logins (auth refreshes).')
+
+        if failures:
+            raise CommandError('Rocketchat healthcheck thresholds exceeded: ' + '; '.join(failures))
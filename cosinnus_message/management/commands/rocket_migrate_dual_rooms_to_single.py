@@ -1,28 +1,117 @@
 import logging
+from queue import Queue, Empty
+from threading import Thread, local
 
-from django.core.management.base import BaseCommand
+from django.db import connection
 
 from cosinnus.conf import settings
 from cosinnus.models.profile import PROFILE_SETTING_ROCKET_CHAT_ID
 from cosinnus.utils.group import get_cosinnus_group_model
+from cosinnus_message.utils.profiling import ProfilableCommand
+from cosinnus_message.models import RocketChatGroupRoomLink
 from cosinnus_message.rocket_chat import RocketChatConnection
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
-class Command(BaseCommand):
+class Command(ProfilableCommand):
     """
-    Sync users with Rocket.Chat
+    Migrates all groups from a dual-room to a single-room configuration: archives the rooms of
+    room keys that are no longer configured, and renames the remaining rooms to the current naming pattern.
+    Groups are processed in parallel, and the changed group settings are saved in bulk.
     """
-    
+
     def add_arguments(self, parser):
         parser.add_argument('-s', '--skip-rename', action='store_true', help='Skip renaming existing rooms (if the room name schema didn\'t change)')
+        parser.add_argument('-w', '--workers', type=int, default=4, help='Number of groups processed in parallel (default: 4)')
+        parser.add_argument('-b', '--batch-size', type=int, default=200, help='Number of changed groups saved per bulk update (default: 200)')
+        parser.add_argument('-d', '--dry-run', action='store_true', help='Only list the rocketchat API operations that would be made, without doing anything')
+
+    def get_stale_room_settings(self, group):
+        """ Returns a list of (setting key, room key, room id) for all saved room connections of
+            the group whose room key is no longer configured """
+        stale = []
+        for setting_key, setting_value in group.settings.items():
+            if setting_key.startswith(f'{PROFILE_SETTING_ROCKET_CHAT_ID}_'):
+                room_key = setting_key.replace(f'{PROFILE_SETTING_ROCKET_CHAT_ID}_', '', 1)
+                if not room_key in settings.COSINNUS_ROCKET_GROUP_ROOM_KEYS:
+                    stale.append((setting_key, room_key, setting_value))
+        return stale
+
+    def get_rocket(self):
+        """ Returns a rocketchat connection for the current worker thread """
+        if not hasattr(self._worker_state, 'rocket'):
+            self._worker_state.rocket = RocketChatConnection(stdout=self.stdout, stderr=self.stderr)
+        return self._worker_state.rocket
+
+    def migrate_group(self, group, skip_rename):
+        """ Archives the group's stale rooms and renames its remaining rooms. Runs in a worker thread.
+            @return: a tuple of (group, deleted setting keys, renamed, error) """
+        deleted_keys = []
+        renamed = False
+        error = False
+        try:
+            rocket = self.get_rocket()
+            for setting_key, room_key, room_id in self.get_stale_room_settings(group):
+                # go by direct room ids, because the room key is not configured any more
+                if not rocket.groups_archive(group, specific_room_ids=[room_id]):
+                    error = True
+                    self.stdout.write(f'\tError during group {group.slug} room archive: {room_key}: {room_id} ')
+                    break
+                deleted_keys.append(setting_key)
+            # the rename may save a looked up room id, which writes the entire settings, so the keys
+            # of the archived rooms are removed first. otherwise an interrupted run leaves them mixed
+            for deleted_key in deleted_keys:
+                del group.settings[deleted_key]
+
+            # call a rename on the group, so that the changed channel naming pattern is applied
+            if not error and not skip_rename:
+                if not rocket.groups_rename(group):
+                    self.stdout.write(f'\tError during group rename: {group.slug}')
+                    error = True
+                renamed = True
+        except Exception as e:
+            logger.exception(e)
+            error = True
+        return group, deleted_keys, renamed, error
+    
+    def run_worker(self, groups, results, skip_rename):
+        """ Migrates groups from the queue until it is empty. Runs in a worker thread. """
+        try:
+            while True:
+                try:
+                    group = groups.get_nowait()
+                except Empty:
+                    return
+                results.put(self.migrate_group(group, skip_rename))
+        finally:
+            # database connections are per thread, don't leave them open
+            connection.close()
 
+    def print_dry_run(self, portal_groups, skip_rename):
+        total = len(portal_groups)
+        operations = 0
+        for count, group in enumerate(portal_groups, 1):
+            self.stdout.write(f'Group {count}/{total} ("{group.slug}"):')
+            for setting_key, room_key, room_id in self.get_stale_room_settings(group):
+                self.stdout.write(f'\tgroups.archive roomId={room_id} (room key "{room_key}")')
+                self.stdout.write(f'\tremove group setting "{setting_key}"')
+                operations += 1
+            if not skip_rename:
+                for room_key, room_name_code in settings.COSINNUS_ROCKET_GROUP_ROOM_NAMES_MAP.items():
+                    room_id = group.settings.get(f'{PROFILE_SETTING_ROCKET_CHAT_ID}_{room_key}', None)
+                    if room_id:
+                        self.stdout.write(f'\tgroups.rename roomId={room_id} name={room_name_code % group.slug}')
+                    else:
+                        self.stdout.write(f'\tgroups.info roomName={room_name_code % group.slug}, then groups.rename if the room exists')
+                        operations += 1
+                    operations += 1
+        self.stdout.write(f'Dry run: {operations} API operations for {total} groups.')
 
     def handle(self, *args, **options):
         skip_rename = options['skip_rename']
-        
+
         if not settings.COSINNUS_CHAT_USER:
             return
         # sanity checks
@@ -32,49 +121,44 @@ class Command(BaseCommand):
         if len(settings.COSINNUS_ROCKET_GROUP_ROOM_KEYS) == 0:
             self.stdout.write('*Aborting*: there seems to be no rocketchat configured in `COSINNUS_ROCKET_GROUP_ROOM_KEYS`. This would archive *all* the rocketchat channels!')
             return
-        
-        rocket = RocketChatConnection(stdout=self.stdout, stderr=self.stderr)
-        portal_groups = get_cosinnus_group_model().objects.all_in_portal()
+
+        portal_groups = list(get_cosinnus_group_model().objects.all_in_portal())
+        if options['dry_run']:
+            self.print_dry_run(portal_groups, skip_rename)
+            return
+
+        self._worker_state = local()
+        group_model = get_cosinnus_group_model()
         count = 0
         errors = 0
         total = len(portal_groups)
+        changed_groups = []
+        groups = Queue()
         for group in portal_groups:
-            # go through the group settings and find any saved room connections
-            deleted_keys = []
-            renamed = False
-            error = False
-            for setting_key, setting_value in group.settings.items():
-                if setting_key.startswith(f'{PROFILE_SETTING_ROCKET_CHAT_ID}_'):
-                    room_key = setting_key.replace(f'{PROFILE_SETTING_ROCKET_CHAT_ID}_', '', 1)
-                    # if the room key no longer exists in the settings, *archive* the room and remove the key from the settings
-                    if not room_key in settings.COSINNUS_ROCKET_GROUP_ROOM_KEYS:
-                        # go by direct room ids, because the room key is not configured any more
-                        if not rocket.groups_archive(group, specific_room_ids=[setting_value]):
-                            error = True
-                            self.stdout.write(f'\tError during group {group.slug} room archive: {room_key}: {setting_value} ')
-                            break
-                        deleted_keys.append(setting_key)
-                        
-            if not error:
-                # soft-save the group if the settings object was changed
-                if deleted_keys:
-                    for deleted_key in deleted_keys:
-                        del group.settings[deleted_key]
-                    type(group).objects.filter(pk=group.pk).update(settings=group.settings)
-                
-                # call a rename on the group, so that the changed channel naming pattern is applied
-                if not skip_rename:
-                    if not rocket.groups_rename(group):
-                        self.stdout.write(f'\tError during group rename: {group.slug}')
-                        error = True
-                    renamed = True
-                
-            if error:
-                errors += 1
-            
-            count += 1
-            self.stdout.write(f'Processed group {count}/{total} ({errors} Errors) ("{group.slug}"): {"**Error!**" if error else ""} Delete channels: {deleted_keys}. Trigger rename: {renamed} ')
-            
-            
-            
-        
\ No newline at end of file
+            groups.put(group)
+        results = Queue()
+        with self.profile_phase('migrate groups'):
+            workers = [Thread(target=self.run_worker, args=(groups, results, skip_rename)) 
+                       for __ in range(max(1, min(options['workers'], total)))]
+            for worker in workers:
+                worker.start()
+            for __ in range(total):
+                group, deleted_keys, renamed, error = results.get()
+                # the archived rooms were removed from the group settings by the worker. the rename may
+                # also have filled in room ids for the configured room keys, so changed settings are saved in any case
+                if deleted_keys or renamed:
+                    if deleted_keys:
+                        RocketChatGroupRoomLink.objects.remove_links(group, room_keys=[
+                            deleted_key.replace(f'{PROFILE_SETTING_ROCKET_CHAT_ID}_', '', 1) for deleted_key in deleted_keys])
+                    changed_groups.append(group)
+                if len(changed_groups) >= options['batch_size']:
+                    group_model.objects.bulk_update(changed_groups, ['settings'])
+                    changed_groups = []
+                if error:
+                    errors += 1
+                count += 1
+                self.stdout.write(f'Processed group {count}/{total} ({errors} Errors) ("{group.slug}"): {"**Error!**" if error else ""} Delete channels: {deleted_keys}. Trigger rename: {renamed} ')
+            for worker in workers:
+                worker.join()
+        if changed_groups:
+            group_model.objects.bulk_update(changed_groups, ['settings'])
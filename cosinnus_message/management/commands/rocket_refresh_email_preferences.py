@@ -0,0 +1,28 @@
+import logging
+
+from cosinnus_message.utils.profiling import ProfilableCommand
+from cosinnus_message.rocket_chat import RocketChatConnection
+from cosinnus.conf import settings
+
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+class Command(ProfilableCommand):
+    """
+    Re-fetches the rocketchat email notification preferences of all users into the local mirror
+    that is shown on the notification settings page. Users that were never fetched come first.
+    Should be run once after deploying the mirror, after that the refresh cronjob keeps it up to date.
+    """
+    
+    def add_arguments(self, parser):
+        parser.add_argument('-l', '--limit', type=int, default=None, help='Only refresh this many users')
+
+    def handle(self, *args, **options):
+        if not settings.COSINNUS_CHAT_USER:
+            return
+        
+        rocket = RocketChatConnection(stdout=self.stdout, stderr=self.stderr)
+        refreshed, failed = rocket.refresh_user_email_preferences(limit=options['limit'])
+        self.stdout.write(f'Refreshed email preferences of {refreshed} users ({failed} Errors)')
@@ -1,7 +1,6 @@
 import logging
 
-from django.core.management.base import BaseCommand
-
+from cosinnus_message.utils.profiling import ProfilableCommand
 from cosinnus_message.rocket_chat import RocketChatConnection
 from cosinnus.utils.group import get_cosinnus_group_model
 from cosinnus.models.group import CosinnusPortal
@@ -18,7 +17,7 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
-class Command(BaseCommand):
+class Command(ProfilableCommand):
     """
     For all users who have *not yet* set any rocketchat mail notification preference, 
     this will set the equivalent of their current portal-mail notification setting 
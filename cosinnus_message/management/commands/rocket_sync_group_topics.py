@@ -1,7 +1,10 @@
 import logging
+from queue import Queue, Empty
+from threading import Thread, local
 
-from django.core.management.base import BaseCommand
+from django.db import connection
 
+from cosinnus_message.utils.profiling import ProfilableCommand
 from cosinnus_message.rocket_chat import RocketChatConnection
 from cosinnus.utils.group import get_cosinnus_group_model
 from cosinnus.models.group import CosinnusPortal
@@ -12,17 +15,69 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
-class Command(BaseCommand):
+class Command(ProfilableCommand):
     """
-    Sets all group room's topics anew
+    Sets all group room's topics anew. The current topics are fetched in bulk first,
+    so that only rooms whose topic differs from the group url are updated.
     """
     
+    def add_arguments(self, parser):
+        parser.add_argument('-w', '--workers', type=int, default=4, help='Number of topic updates run in parallel (default: 4)')
+    
+    def get_rocket(self):
+        """ Returns a rocketchat connection for the current worker thread """
+        if not hasattr(self._worker_state, 'rocket'):
+            self._worker_state.rocket = RocketChatConnection(stdout=self.stdout, stderr=self.stderr)
+        return self._worker_state.rocket
+    
+    def set_topic(self, group, current_topics):
+        try:
+            return self.get_rocket().group_set_topic_to_url(group, current_topics=current_topics)
+        except Exception as e:
+            logger.exception(e)
+            return 0, 0, len(settings.COSINNUS_ROCKET_GROUP_ROOM_KEYS)
+
+    def run_worker(self, groups, results, current_topics):
+        """ Sets the topics of groups from the queue until it is empty. Runs in a worker thread. """
+        try:
+            while True:
+                try:
+                    group = groups.get_nowait()
+                except Empty:
+                    return
+                results.put(self.set_topic(group, current_topics))
+        finally:
+            # database connections are per thread, don't leave them open
+            connection.close()
 
     def handle(self, *args, **options):
         if not settings.COSINNUS_CHAT_USER:
             return
         
         rocket = RocketChatConnection(stdout=self.stdout, stderr=self.stderr)
+        with self.profile_phase('fetch topics'):
+            current_topics = rocket.get_room_topics()
+        if current_topics is None:
+            self.stdout.write('Could not fetch the current room topics, setting all topics anew.')
+        
         current_portal = CosinnusPortal.get_current()
+        groups = Queue()
         for group in get_cosinnus_group_model().objects.filter(portal=current_portal, is_active=True):
-            rocket.group_set_topic_to_url(group)
+            groups.put(group)
+        total = groups.qsize()
+        self._worker_state = local()
+        updated, unchanged, failed = 0, 0, 0
+        results = Queue()
+        with self.profile_phase('set topics'):
+            workers = [Thread(target=self.run_worker, args=(groups, results, current_topics))
+                       for __ in range(max(1, min(options['workers'], total)))]
+            for worker in workers:
+                worker.start()
+            for __ in range(total):
+                group_updated, group_unchanged, group_failed = results.get()
+                updated += group_updated
+                unchanged += group_unchanged
+                failed += group_failed
+            for worker in workers:
+                worker.join()
+        self.stdout.write(f'Synced topics of {total} groups. Rooms unchanged: {unchanged}, updated: {updated}, failed: {failed}')
@@ -0,0 +1,28 @@
+import logging
+
+from django.core.management.base import CommandError
+
+from cosinnus_message.utils.profiling import ProfilableCommand
+from cosinnus_message.rocket_chat import RocketChatConnection
+from cosinnus.conf import settings
+
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+class Command(ProfilableCommand):
+    """
+    Warms up the rocketchat connection and caches after a deploy: authenticates the admin connection
+    once, validates it and preloads the room ids and room names of all active groups into the cache.
+    Exits with an error if the admin connection is not valid.
+    Meant to be run once per deploy, from the deploy or worker start script, after the migrations.
+    """
+
+    def handle(self, *args, **options):
+        if not settings.COSINNUS_CHAT_USER:
+            return
+        
+        rocket = RocketChatConnection(stdout=self.stdout, stderr=self.stderr)
+        if rocket.warm_up(stdout=self.stdout) is None:
+            raise CommandError('Rocketchat warm-up failed, see the log for details.')
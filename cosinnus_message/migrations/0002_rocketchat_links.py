@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        migrations.swappable_dependency(settings.COSINNUS_GROUP_OBJECT_MODEL),
+        ('cosinnus_message', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RocketChatUserLink',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rocket_user_id', models.CharField(blank=True, max_length=64, null=True, unique=True, verbose_name='Rocket.Chat user ID')),
+                ('rocket_username', models.CharField(blank=True, db_index=True, max_length=255, verbose_name='Rocket.Chat username')),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='rocketchat_link', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'verbose_name': 'Rocket.Chat user link',
+                'verbose_name_plural': 'Rocket.Chat user links',
+            },
+        ),
+        migrations.CreateModel(
+            name='RocketChatGroupRoomLink',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('room_key', models.CharField(max_length=100, verbose_name='Room key')),
+                ('room_id', models.CharField(db_index=True, max_length=64, verbose_name='Rocket.Chat room ID')),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rocketchat_room_links', to=settings.COSINNUS_GROUP_OBJECT_MODEL, verbose_name='Group')),
+            ],
+            options={
+                'verbose_name': 'Rocket.Chat group room link',
+                'verbose_name_plural': 'Rocket.Chat group room links',
+                'unique_together': {('group', 'room_key')},
+            },
+        ),
+        migrations.CreateModel(
+            name='RocketChatContactRoomLink',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('room_name', models.CharField(max_length=255, unique=True, verbose_name='Rocket.Chat room name')),
+                ('room_id', models.CharField(blank=True, db_index=True, max_length=64, null=True, verbose_name='Rocket.Chat room ID')),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rocketchat_contact_room_links', to=settings.COSINNUS_GROUP_OBJECT_MODEL, verbose_name='Group')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rocketchat_contact_room_links', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'verbose_name': 'Rocket.Chat contact room link',
+                'verbose_name_plural': 'Rocket.Chat contact room links',
+                'unique_together': {('user', 'group')},
+            },
+        ),
+    ]
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations
+
+from cosinnus.models.profile import PROFILE_SETTING_ROCKET_CHAT_ID, PROFILE_SETTING_ROCKET_CHAT_USERNAME,\
+    PROFILE_SETTING_ROCKET_CHAT_CONTACT_GROUP_ROOM
+
+
+BATCH_SIZE = 1000
+
+
+def backfill_rocketchat_links(apps, schema_editor):
+    """ Copies the rocketchat ids saved in the profile and group settings into the link tables.
+        Conflicting duplicates (e.g. two groups pointing to the same room) are skipped. """
+    UserProfile = apps.get_model(getattr(settings, 'COSINNUS_USER_PROFILE_MODEL', 'cosinnus.UserProfile'))
+    CosinnusGroup = apps.get_model(settings.COSINNUS_GROUP_OBJECT_MODEL)
+    RocketChatUserLink = apps.get_model('cosinnus_message', 'RocketChatUserLink')
+    RocketChatGroupRoomLink = apps.get_model('cosinnus_message', 'RocketChatGroupRoomLink')
+    RocketChatContactRoomLink = apps.get_model('cosinnus_message', 'RocketChatContactRoomLink')
+    
+    group_ids = set(CosinnusGroup.objects.values_list('id', flat=True))
+    contact_room_prefix = PROFILE_SETTING_ROCKET_CHAT_CONTACT_GROUP_ROOM.split('%')[0]
+    
+    user_links, contact_links = [], []
+    for profile in UserProfile.objects.only('user_id', 'settings').iterator():
+        profile_settings = profile.settings or {}
+        rocket_user_id = profile_settings.get(PROFILE_SETTING_ROCKET_CHAT_ID)
+        rocket_username = profile_settings.get(PROFILE_SETTING_ROCKET_CHAT_USERNAME)
+        if rocket_user_id or rocket_username:
+            user_links.append(RocketChatUserLink(user_id=profile.user_id, rocket_user_id=rocket_user_id or None,
+                                                 rocket_username=rocket_username or ''))
+        for key, room_name in profile_settings.items():
+            if not key.startswith(contact_room_prefix) or not room_name:
+                continue
+            group_id = key[len(contact_room_prefix):]
+            if group_id.isdigit() and int(group_id) in group_ids:
+                contact_links.append(RocketChatContactRoomLink(user_id=profile.user_id, group_id=int(group_id), room_name=room_name))
+        if len(user_links) >= BATCH_SIZE:
+            RocketChatUserLink.objects.bulk_create(user_links, ignore_conflicts=True)
+            user_links = []
+        if len(contact_links) >= BATCH_SIZE:
+            RocketChatContactRoomLink.objects.bulk_create(contact_links, ignore_conflicts=True)
+            contact_links = []
+    RocketChatUserLink.objects.bulk_create(user_links, ignore_conflicts=True)
+    RocketChatContactRoomLink.objects.bulk_create(contact_links, ignore_conflicts=True)
+    
+    room_prefix = f'{PROFILE_SETTING_ROCKET_CHAT_ID}_'
+    room_links = []
+    for group in CosinnusGroup.objects.only('id', 'settings').iterator():
+        for key, room_id in (group.settings or {}).items():
+            if key.startswith(room_prefix) and room_id:
+                room_links.append(RocketChatGroupRoomLink(group_id=group.id, room_key=key[len(room_prefix):], room_id=room_id))
+        if len(room_links) >= BATCH_SIZE:
+            RocketChatGroupRoomLink.objects.bulk_create(room_links, ignore_conflicts=True)
+            room_links = []
+    RocketChatGroupRoomLink.objects.bulk_create(room_links, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cosinnus_message', '0002_rocketchat_links'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_rocketchat_links, migrations.RunPython.noop),
+    ]
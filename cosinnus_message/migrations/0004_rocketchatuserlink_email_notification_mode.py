@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cosinnus_message', '0003_backfill_rocketchat_links'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rocketchatuserlink',
+            name='email_notification_mode',
+            field=models.CharField(blank=True, max_length=20, null=True, verbose_name='Email notification mode'),
+        ),
+        migrations.AddField(
+            model_name='rocketchatuserlink',
+            name='email_notification_mode_synced',
+            field=models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='Email notification mode last synced'),
+        ),
+    ]
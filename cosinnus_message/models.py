@@ -6,7 +6,8 @@ from cosinnus_message.conf import settings # we need this import here!
 
 from django_mailbox.models import Mailbox
 from cosinnus.models.group import CosinnusPortal
-from django.db import models
+from django.db import models, transaction
+from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 
 
@@ -22,6 +23,152 @@ class CosinnusMailbox(Mailbox):
         verbose_name_plural = "Cosinnus Mailboxes"
 
 
+
+class RocketChatUserLinkManager(models.Manager):
+    
+    def get_user(self, rocket_user_id):
+        """ Returns the user for a rocketchat user id, or None """
+        link = self.filter(rocket_user_id=rocket_user_id).select_related('user').first()
+        return link.user if link else None
+    
+    def get_user_by_username(self, rocket_username):
+        """ Returns the user for a rocketchat username, or None """
+        link = self.filter(rocket_username=rocket_username).select_related('user').first()
+        return link.user if link else None
+    
+    def set_link(self, user, **fields):
+        """ Creates or updates the link for a user with the given fields.
+            A stale link of another user holding the same rocketchat user id is cleared first. """
+        with transaction.atomic():
+            if fields.get('rocket_user_id'):
+                self.filter(rocket_user_id=fields['rocket_user_id']).exclude(user=user).update(rocket_user_id=None)
+            return self.update_or_create(user=user, defaults=fields)[0]
+    
+    def get_email_notification_mode(self, user):
+        """ Returns the locally mirrored rocketchat `emailNotificationMode` preference of a user,
+            '' if the user never set one, or None if it is unknown """
+        return self.filter(user=user).values_list('email_notification_mode', flat=True).first()
+    
+    def set_email_notification_mode(self, user, mode):
+        """ Updates the local mirror of a user's rocketchat `emailNotificationMode` preference """
+        return self.set_link(user, email_notification_mode=mode, email_notification_mode_synced=now())
+
+
+class RocketChatUserLink(models.Model):
+    """ Links a user to their rocketchat account.
+        Mirrors the rocketchat user id and username from the user's profile settings 
+        for indexed lookups in both directions. """
+    
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, verbose_name=_('User'), 
+        related_name='rocketchat_link', on_delete=models.CASCADE)
+    rocket_user_id = models.CharField(_('Rocket.Chat user ID'), max_length=64, unique=True, null=True, blank=True)
+    rocket_username = models.CharField(_('Rocket.Chat username'), max_length=255, blank=True, db_index=True)
+    # local mirror of the user's rocketchat `emailNotificationMode` preference, so it can be shown
+    # without a request to rocketchat. '' if the user never set it, None if it was never fetched
+    email_notification_mode = models.CharField(_('Email notification mode'), max_length=20, null=True, blank=True)
+    email_notification_mode_synced = models.DateTimeField(_('Email notification mode last synced'), 
+        null=True, blank=True, db_index=True)
+    
+    objects = RocketChatUserLinkManager()
+    
+    class Meta(object):
+        verbose_name = _('Rocket.Chat user link')
+        verbose_name_plural = _('Rocket.Chat user links')
+    
+    def __str__(self):
+        return '%s <-> %s' % (self.user_id, self.rocket_user_id)
+
+
+class RocketChatGroupRoomLinkManager(models.Manager):
+    
+    def get_group(self, room_id):
+        """ Returns the group for a rocketchat room id, or None """
+        link = self.filter(room_id=room_id).select_related('group').first()
+        return link.group if link else None
+    
+    def get_group_and_room_key(self, room_id):
+        """ Returns a tuple of (group, room key) for a rocketchat room id, or (None, None) """
+        link = self.filter(room_id=room_id).select_related('group').first()
+        return (link.group, link.room_key) if link else (None, None)
+    
+    def set_link(self, group, room_key, room_id):
+        """ Creates or updates the link for a group's room.
+            Stale links of other groups or room keys to the same rocketchat room are removed first. """
+        with transaction.atomic():
+            self.filter(room_id=room_id).exclude(group=group, room_key=room_key).delete()
+            return self.update_or_create(group=group, room_key=room_key, defaults={'room_id': room_id})[0]
+    
+    def remove_links(self, group, room_keys=None):
+        """ Removes the links for all or the given room keys of a group """
+        queryset = self.filter(group=group)
+        if room_keys is not None:
+            queryset = queryset.filter(room_key__in=room_keys)
+        queryset.delete()
+
+
+class RocketChatGroupRoomLink(models.Model):
+    """ Links a group's room of a room key (see `COSINNUS_ROCKET_GROUP_ROOM_KEYS`) to its rocketchat room.
+        Mirrors the room ids from the group's settings for indexed lookups in both directions. """
+    
+    group = models.ForeignKey(settings.COSINNUS_GROUP_OBJECT_MODEL, verbose_name=_('Group'),
+        related_name='rocketchat_room_links', on_delete=models.CASCADE)
+    room_key = models.CharField(_('Room key'), max_length=100)
+    room_id = models.CharField(_('Rocket.Chat room ID'), max_length=64, db_index=True)
+    
+    objects = RocketChatGroupRoomLinkManager()
+    
+    class Meta(object):
+        unique_together = (('group', 'room_key'),)
+        verbose_name = _('Rocket.Chat group room link')
+        verbose_name_plural = _('Rocket.Chat group room links')
+    
+    def __str__(self):
+        return '%s/%s <-> %s' % (self.group_id, self.room_key, self.room_id)
+
+
+class RocketChatContactRoomLinkManager(models.Manager):
+    
+    def get_user_and_group(self, room_id):
+        """ Returns a tuple of (user, group) for a rocketchat contact room id, or (None, None) """
+        link = self.filter(room_id=room_id).select_related('user', 'group').first()
+        return (link.user, link.group) if link else (None, None)
+    
+    def is_room_name_taken(self, room_name):
+        return self.filter(room_name=room_name).exists()
+    
+    def set_link(self, user, group, room_name, room_id=None):
+        """ Creates or updates the contact room link of a user for a group.
+            A stale link of another user or group holding the same room name is removed first. """
+        with transaction.atomic():
+            self.filter(room_name=room_name).exclude(user=user, group=group).delete()
+            return self.update_or_create(user=user, group=group, defaults={'room_name': room_name, 'room_id': room_id})[0]
+    
+    def remove_link(self, user, group):
+        self.filter(user=user, group=group).delete()
+
+
+class RocketChatContactRoomLink(models.Model):
+    """ Links a user and a group to the rocketchat contact room the user opened to talk to the group's admins.
+        Mirrors the contact room names from the user's profile settings. """
+    
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name=_('User'),
+        related_name='rocketchat_contact_room_links', on_delete=models.CASCADE)
+    group = models.ForeignKey(settings.COSINNUS_GROUP_OBJECT_MODEL, verbose_name=_('Group'),
+        related_name='rocketchat_contact_room_links', on_delete=models.CASCADE)
+    room_name = models.CharField(_('Rocket.Chat room name'), max_length=255, unique=True)
+    room_id = models.CharField(_('Rocket.Chat room ID'), max_length=64, null=True, blank=True, db_index=True)
+    
+    objects = RocketChatContactRoomLinkManager()
+    
+    class Meta(object):
+        unique_together = (('user', 'group'),)
+        verbose_name = _('Rocket.Chat contact room link')
+        verbose_name_plural = _('Rocket.Chat contact room links')
+    
+    def __str__(self):
+        return '%s/%s <-> %s' % (self.user_id, self.group_id, self.room_name)
+
+
 import django
 if django.VERSION[:2] < (1, 7):
     from cosinnus_message import cosinnus_app
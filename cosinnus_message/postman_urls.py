@@ -97,7 +97,7 @@ from django.views.generic.base import RedirectView
 
 from postman import OPTIONS
 from postman.views import (InboxView, SentView, ArchivesView, TrashView,
-        WriteView, ReplyView)
+        WriteView, ReplyView, ConversationOlderView)
 from cosinnus.views.user import UserSelect2View
 
 
@@ -107,6 +107,7 @@ urlpatterns = [
 
     url(r'^nachricht/(?P<message_id>[\d]+)/$', CosinnusMessageView.as_view(), name='view'),
     url(r'^nachricht/t/(?P<thread_id>[\d]+)/$', CosinnusConversationView.as_view(), name='view_conversation'),
+    url(r'^nachricht/t/(?P<thread_id>[\d]+)/aeltere/$', ConversationOlderView.as_view(), name='view_conversation_older'),
     url(r'^archiv/$', ArchiveView.as_view(), name='archive'),
     url(r'^loeschen/$', DeleteView.as_view(), name='delete'),
     url(r'^wiederherstellen/$', UndeleteView.as_view(), name='undelete'),
@@ -0,0 +1,57 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import logging
+from threading import Lock
+
+from django.db import close_old_connections
+
+from cosinnus.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = Lock()
+
+
+def get_rocket_executor():
+    """ Returns the thread pool in which all blocking rocketchat requests of async code are run.
+        Its size bounds the number of concurrent rocketchat requests per process. """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=settings.COSINNUS_CHAT_ASYNC_MAX_WORKERS,
+                                               thread_name_prefix='cosinnus-rocketchat')
+    return _executor
+
+
+def _run_in_worker(method_name, args, kwargs):
+    from cosinnus_message.rocket_chat import RocketChatConnection
+    try:
+        # the client is taken from the connection cache for every call, which checks it
+        # and logs in again once its auth token has expired
+        return getattr(RocketChatConnection(), method_name)(*args, **kwargs)
+    finally:
+        # database connections are per thread, don't keep broken or expired ones in the pool's threads
+        close_old_connections()
+
+
+class AsyncRocketChatConnection(object):
+    """ Awaitable counterpart of `RocketChatConnection` for async views.
+
+        Every public method of `RocketChatConnection` can be awaited on this class with the same
+        arguments, e.g. `await AsyncRocketChatConnection().groups_request(group, user)`.
+        The blocking rocketchat API client is run in a bounded thread pool, so that the event loop
+        is free while waiting on rocketchat. Every call uses the cached rocketchat connection. """
+
+    def __getattr__(self, name):
+        from cosinnus_message.rocket_chat import RocketChatConnection
+        if name.startswith('_') or not callable(getattr(RocketChatConnection, name, None)):
+            raise AttributeError(name)
+
+        async def method(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(get_rocket_executor(), partial(_run_in_worker, name, args, kwargs))
+        method.__name__ = name
+        return method
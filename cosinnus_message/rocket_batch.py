@@ -0,0 +1,301 @@
+from collections import OrderedDict
+import logging
+from contextlib import contextmanager
+from copy import copy
+from threading import Thread, local
+import weakref
+
+from annoying.functions import get_object_or_None
+from django.db import transaction
+
+from cosinnus.conf import settings
+from cosinnus.models.group import CosinnusGroupMembership
+from cosinnus.utils.group import get_cosinnus_group_model
+
+logger = logging.getLogger(__name__)
+
+# per-thread state of the active membership and transaction batches
+_batch_state = local()
+
+# the `RocketChatConnection` method run for each deferrable (object type, action)
+TRANSACTION_BATCH_OPERATIONS = {
+    ('group', 'create'): 'groups_create',
+    ('group', 'update'): 'groups_rename',
+    ('group', 'delete'): 'groups_delete',
+    ('group', 'archive'): 'groups_archive',
+    ('group', 'unarchive'): 'groups_unarchive',
+    ('user', 'disable'): 'users_disable',
+    ('user', 'enable'): 'users_enable',
+    ('note', 'create'): 'notes_create',
+    ('note', 'update'): 'notes_update',
+    ('note', 'delete'): 'notes_delete',
+}
+# actions that toggle a state of an object, of which only the last one per object is run
+TRANSACTION_BATCH_STATE_ACTIONS = ('archive', 'unarchive', 'disable', 'enable')
+
+
+def get_membership_batch():
+    """ Returns the membership batch active in the current thread as dict of
+        group id -> set of user ids, or None if no batch is active """
+    return getattr(_batch_state, 'membership_batch', None)
+
+
+def record_membership_change(membership):
+    """ Records a saved or deleted membership in the membership batch active in the current thread.
+        @return: True if the change was recorded and will be synced when the batch ends,
+            False if no batch is active and the change should be synced directly """
+    batch = get_membership_batch()
+    if batch is None:
+        return False
+    _add_membership_to_batch(batch, membership)
+    return True
+
+
+def _get_membership_pairs(membership):
+    """ Returns the (group id, user id) pairs to sync for a saved or deleted membership """
+    pairs = [(membership.group_id, membership.user_id)]
+    if membership.id:
+        # a changed user or group of an existing membership needs the old pair synced as well
+        old = CosinnusGroupMembership.objects.filter(pk=membership.id).values_list('group_id', 'user_id').first()
+        if old:
+            pairs.append(old)
+    return pairs
+
+
+def _add_membership_to_batch(batch, membership):
+    for group_id, user_id in _get_membership_pairs(membership):
+        batch.setdefault(group_id, set()).add(user_id)
+
+
+def sync_membership_batch(batch, rocket=None):
+    """ Reconciles the rocketchat rooms of all groups in a membership batch with the
+        current memberships of the users recorded for them """
+    if rocket is None:
+        from cosinnus_message.rocket_chat import RocketChatConnection
+        rocket = RocketChatConnection()
+    for group in get_cosinnus_group_model().objects.filter(id__in=list(batch.keys())):
+        try:
+            rocket.groups_reconcile_memberships(group, batch[group.id])
+        except Exception as e:
+            logger.exception(e)
+
+
+@contextmanager
+def bulk_membership_sync(threaded=False):
+    """ Context manager for changing many group memberships at once, e.g. for CSV imports,
+        conference registrations or group merges.
+
+        Inside the block, the rocketchat membership hooks only record which users' memberships
+        of which groups were saved or deleted. When the block is left, the rooms of each affected
+        group are reconciled with the memberships in the database in one go, using bulk invites
+        instead of one set of requests per membership. Nested blocks are synced by the outermost one.
+
+        Usage:
+            with bulk_membership_sync():
+                for user in users:
+                    CosinnusGroupMembership.objects.create(group=group, user=user, status=MEMBERSHIP_MEMBER)
+
+        @param threaded: if True, the reconciliation is run in a thread after leaving the block """
+    if get_membership_batch() is not None:
+        yield
+        return
+
+    _batch_state.membership_batch = {}
+    try:
+        yield
+    finally:
+        batch = _batch_state.membership_batch
+        _batch_state.membership_batch = None
+        if batch and settings.COSINNUS_ROCKET_ENABLED:
+            if threaded:
+                class CosinnusRocketMembershipBatchThread(Thread):
+                    def run(self):
+                        sync_membership_batch(batch)
+                CosinnusRocketMembershipBatchThread().start()
+            else:
+                sync_membership_batch(batch)
+
+
+class _RecordedChange(object):
+    """ A change recorded in a transaction batch, registered as a commit callback of the transaction.
+        The batch only holds a weak reference to it until it is called on commit, so if django discards
+        the callback because the transaction or savepoint it was recorded in is rolled back, the change
+        is gone from the batch as well. """
+    
+    def __init__(self, batch, kind, data):
+        self.batch = batch
+        self.kind = kind
+        self.data = data
+    
+    def __call__(self):
+        self.batch.committed_changes.append(self)
+
+
+class RocketTransactionBatch(object):
+    """ The rocketchat operations recorded during one database transaction,
+        run in one de-duplicated go once the transaction has been committed. """
+    
+    def __init__(self):
+        # weak references to the recorded `_RecordedChange`s, in order of recording
+        self.changes = []
+        # the changes whose commit callback has been called
+        self.committed_changes = []
+        self.flushed = False
+    
+    def record(self, kind, data):
+        """ Records a change in the current atomic block.
+            @param kind: 'operation' with data (object type, action, instance, pk at the time of recording),
+                or 'membership' with data [(group id, user id), ...] """
+        change = _RecordedChange(self, kind, data)
+        self.changes.append(weakref.ref(change))
+        transaction.on_commit(change)
+        # registered for every change, so that the batch still runs if a savepoint with
+        # an earlier registration was rolled back. only the first call runs the batch
+        transaction.on_commit(self.flush_on_commit)
+    
+    def _get_changes(self, kind):
+        """ Returns the data of all recorded changes of a kind that were not rolled back """
+        changes = [ref() for ref in self.changes]
+        return [change.data for change in changes if change is not None and change.kind == kind]
+    
+    @property
+    def operations(self):
+        """ List of (object type, action, instance, pk at the time of recording) """
+        return self._get_changes('operation')
+    
+    @property
+    def memberships(self):
+        """ Dict of group id -> set of user ids, like a membership batch """
+        memberships = {}
+        for pairs in self._get_changes('membership'):
+            for group_id, user_id in pairs:
+                memberships.setdefault(group_id, set()).add(user_id)
+        return memberships
+    
+    def flush_on_commit(self):
+        """ Called on commit, possibly multiple times. Runs the batch once. """
+        if self.flushed:
+            return
+        self.flushed = True
+        if _get_current_transaction_batch() is self:
+            _batch_state.transaction_batch = None
+        # the changes whose callbacks are still pending are only referenced by django until
+        # the commit callbacks have run, so they are collected here
+        operations, memberships = self.get_merged_operations(), self.memberships
+        if settings.COSINNUS_CHAT_TRANSACTION_BATCH_ASYNC:
+            batch = self
+            class CosinnusRocketTransactionBatchThread(Thread):
+                def run(self):
+                    batch.flush(operations, memberships)
+            CosinnusRocketTransactionBatchThread().start()
+        else:
+            self.flush(operations, memberships)
+    
+    def get_merged_operations(self):
+        """ De-duplicates the recorded operations per object:
+                - a create followed by updates is a single create
+                - a delete supersedes any previous create and update, and for an object
+                    that was created in the same transaction, nothing is done at all
+                - of the state toggling actions (archive, disable, ...), only the last one counts
+            @return: an ordered list of (object type, action, instance, pk) """
+        lifecycle, state = OrderedDict(), OrderedDict()
+        for object_type, action, instance, pk in self.operations:
+            # objects created in the transaction only have a pk after saving
+            pk = pk or instance.pk
+            if pk is None:
+                continue
+            key = (object_type, pk)
+            if action in TRANSACTION_BATCH_STATE_ACTIONS:
+                state[key] = (object_type, action, instance, pk)
+                continue
+            previous_action = lifecycle[key][1] if key in lifecycle else None
+            if previous_action == 'create' and action == 'update':
+                continue
+            if action == 'delete':
+                state.pop(key, None)
+                if previous_action == 'create':
+                    del lifecycle[key]
+                    continue
+            lifecycle[key] = (object_type, action, instance, pk)
+        return list(lifecycle.values()) + list(state.values())
+    
+    def flush(self, operations, memberships):
+        """ Runs the merged operations against the database state after the commit. Group operations
+            run first, then membership syncs, then user and note operations. """
+        from cosinnus_message.rocket_chat import RocketChatConnection
+        try:
+            rocket = RocketChatConnection()
+        except Exception as e:
+            logger.exception(e)
+            return
+        for object_type in ('group', 'user', 'note'):
+            for operation in [op for op in operations if op[0] == object_type]:
+                self._run_operation(rocket, *operation)
+            if object_type == 'group':
+                # newly created rooms already contain all members, and deleted rooms need no syncing
+                skipped_group_ids = set([pk for op_type, action, __, pk in operations 
+                                         if op_type == 'group' and action in ('create', 'delete')])
+                memberships = dict([(group_id, user_ids) for group_id, user_ids in memberships.items() 
+                                    if group_id not in skipped_group_ids])
+                if memberships:
+                    sync_membership_batch(memberships, rocket=rocket)
+    
+    def _run_operation(self, rocket, object_type, action, instance, pk):
+        try:
+            # always act on the committed state of the object
+            current = get_object_or_None(type(instance), pk=pk)
+            if action == 'delete':
+                if current is not None:
+                    return
+                # django clears the pk of a deleted instance, but the operation needs it like the post_delete hook had it
+                current = copy(instance)
+                current.pk = pk
+            elif current is None:
+                return
+            getattr(rocket, TRANSACTION_BATCH_OPERATIONS[(object_type, action)])(current)
+        except Exception as e:
+            logger.exception(e)
+
+
+def _get_current_transaction_batch():
+    ref = getattr(_batch_state, 'transaction_batch', None)
+    return ref() if ref is not None else None
+
+
+def get_transaction_batch():
+    """ Returns the batch for the transaction active in the current thread, creating it if necessary.
+        Returns None if no transaction is active or transaction batching is disabled. """
+    if not settings.COSINNUS_CHAT_TRANSACTION_BATCH_ENABLED:
+        return None
+    if not transaction.get_connection().in_atomic_block:
+        return None
+    # the thread only holds a weak reference to the batch, which is kept alive by its commit callbacks.
+    # django discards these when the transaction is rolled back, and with them the batch
+    batch = _get_current_transaction_batch()
+    if batch is None or batch.flushed:
+        batch = RocketTransactionBatch()
+        _batch_state.transaction_batch = weakref.ref(batch)
+    return batch
+
+
+def defer_to_transaction(object_type, action, instance):
+    """ Records a rocketchat operation to be run once the current transaction is committed.
+        Operations recorded in a savepoint that is rolled back are dropped.
+        @param object_type: 'group', 'user' or 'note'
+        @param action: see `TRANSACTION_BATCH_OPERATIONS`
+        @return: True if the operation was recorded, False if it should be run directly """
+    batch = get_transaction_batch()
+    if batch is None:
+        return False
+    batch.record('operation', (object_type, action, instance, instance.pk))
+    return True
+
+
+def defer_membership_change_to_transaction(membership):
+    """ Records a saved or deleted membership to be synced once the current transaction is committed.
+        @return: True if the change was recorded, False if it should be synced directly """
+    batch = get_transaction_batch()
+    if batch is None:
+        return False
+    batch.record('membership', _get_membership_pairs(membership))
+    return True
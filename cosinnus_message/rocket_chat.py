@@ -1,18 +1,24 @@
+import json
 import logging
 import mimetypes
 import os
+import random
 import re
 import secrets
+from threading import Lock, Thread, local
+import time
 
 from cosinnus.models.group_extra import CosinnusSociety, CosinnusProject,\
     CosinnusConference
 from cosinnus.conf import settings
 from django.core.cache import cache
 from django.contrib.auth import get_user_model
-from django.db.models import Q
+from django.db.models import F, Q
 from django.utils.crypto import get_random_string
 from django.utils.translation import ugettext_lazy as _
 from oauth2_provider.models import Application
+import requests
+from requests.exceptions import RequestException
 
 from rocketchat_API.APIExceptions.RocketExceptions import RocketAuthenticationException,\
     RocketConnectionException
@@ -21,22 +27,39 @@ from cosinnus.models.group import CosinnusPortal, CosinnusGroupMembership
 from cosinnus.models import MEMBERSHIP_ADMIN
 from cosinnus.models.membership import MEMBERSHIP_MEMBER,\
     MEMBERSHIP_INVITED_PENDING, MEMBERSHIP_PENDING, MEMBER_STATUS
-from cosinnus.models.profile import PROFILE_SETTING_ROCKET_CHAT_ID, PROFILE_SETTING_ROCKET_CHAT_USERNAME,\
-    PROFILE_SETTING_ROCKET_CHAT_CONTACT_GROUP_ROOM, get_user_profile_model
+from cosinnus.models.profile import PROFILE_SETTING_ROCKET_CHAT_ID, PROFILE_SETTING_ROCKET_CHAT_USERNAME
 import traceback
+from cosinnus.utils.group import get_cosinnus_group_model
 from cosinnus.utils.user import filter_active_users, filter_portal_users
 import six
 from annoying.functions import get_object_or_None
 from cosinnus_message.utils.utils import save_rocketchat_mail_notification_preference_for_user_setting
+from cosinnus_message.models import RocketChatUserLink, RocketChatGroupRoomLink,\
+    RocketChatContactRoomLink
 from cosinnus.templatetags.cosinnus_tags import full_name
 from django.template.defaultfilters import truncatewords
 
 logger = logging.getLogger(__name__)
 
 ROCKETCHAT_USER_CONNECTION_CACHE_KEY = 'cosinnus/core/portal/%d/rocketchat-user-connection/%s/'
+# cached resolved rocketchat room name for a group room. args: portal id, group id, room key
+ROCKETCHAT_GROUP_ROOM_NAME_CACHE_KEY = 'cosinnus/core/portal/%d/rocketchat-group-room-name/%d/%s/'
+# timestamp of the last room membership verification of a user for a group. args: portal id, group id, user id
+ROCKETCHAT_ROOM_MEMBERSHIP_VERIFIED_CACHE_KEY = 'cosinnus/core/portal/%d/rocketchat-room-membership-verified/%d/%d/'
+# timestamp of the last successful account sanity check of a user. args: portal id, user id
+ROCKETCHAT_USER_SANITY_VERIFIED_CACHE_KEY = 'cosinnus/core/portal/%d/rocketchat-user-sanity-verified/%d/'
 
 ROCKETCHAT_NOTE_ID_SETTINGS_KEY = 'rocket_chat_message_id'
 
+# process-wide locks for logging in rocketchat connections, by connection cache key
+_connection_locks = {}
+_connection_locks_lock = Lock()
+# the number of rocketchat logins made by this process, see `get_login_count`
+_login_count = 0
+_login_count_lock = Lock()
+# functions called with every response of the rocketchat clients, see `add_response_hook`
+_response_hooks = []
+
 ROCKETCHAT_PREFERENCE_EMAIL_NOTIFICATION_OFF = 'nothing'
 ROCKETCHAT_PREFERENCE_EMAIL_NOTIFICATION_DEFAULT = 'default'
 ROCKETCHAT_PREFERENCE_EMAIL_NOTIFICATION_MENTIONS = 'mentions'
@@ -46,14 +69,46 @@ ROCKETCHAT_PREFERENCES_EMAIL_NOTIFICATION = (
     ROCKETCHAT_PREFERENCE_EMAIL_NOTIFICATION_MENTIONS
 )
 
+def add_response_hook(hook):
+    """ Registers a function that is called with each response received by any rocketchat client
+        of this process, e.g. for profiling. The hook must be thread-safe. """
+    _response_hooks.append(hook)
+
+
+def remove_response_hook(hook):
+    if hook in _response_hooks:
+        _response_hooks.remove(hook)
+
+
+def _run_response_hooks(response, *args, **kwargs):
+    for hook in list(_response_hooks):
+        try:
+            hook(response)
+        except Exception as e:
+            logger.exception(e)
+
+
+def get_login_count():
+    """ Returns the number of rocketchat logins (initial and after an expired token) made by this process """
+    return _login_count
+
+
+def _get_connection_lock(cache_key):
+    """ Returns the process-wide lock for logging in the connection with the given cache key """
+    with _connection_locks_lock:
+        return _connection_locks.setdefault(cache_key, Lock())
+
+
 def get_cached_rocket_connection(rocket_username, password, server_url, reset=False, timeout=30):
     """ Retrieves a cached rocketchat connection or creates a new one and caches it.
+        If multiple threads find the cached connection expired at the same time, only one of
+        them logs in again, and the others use its new connection.
         @param reset: Resets the cached connection and connects a fresh one immediately """
     cache_key = ROCKETCHAT_USER_CONNECTION_CACHE_KEY % (CosinnusPortal.get_current().id, rocket_username)
 
+    stale_auth_token = None
     if reset:
         cache.delete(cache_key)
-        rocket_connection = None
     else:
         rocket_connection = cache.get(cache_key)
         # check if rocket connection is still alive, if not, remove it from cache
@@ -62,11 +117,18 @@ def get_cached_rocket_connection(rocket_username, password, server_url, reset=Fa
             alive = rocket_connection.me().status_code == 200
         except:
             pass
-        if not alive:
+        if alive:
+            return rocket_connection
+        if rocket_connection is not None:
+            stale_auth_token = rocket_connection.headers.get('X-Auth-Token')
+
+    with _get_connection_lock(cache_key):
+        if not reset:
+            # another thread may have logged in again while this one was waiting for the lock
+            rocket_connection = cache.get(cache_key)
+            if rocket_connection is not None and rocket_connection.headers.get('X-Auth-Token') not in (None, stale_auth_token):
+                return rocket_connection
             cache.delete(cache_key)
-            rocket_connection = None
-
-    if rocket_connection is None:
         rocket_connection = RocketChat(user=rocket_username, password=password, server_url=server_url, timeout=timeout)
         cache.set(cache_key, rocket_connection, settings.COSINNUS_CHAT_CONNECTION_CACHE_TIMEOUT)
     return rocket_connection
@@ -78,13 +140,178 @@ def delete_cached_rocket_connection(rocket_username):
     cache.delete(cache_key)
 
 
+def get_cached_group_room_name(group, room_key, room_id):
+    """ Returns the cached rocketchat room name for the given group room, or None if
+        nothing was cached or the cached name belongs to a different room id """
+    if not group.id or not room_id:
+        return None
+    cache_key = ROCKETCHAT_GROUP_ROOM_NAME_CACHE_KEY % (CosinnusPortal.get_current().id, group.id, room_key)
+    cached = cache.get(cache_key)
+    if cached and cached.get('room_id') == room_id:
+        return cached.get('name')
+    return None
+
+
+def set_cached_group_room_name(group, room_key, room_id, room_name):
+    """ Caches the resolved rocketchat room name for the given group room """
+    if not group.id or not room_id or not room_name:
+        return
+    cache_key = ROCKETCHAT_GROUP_ROOM_NAME_CACHE_KEY % (CosinnusPortal.get_current().id, group.id, room_key)
+    cache.set(cache_key, {'room_id': room_id, 'name': room_name}, settings.COSINNUS_CHAT_ROOM_NAME_CACHE_TIMEOUT)
+
+
+def delete_cached_group_room_names(group, room_keys=None):
+    """ Deletes the cached rocketchat room names for all (or the given) rooms of a group """
+    if not group.id:
+        return
+    room_keys = room_keys or settings.COSINNUS_ROCKET_GROUP_ROOM_KEYS
+    portal_id = CosinnusPortal.get_current().id
+    cache.delete_many([ROCKETCHAT_GROUP_ROOM_NAME_CACHE_KEY % (portal_id, group.id, room_key) for room_key in room_keys])
+
+
+def get_room_membership_verified_at(user, group):
+    """ Returns the timestamp of the last verification of the user's room memberships
+        for the given group, or None if they are due for verification """
+    cache_key = ROCKETCHAT_ROOM_MEMBERSHIP_VERIFIED_CACHE_KEY % (CosinnusPortal.get_current().id, group.id, user.id)
+    return cache.get(cache_key)
+
+
+def mark_room_membership_verified(user, group):
+    """ Records that the user's room memberships for the given group have just been verified.
+        The marker expires after `COSINNUS_CHAT_MEMBERSHIP_VERIFICATION_INTERVAL` seconds. """
+    interval = settings.COSINNUS_CHAT_MEMBERSHIP_VERIFICATION_INTERVAL
+    if not interval:
+        return
+    cache_key = ROCKETCHAT_ROOM_MEMBERSHIP_VERIFIED_CACHE_KEY % (CosinnusPortal.get_current().id, group.id, user.id)
+    cache.set(cache_key, time.time(), interval)
+
+
+def delete_room_membership_verified(user, group):
+    """ Makes the user's room memberships for the given group due for verification again """
+    cache_key = ROCKETCHAT_ROOM_MEMBERSHIP_VERIFIED_CACHE_KEY % (CosinnusPortal.get_current().id, group.id, user.id)
+    cache.delete(cache_key)
+
+
+def get_user_sanity_verified_at(user):
+    """ Returns the timestamp of the last successful `ensure_user_account_sanity` check for the user,
+        or None if the user is due for a check """
+    cache_key = ROCKETCHAT_USER_SANITY_VERIFIED_CACHE_KEY % (CosinnusPortal.get_current().id, user.id)
+    return cache.get(cache_key)
+
+
+def mark_user_sanity_verified(user):
+    """ Records a successful account sanity check for the user. The marker expires after
+        `COSINNUS_CHAT_USER_SANITY_CHECK_INTERVAL` seconds, randomly shortened by up to
+        `COSINNUS_CHAT_USER_SANITY_CHECK_JITTER` of the interval so that users verified
+        during the same login peak don't all become due at the same time again. """
+    interval = settings.COSINNUS_CHAT_USER_SANITY_CHECK_INTERVAL
+    if not interval:
+        return
+    jitter = settings.COSINNUS_CHAT_USER_SANITY_CHECK_JITTER
+    timeout = max(1, int(interval * (1.0 - random.uniform(0, jitter))))
+    cache_key = ROCKETCHAT_USER_SANITY_VERIFIED_CACHE_KEY % (CosinnusPortal.get_current().id, user.id)
+    cache.set(cache_key, time.time(), timeout)
+
+
+def delete_user_sanity_verified(user):
+    """ Makes the user due for an account sanity check on their next login """
+    cache_key = ROCKETCHAT_USER_SANITY_VERIFIED_CACHE_KEY % (CosinnusPortal.get_current().id, user.id)
+    cache.delete(cache_key)
+
+
+def save_user_rocket_chat_id(profile, rocket_user_id):
+    """ Saves a user's rocketchat user id to their profile settings and the user link table """
+    profile.settings[PROFILE_SETTING_ROCKET_CHAT_ID] = rocket_user_id
+    # Update profile settings without triggering signals to prevent cycles
+    type(profile).objects.filter(pk=profile.pk).update(settings=profile.settings)
+    RocketChatUserLink.objects.set_link(profile.user, rocket_user_id=rocket_user_id or None,
+                                        rocket_username=profile.rocket_username or '')
+
+
+def save_group_room_id(group, room_key, room_id):
+    """ Saves the rocketchat room id for a room key of a group to the group settings and the room link table """
+    group.settings[f'{PROFILE_SETTING_ROCKET_CHAT_ID}_{room_key}'] = room_id
+    # Update group settings without triggering signals to prevent cycles
+    type(group).objects.filter(pk=group.pk).update(settings=group.settings)
+    # the rooms of a new group are created before it has a pk, they are linked by `save_group_room_links` once it is saved
+    if group.pk:
+        RocketChatGroupRoomLink.objects.set_link(group, room_key, room_id)
+
+
+def save_group_room_links(group):
+    """ Writes the room link table entries for all room ids in the group settings """
+    for room_key in settings.COSINNUS_ROCKET_GROUP_ROOM_KEYS:
+        room_id = group.settings.get(f'{PROFILE_SETTING_ROCKET_CHAT_ID}_{room_key}', None)
+        if room_id:
+            RocketChatGroupRoomLink.objects.set_link(group, room_key, room_id)
+
+
 class RocketChat(RocketChatAPI):
+    """ Rocketchat API client that is safe to share between threads: each thread sends its
+        requests through its own pooled HTTP session, and the auth headers are never modified
+        in place, but replaced as a whole on login, which is serialized by a lock. """
 
     def __init__(self, *args, **kwargs):
         # this fixes the re-used dict from the original rocket API object
         self.headers = {}
+        self._thread_state = local()
+        self._login_lock = Lock()
         super(RocketChat, self).__init__(*args, **kwargs)
-
+    
+    def __getstate__(self):
+        # sessions and locks are bound to the process, so they are not pickled into the connection cache
+        state = self.__dict__.copy()
+        for key in ('_thread_state', '_login_lock', 'req'):
+            state.pop(key, None)
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._thread_state = local()
+        self._login_lock = Lock()
+    
+    @property
+    def req(self):
+        """ The HTTP session of the current thread, which the base class sends all API requests through """
+        session = getattr(self._thread_state, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.hooks['response'].append(_run_response_hooks)
+            self._thread_state.session = session
+        return session
+    
+    @req.setter
+    def req(self, value):
+        # the base class sets a single session for all threads here, which is replaced by the per-thread sessions
+        pass
+    
+    def login(self, user, password):
+        """ Overwrite base method to log in through the thread's session with the configured timeout,
+            and to set both auth headers at once, so that no other thread sends mismatching ones """
+        request_data = {'password': password}
+        if re.match(r'^[_a-z0-9-]+(\.[_a-z0-9-]+)*@[a-z0-9-]+(\.[a-z0-9-]+)*(\.[a-z]{2,4})$', user):
+            request_data['user'] = user
+        else:
+            request_data['username'] = user
+        with self._login_lock:
+            login_request = self.req.post(self.server_url + self.API_path + 'login', data=request_data,
+                                          verify=self.ssl_verify, proxies=self.proxies, timeout=self.timeout)
+            if login_request.status_code == 401:
+                raise RocketAuthenticationException()
+            if login_request.status_code != 200:
+                raise RocketConnectionException()
+            if login_request.json().get('status') != 'success':
+                raise RocketAuthenticationException()
+            global _login_count
+            with _login_count_lock:
+                _login_count += 1
+            data = login_request.json().get('data')
+            self.headers = {
+                'X-Auth-Token': data.get('authToken'),
+                'X-User-Id': data.get('userId'),
+            }
+            return login_request
+    
     def rooms_upload(self, rid, file, **kwargs):
         """
         Overwrite base method to allow filename and mimetye kwargs
@@ -95,6 +322,12 @@ class RocketChat(RocketChatAPI):
             'file': (filename, open(file, 'rb'), mimetype),
         }
         return self.__call_api_post('rooms.upload/' + rid, kwargs=kwargs, use_json=False, files=files)
+    
+    def groups_invite_many(self, room_id, user_ids, **kwargs):
+        """
+        Invites multiple users to a private group with a single request
+        """
+        return self.__call_api_post('groups.invite', roomId=room_id, userIds=user_ids, kwargs=kwargs)
 
 
 class RocketChatConnection:
@@ -233,6 +466,7 @@ class RocketChatConnection:
 
                 profile.settings[PROFILE_SETTING_ROCKET_CHAT_USERNAME] = rocket_username
                 profile.save(update_fields=['settings'])
+                RocketChatUserLink.objects.set_link(user, rocket_username=rocket_username)
 
             # Username exists?
             if rocket_user:
@@ -301,9 +535,7 @@ class RocketChatConnection:
                 return
             user_data = response.get('user')
             rocket_chat_id = user_data.get('_id')
-            profile.settings[PROFILE_SETTING_ROCKET_CHAT_ID] = rocket_chat_id
-            # Update profile settings without triggering signals to prevent cycles
-            type(profile).objects.filter(pk=profile.pk).update(settings=profile.settings)
+            save_user_rocket_chat_id(profile, rocket_chat_id)
         return profile.settings.get(PROFILE_SETTING_ROCKET_CHAT_ID)
 
     def get_group_id(self, group, room_key=None):
@@ -324,9 +556,7 @@ class RocketChatConnection:
                 return
             group_data = response.get('group')
             rocket_chat_id = group_data.get('_id')
-            group.settings[key] = rocket_chat_id
-            # Update group settings without triggering signals to prevent cycles
-            type(group).objects.filter(pk=group.pk).update(settings=group.settings)
+            save_group_room_id(group, room_key, rocket_chat_id)
         return group.settings.get(key)
 
     def users_create_or_update(self, user, request=None):
@@ -366,9 +596,7 @@ class RocketChatConnection:
         # Save Rocket.Chat User ID to user instance
         user_id = response.get('user', {}).get('_id')
         profile = user.cosinnus_profile
-        profile.settings[PROFILE_SETTING_ROCKET_CHAT_ID] = user_id
-        # Update profile settings without triggering signals to prevent cycles
-        type(profile).objects.filter(pk=profile.pk).update(settings=profile.settings)
+        save_user_rocket_chat_id(profile, user_id)
         user.cosinnus_profile = profile
         
         # Update the user's email preferences based on the portal default
@@ -397,9 +625,7 @@ class RocketChatConnection:
                 return
             user_data = response.get('user')
             user_id = user_data.get('_id')
-            profile.settings[PROFILE_SETTING_ROCKET_CHAT_ID] = user_id
-            # Update profile settings without triggering signals to prevent cycles
-            type(profile).objects.filter(pk=profile.pk).update(settings=profile.settings)
+            save_user_rocket_chat_id(profile, user_id)
         user_id = profile.settings[PROFILE_SETTING_ROCKET_CHAT_ID]
         if not user_id:
             return
@@ -408,6 +634,8 @@ class RocketChatConnection:
         response = self.rocket.users_update(user_id=user_id, username=profile.rocket_username).json()
         if not response.get('success'):
             logger.error('RocketChat: users_update_username: ' + response.get('errorType', '<No Error Type>'), extra={'response': response})
+        else:
+            RocketChatUserLink.objects.set_link(user, rocket_username=profile.rocket_username)
     
     def check_user_account_status(self, user):
         """ Read-only check whether or not the user exists in rocket chat.
@@ -443,23 +671,27 @@ class RocketChatConnection:
         # check for False, as None would mean unknown status
         status = self.check_user_account_status(user)
         if status is False:
-            user = self.users_create(user)
+            created_user = self.users_create(user)
             # re-check again to make sure the user was actually created
-            if user and self.check_user_account_status(user):
+            if created_user and self.check_user_account_status(created_user):
                 logger.info('ensure_user_account_sanity successfully created new rocketchat user account', extra={'user_id': getattr(user, 'id', None)})
                 # newly created user, do a invite to their group memberships' rooms
-                self.force_redo_user_room_memberships(user)
+                self.force_redo_user_room_memberships(created_user)
+                mark_user_sanity_verified(user)
                 return True
             else:
                 logger.info('ensure_user_account_sanity attempted to create a new rocketchat user account, but failed!', extra={'user_id': getattr(user, 'id', None)})
+                delete_user_sanity_verified(user)
                 return False
         elif status is None:
             logger.error('RocketChat: ensure_user_account_sanity was called, but could not do anything as `check_user_account_status` received an unknown status code.')
+            delete_user_sanity_verified(user)
             return False
         
         # status is True, account exists
         if force_group_membership_sync:
             self.force_redo_user_room_memberships(user)
+        mark_user_sanity_verified(user)
         return True
     
     def force_redo_user_room_membership_for_group(self, user, group):
@@ -470,6 +702,34 @@ class RocketChatConnection:
             # force the re-invite
             self.invite_or_kick_for_membership(membership)
     
+    def verify_user_room_membership_for_group(self, user, group, threaded=True):
+        """ Re-does the user's room memberships for a group like `force_redo_user_room_membership_for_group`,
+            but only if they have not been verified within the last 
+            `COSINNUS_CHAT_MEMBERSHIP_VERIFICATION_INTERVAL` seconds.
+            @param threaded: if True, a due verification is run in a thread, so that callers
+                from within the request cycle only pay for a cache lookup """
+        if get_room_membership_verified_at(user, group):
+            return
+        # mark before running so that concurrent page views don't start the same verification
+        mark_room_membership_verified(user, group)
+        rocket = self
+        
+        def _verify():
+            try:
+                rocket.force_redo_user_room_membership_for_group(user, group)
+            except Exception as e:
+                # make sure the next visit retries the verification
+                delete_room_membership_verified(user, group)
+                logger.exception(e)
+        
+        if threaded:
+            class CosinnusRocketMembershipVerifyThread(Thread):
+                def run(self):
+                    _verify()
+            CosinnusRocketMembershipVerifyThread().start()
+        else:
+            _verify()
+    
     def force_redo_user_room_memberships(self, user):
         """ A helper function that will re-do all room memberships by
             saving each user's membership (and having the invite-room hooks trigger) """
@@ -581,18 +841,24 @@ class RocketChatConnection:
     
     def get_group_room_name(self, group, room_key=None):
         """ Returns the rocketchat room name for a CosinnusGroup, for use in any URLs.
-            Creates a room for the group if it doesn't exist yet """
+            Creates a room for the group if it doesn't exist yet.
+            The resolved name is cached and only invalidated by `groups_create`, 
+            `groups_rename` and `groups_delete`. """
         room_key = room_key or settings.COSINNUS_ROCKET_GROUP_ROOM_KEYS[0]
         room_id = group.settings.get(f'{PROFILE_SETTING_ROCKET_CHAT_ID}_{room_key}', None)
         # create group if it didn't exist
         if not room_id:
             self.groups_create(group)
             room_id = group.settings.get(f'{PROFILE_SETTING_ROCKET_CHAT_ID}_{room_key}', None)
+        group_name = get_cached_group_room_name(group, room_key, room_id)
+        if group_name:
+            return group_name
         response = self.rocket.groups_info(room_id=room_id).json()
         if not response.get('success'):
             logger.error('RocketChat: groups_request: groups_info ' + response.get('errorType', '<No Error Type>'), extra={'response': response})
             return None
         group_name = response.get('group', {}).get('name', None)
+        set_cached_group_room_name(group, room_key, room_id, group_name)
         return group_name
     
     def _find_or_create_private_channel_for_user_and_group(self, user, group, members, create=False):
@@ -611,6 +877,7 @@ class RocketChatConnection:
             elif not response.get('success') and response.get('errorType', None) == 'error-room-not-found':
                 # delete room from users profile
                 profile.delete_users_rocket_contact_room_name_for_group(group)
+                RocketChatContactRoomLink.objects.remove_link(user, group)
             elif not response.get('success'):
                 return None, None
                 
@@ -624,11 +891,8 @@ class RocketChatConnection:
                 if i > 0:
                     new_group_name += f'-{i}'
                 # check that the room isn't used by another user
-                settings_key_for_group = PROFILE_SETTING_ROCKET_CHAT_CONTACT_GROUP_ROOM % group.id
-                filter_query = {f'settings__{settings_key_for_group}': new_group_name}
-                queryset = get_user_profile_model().objects.filter(**filter_query)
-                if queryset.count() > 0:
-                    return None
+                if RocketChatContactRoomLink.objects.is_room_name_taken(new_group_name):
+                    continue
                 # try to create the room
                 response = self.rocket.groups_create(new_group_name, members=members).json()
                 if not response.get('success') and response.get('errorType', None) == 'error-duplicate-channel-name':
@@ -643,6 +907,7 @@ class RocketChatConnection:
                     # we set the room in the user profile that was just created.
                     # we never set this from anywhere else, unless a room was just created!
                     profile.set_users_rocket_contact_room_name_for_group(group, room_name)
+                    RocketChatContactRoomLink.objects.set_link(user, group, room_name, room_id=room_id)
                     return room_name, room_id
                 return None, None
             logger.error('RocketChat: _find_or_create_private_channel_for_user_and_group: create new unique room: max tries exceeded!', extra={'group_id': group.id, 'user_id': user.id})
@@ -662,7 +927,8 @@ class RocketChatConnection:
         :param user:
         :param force_sync_membership: if True, and the user is a member of the CosinnusGroup,
             the user will be added to the rocketchat group again (useful to make sure
-            that users are *really* members of the group)
+            that users are *really* members of the group). This happens asynchronously and
+            at most once per `COSINNUS_CHAT_MEMBERSHIP_VERIFICATION_INTERVAL`
         :return: group name or none if the group didn't exist and create has been not given
         """
         if not hasattr(user, 'cosinnus_profile'):
@@ -673,7 +939,7 @@ class RocketChatConnection:
         if group.is_member(user):
             members_group_name = self.get_group_room_name(group)
             if force_sync_membership:
-                self.force_redo_user_room_membership_for_group(user, group)
+                self.verify_user_room_membership_for_group(user, group)
             return members_group_name
         
         #  case: contact request. find a room name, or create one, or return nothing
@@ -768,12 +1034,23 @@ class RocketChatConnection:
         :param group:
         :return:
         """
+        # any room (re-)created here may have a different name than a previously cached one
+        delete_cached_group_room_names(group)
+        
         memberships = group.memberships.select_related('user', 'user__cosinnus_profile')
         admin_qs = memberships.filter_membership_status(MEMBERSHIP_ADMIN)
         admin_ids = [self.get_user_id(m.user) for m in admin_qs]
         members_qs = memberships.filter_membership_status(MEMBER_STATUS)
-        member_usernames = [str(m.user.cosinnus_profile.rocket_username)
-                            for m in members_qs if hasattr(m.user, 'cosinnus_profile') and m.user.cosinnus_profile]
+        # admins go first so they are always part of the initial members and can be made moderators
+        members = sorted([m for m in members_qs if hasattr(m.user, 'cosinnus_profile') and m.user.cosinnus_profile],
+                         key=lambda m: m.status != MEMBERSHIP_ADMIN)
+        # rooms are created with a bounded set of initial members, the rest is invited in chunks afterwards
+        max_initial_members = settings.COSINNUS_CHAT_ROOM_CREATE_MAX_INITIAL_MEMBERS
+        if max_initial_members:
+            members, remaining_members = members[:max_initial_members], members[max_initial_members:]
+        else:
+            remaining_members = []
+        member_usernames = [str(m.user.cosinnus_profile.rocket_username) for m in members]
         member_usernames.append(settings.COSINNUS_CHAT_USER)
 
         # Createconfigured channels
@@ -798,9 +1075,7 @@ class RocketChatConnection:
                         logger.error('RocketChat: groups_create: groups_info ' + response.get('errorType', '<No Error Type>'), extra={'response': response})
                     room_id = response.get('group', {}).get('_id')
                     if room_id:
-                        # Update group settings without triggering signals to prevent cycles
-                        group.settings[f'{PROFILE_SETTING_ROCKET_CHAT_ID}_{group_room_key}'] = room_id
-                        type(group).objects.filter(pk=group.pk).update(settings=group.settings)
+                        save_group_room_id(group, group_room_key, room_id)
                     continue
                 elif response.get('errorType') in ('error-room-archived', 'error-archived-duplicate-name'):
                     # group has an archived room, which is probably a different one
@@ -833,14 +1108,15 @@ class RocketChatConnection:
             if response.get('success'):
                 room_id = response.get('group', {}).get('_id')
                 if room_id:
+                    # Invite the members that didn't fit into the initial member set
+                    if remaining_members:
+                        self.rooms_invite_bulk(room_id, [self.get_user_id(m.user) for m in remaining_members])
                     # Add moderators
                     for user_id in admin_ids:
                         response = self.rocket.groups_add_moderator(room_id=room_id, user_id=user_id).json()
                         if not response.get('success'):
                             logger.error('RocketChat: groups_create: groups_add_moderator ' + response.get('errorType', '<No Error Type>'), extra={'response': response})
-                    # Update group settings without triggering signals to prevent cycles
-                    group.settings[f'{PROFILE_SETTING_ROCKET_CHAT_ID}_{group_room_key}'] = room_id
-                    type(group).objects.filter(pk=group.pk).update(settings=group.settings)
+                    save_group_room_id(group, group_room_key, room_id)
     
                     # Set description
                     response = self.rocket.groups_set_description(room_id=room_id, description=group.name).json()
@@ -866,21 +1142,107 @@ class RocketChatConnection:
                 response = self.rocket.groups_rename(room_id=room_id, name=room_name).json()
                 if not response.get('success'):
                     logger.error('RocketChat: groups_rename ' + response.get('errorType', '<No Error Type>'), extra={'response': response})
+                    delete_cached_group_room_names(group, room_keys=[room_key])
                     success = False
+                else:
+                    # the rename response contains the new room, so we can re-fill the cache directly
+                    set_cached_group_room_name(group, room_key, room_id, response.get('group', {}).get('name', None))
         return success
     
-    def group_set_topic_to_url(self, group, specific_room_keys=None):
+    def get_all_rooms(self, fields):
+        """ Returns a list of the room dicts of all private rooms in rocketchat, containing the 
+            room id and the given fields, fetched in pages of `COSINNUS_CHAT_BULK_PAGE_SIZE`, 
+            or None if the rooms could not be listed
+            @param fields: a list of room field names, e.g. ['name', 'topic'] """
+        all_rooms = []
+        size = settings.COSINNUS_CHAT_BULK_PAGE_SIZE
+        offset = 0
+        fields_param = json.dumps(dict([(field, 1) for field in fields]))
+        while True:
+            response = self.rocket.groups_list_all(count=size, offset=offset, fields=fields_param).json()
+            if not response.get('success'):
+                logger.error('RocketChat: get_all_rooms ' + response.get('errorType', '<No Error Type>'), extra={'response': response})
+                return None
+            rooms = response.get('groups', [])
+            all_rooms.extend(rooms)
+            offset += len(rooms)
+            if not rooms or offset >= response.get('total', 0):
+                break
+        return all_rooms
+    
+    def get_room_topics(self):
+        """ Returns a dict of room id -> topic for all private rooms in rocketchat,
+            or None if the rooms could not be listed """
+        rooms = self.get_all_rooms(['topic'])
+        if rooms is None:
+            return None
+        return dict([(room['_id'], room.get('topic')) for room in rooms])
+    
+    def warm_up(self, stdout=None):
+        """ Prepares this process and the cache for serving rocketchat requests after a deploy:
+            validates that the admin connection is authenticated and has admin rights, and preloads
+            the room ids and room names for all active groups, so that the first requests don't
+            have to look them up.
+            @return: a tuple of (rooms cached, room ids filled in), or None if the connection is invalid """
+        response = self.rocket.me().json()
+        if not response.get('success'):
+            logger.error('RocketChat: warm_up: the admin connection could not be validated', extra={'response': response})
+            return None
+        if 'admin' not in response.get('roles', []):
+            logger.error('RocketChat: warm_up: the configured chat user is not a rocketchat admin', extra={'response': response})
+            return None
+        
+        rooms = self.get_all_rooms(['name'])
+        if rooms is None:
+            return None
+        room_names_by_id = dict([(room['_id'], room.get('name')) for room in rooms])
+        room_ids_by_name = dict([(room.get('name'), room['_id']) for room in rooms])
+        
+        cached = 0
+        filled_in = 0
+        for group in get_cosinnus_group_model().objects.all_in_portal():
+            for room_key in settings.COSINNUS_ROCKET_GROUP_ROOM_KEYS:
+                room_id = group.settings.get(f'{PROFILE_SETTING_ROCKET_CHAT_ID}_{room_key}', None)
+                if not room_id:
+                    # find a room created before the id was saved by its name, like `get_group_id`
+                    room_name_code = settings.COSINNUS_ROCKET_GROUP_ROOM_NAMES_MAP[room_key]
+                    room_id = room_ids_by_name.get(room_name_code % group.slug)
+                    if not room_id:
+                        continue
+                    save_group_room_id(group, room_key, room_id)
+                    filled_in += 1
+                room_name = room_names_by_id.get(room_id)
+                if room_name:
+                    set_cached_group_room_name(group, room_key, room_id, room_name)
+                    cached += 1
+        if stdout:
+            stdout.write(f'Cached {cached} room names, filled in {filled_in} missing room ids.')
+        return cached, filled_in
+    
+    def group_set_topic_to_url(self, group, specific_room_keys=None, current_topics=None):
         """ Sets the CosinnusGroup url as topic of the group's room 
             @param specific_room_keysspecific_room_keys: if set to a list, the topic will only be 
-                set for those specific room names, instead of for all rooms of that group """
+                set for those specific room names, instead of for all rooms of that group
+            @param current_topics: optional dict of room id -> current topic, as returned by `get_room_topics`.
+                If given, rooms whose topic already is the group url are skipped.
+            @return: a tuple of (updated, unchanged, failed) room counts """
+        updated, unchanged, failed = 0, 0, 0
         room_keys = specific_room_keys or settings.COSINNUS_ROCKET_GROUP_ROOM_KEYS
         for group_room_key in room_keys:
             # check if group room exists
             room_id = group.settings.get(f'{PROFILE_SETTING_ROCKET_CHAT_ID}_{group_room_key}', None)
             if room_id:
-                response = self.rocket.groups_set_topic(room_id=room_id, topic=group.get_absolute_url()).json()
+                topic = group.get_absolute_url()
+                if current_topics is not None and current_topics.get(room_id) == topic:
+                    unchanged += 1
+                    continue
+                response = self.rocket.groups_set_topic(room_id=room_id, topic=topic).json()
                 if not response.get('success'):
                     logger.error('RocketChat: groups_set_topic: ' + response.get('errorType', '<No Error Type>'), extra={'response': response})
+                    failed += 1
+                else:
+                    updated += 1
+        return updated, unchanged, failed
         
     def groups_archive(self, group, specific_room_keys=None, specific_room_ids=None):
         """
@@ -926,6 +1288,9 @@ class RocketChatConnection:
         """
         # Delete configured channels
         success = True
+        delete_cached_group_room_names(group)
+        if group.pk:
+            RocketChatGroupRoomLink.objects.remove_links(group)
         for room in settings.COSINNUS_ROCKET_GROUP_ROOM_KEYS:
             room_id = self.get_group_id(group, room_key=room)
             if room_id:
@@ -1020,6 +1385,174 @@ class RocketChatConnection:
                 if not response.get('success') and not response.get('errorType', '') == 'error-user-not-moderator':
                     logger.error('RocketChat: groups_remove_moderator ' + response.get('errorType', '<No Error Type>'), extra={'response': response})
 
+    def get_room_member_ids(self, room_id):
+        """ Returns the set of rocketchat user ids of all members of a private room,
+            or None if the members could not be retrieved """
+        member_ids = set()
+        size = settings.COSINNUS_CHAT_BULK_PAGE_SIZE
+        offset = 0
+        while True:
+            response = self.rocket.groups_members(room_id=room_id, count=size, offset=offset).json()
+            if not response.get('success'):
+                logger.error('RocketChat: get_room_member_ids ' + response.get('errorType', '<No Error Type>'), extra={'response': response})
+                return None
+            members = response.get('members', [])
+            member_ids.update([member['_id'] for member in members])
+            offset += len(members)
+            if not members or offset >= response.get('total', 0):
+                break
+        return member_ids
+    
+    def get_room_moderator_ids(self, room_id):
+        """ Returns the set of rocketchat user ids of all moderators of a private room,
+            or None if the roles could not be retrieved """
+        response = self.rocket.groups_roles(room_id=room_id).json()
+        if not response.get('success'):
+            logger.error('RocketChat: get_room_moderator_ids ' + response.get('errorType', '<No Error Type>'), extra={'response': response})
+            return None
+        return set([role['u']['_id'] for role in response.get('roles', []) if 'moderator' in role.get('roles', [])])
+    
+    def rooms_invite_bulk(self, room_id, user_ids, chunk_size=None, progress_label=None, existing_ids=None):
+        """ Invites the given rocketchat users to a private room, using one request per chunk of
+            `COSINNUS_CHAT_BULK_INVITE_CHUNK_SIZE` users. Users that already are members of the room
+            are skipped, so this can safely be re-run after an interrupted or partially failed run.
+            Failed chunks are retried, and if they still fail, their users are invited one by one.
+            @param progress_label: if given, progress is written to this connection's stdout
+            @param existing_ids: the room's current member ids, if already known
+            @return: a tuple of (invited, skipped, failed) user counts """
+        user_ids = list(dict.fromkeys([user_id for user_id in user_ids if user_id]))
+        if existing_ids is None:
+            existing_ids = self.get_room_member_ids(room_id)
+        if existing_ids is None:
+            # inviting existing members is harmless, just slower
+            existing_ids = set()
+        pending_ids = [user_id for user_id in user_ids if user_id not in existing_ids]
+        skipped = len(user_ids) - len(pending_ids)
+        invited, failed = 0, 0
+        
+        chunk_size = chunk_size or settings.COSINNUS_CHAT_BULK_INVITE_CHUNK_SIZE
+        for start in range(0, len(pending_ids), chunk_size):
+            chunk = pending_ids[start:start + chunk_size]
+            if self._rooms_invite_chunk(room_id, chunk):
+                invited += len(chunk)
+            else:
+                # fall back to single invites, so a single broken account doesn't fail the entire chunk
+                for user_id in chunk:
+                    response = self.rocket.groups_invite(room_id=room_id, user_id=user_id).json()
+                    if response.get('success'):
+                        invited += 1
+                    else:
+                        failed += 1
+                        logger.error('RocketChat: rooms_invite_bulk: groups_invite ' + response.get('errorType', '<No Error Type>'), extra={'response': response})
+            if progress_label and self.stdout:
+                self.stdout.write('%s: %i/%i' % (progress_label, start + len(chunk), len(pending_ids)), ending='\r')
+                self.stdout.flush()
+        return invited, skipped, failed
+    
+    def _rooms_invite_chunk(self, room_id, user_ids):
+        """ Invites a chunk of users to a private room with a single request, retrying
+            `COSINNUS_CHAT_BULK_INVITE_RETRIES` times with an increasing delay.
+            @return: True if successful, False otherwise """
+        response = {}
+        for attempt in range(settings.COSINNUS_CHAT_BULK_INVITE_RETRIES + 1):
+            if attempt:
+                time.sleep(settings.COSINNUS_CHAT_BULK_INVITE_RETRY_DELAY * 2 ** (attempt - 1))
+            try:
+                response = self.rocket.groups_invite_many(room_id=room_id, user_ids=user_ids).json()
+            except RequestException as e:
+                # large chunks are the most likely to run into timeouts
+                response = {'errorType': str(e)}
+            if response.get('success'):
+                return True
+        logger.warning('RocketChat: rooms_invite_bulk: chunk invite failed after retries ' + str(response.get('errorType', '<No Error Type>')), 
+                       extra={'response': response, 'room_id': room_id, 'chunk_size': len(user_ids)})
+        return False
+    
+    def groups_invite_members_bulk(self, group, chunk_size=None):
+        """ Invites all active members of a group into the group's rooms using chunked bulk invites,
+            and makes the group's admins moderators. This has the same result as calling
+            `invite_or_kick_for_membership` for each active membership, but takes only a fraction
+            of the requests for large groups and conferences.
+            @return: a tuple of (invited, skipped, failed) user counts, summed over all rooms """
+        memberships = group.memberships.filter_membership_status(MEMBER_STATUS).select_related('user', 'user__cosinnus_profile')
+        member_ids, admin_ids = [], []
+        for membership in memberships:
+            user_id = self.get_user_id(membership.user)
+            if not user_id:
+                continue
+            member_ids.append(user_id)
+            if membership.status == MEMBERSHIP_ADMIN:
+                admin_ids.append(user_id)
+        
+        totals = [0, 0, 0]
+        for room_key in settings.COSINNUS_ROCKET_GROUP_ROOM_KEYS:
+            room_id = self.get_group_id(group, room_key=room_key)
+            if not room_id:
+                continue
+            counts = self.rooms_invite_bulk(room_id, member_ids, chunk_size=chunk_size, progress_label=f'{group.slug} ({room_key})')
+            totals = [total + count for total, count in zip(totals, counts)]
+            for user_id in admin_ids:
+                response = self.rocket.groups_add_moderator(room_id=room_id, user_id=user_id).json()
+                if not response.get('success') and not response.get('errorType', '') == 'error-user-already-moderator':
+                    logger.error('RocketChat: groups_invite_members_bulk: groups_add_moderator ' + response.get('errorType', '<No Error Type>'), extra={'response': response})
+        return tuple(totals)
+    
+    def groups_reconcile_memberships(self, group, user_ids):
+        """ Brings the room memberships and moderator roles of the given users in all rooms of a group
+            in line with their current group memberships. Needs one member listing and one role listing
+            per room and invites users in bulk, so this is used to sync many membership changes
+            at once instead of syncing each one through the membership hooks.
+            @param user_ids: ids of the users whose memberships in the group may have changed
+            @return: a tuple of (invited, kicked, failed) user counts, summed over all rooms """
+        memberships = dict([(m.user_id, m) for m in group.memberships.filter(user_id__in=user_ids)])
+        users = get_user_model().objects.filter(id__in=user_ids).select_related('cosinnus_profile')
+        member_ids, admin_ids, removed_ids = set(), set(), set()
+        for user in users:
+            rocket_user_id = self.get_user_id(user)
+            if not rocket_user_id:
+                continue
+            membership = memberships.get(user.id)
+            if membership and membership.status in MEMBER_STATUS:
+                member_ids.add(rocket_user_id)
+                if membership.status == MEMBERSHIP_ADMIN:
+                    admin_ids.add(rocket_user_id)
+            else:
+                removed_ids.add(rocket_user_id)
+        
+        invited, kicked, failed = 0, 0, 0
+        for room_key in settings.COSINNUS_ROCKET_GROUP_ROOM_KEYS:
+            room_id = self.get_group_id(group, room_key=room_key)
+            if not room_id:
+                continue
+            existing_ids = self.get_room_member_ids(room_id)
+            room_invited, __, room_failed = self.rooms_invite_bulk(room_id, member_ids, existing_ids=existing_ids)
+            invited += room_invited
+            failed += room_failed
+            
+            # if the room members are unknown, try to kick all removed users
+            for user_id in (removed_ids if existing_ids is None else removed_ids & existing_ids):
+                response = self.rocket.groups_kick(room_id=room_id, user_id=user_id).json()
+                if response.get('success'):
+                    kicked += 1
+                elif existing_ids is not None:
+                    failed += 1
+                    logger.error('RocketChat: groups_reconcile_memberships: groups_kick ' + response.get('errorType', '<No Error Type>'), extra={'response': response})
+            
+            moderator_ids = self.get_room_moderator_ids(room_id)
+            promote_ids = admin_ids if moderator_ids is None else admin_ids - moderator_ids
+            demote_ids = member_ids - admin_ids
+            if moderator_ids is not None:
+                demote_ids = demote_ids & moderator_ids
+            for user_id in promote_ids:
+                response = self.rocket.groups_add_moderator(room_id=room_id, user_id=user_id).json()
+                if not response.get('success') and not response.get('errorType', '') == 'error-user-already-moderator':
+                    logger.error('RocketChat: groups_reconcile_memberships: groups_add_moderator ' + response.get('errorType', '<No Error Type>'), extra={'response': response})
+            for user_id in demote_ids:
+                response = self.rocket.groups_remove_moderator(room_id=room_id, user_id=user_id).json()
+                if not response.get('success') and not response.get('errorType', '') == 'error-user-not-moderator':
+                    logger.error('RocketChat: groups_reconcile_memberships: groups_remove_moderator ' + response.get('errorType', '<No Error Type>'), extra={'response': response})
+        return invited, kicked, failed
+    
     def add_member_to_room(self, user, room_id):
         """ Add a member to a given room """
         user_id = self.get_user_id(user)
@@ -1253,24 +1786,55 @@ class RocketChatConnection:
         response = user_connection.users_get_preferences().json()
         if not response.get('success') or not 'preferences' in response:
             # if the preferences aren't set up yet, don't count this ans an error
-            if response.get('error', None) != "FAILED TO RETRIEVE USER PREFERENCES BECAUSE THEY HAVEN'T BEEN SET UP BY THE USER YET":
-                logger.error('RocketChat: get_user_preferences did not receive a success response or data: ' + response.get('errorType', '<No Error Type>'), extra={'response': response})
+            if response.get('error', None) == "FAILED TO RETRIEVE USER PREFERENCES BECAUSE THEY HAVEN'T BEEN SET UP BY THE USER YET":
+                return {}
+            logger.error('RocketChat: get_user_preferences did not receive a success response or data: ' + response.get('errorType', '<No Error Type>'), extra={'response': response})
             return None
         return response.get('preferences', None)
         
     def get_user_email_preference(self, user):
-        """ Gets the user preference for email notifications
+        """ Gets the user preference for email notifications, and updates the local mirror of it.
             Preference for emails is: 'emailNotificationMode': 'mentions'|'default'|'nothing'
             @return: one of the values of `ROCKETCHAT_PREFERENCES_EMAIL_NOTIFICATION` or None if 
                 no setting is set, it is of unknown value or an error occured """
         prefs = self.get_user_preferences(user)
-        if not prefs:
+        if prefs is None:
             return None
+        return self._mirror_user_email_preference(user, prefs)
+    
+    def _mirror_user_email_preference(self, user, prefs):
+        """ Saves the email preference from a user's preferences dict to the local mirror.
+            @return: the preference, or None if it is not set or of unknown value """
         email_pref = prefs.get('emailNotificationMode', None)
         if email_pref and email_pref not in ROCKETCHAT_PREFERENCES_EMAIL_NOTIFICATION:
             logger.error('RocketChat: get_user_email_preference did not receive a known value: ' + str(email_pref))
             return None
-        return email_pref
+        RocketChatUserLink.objects.set_email_notification_mode(user, email_pref or '')
+        return email_pref or None
+    
+    def refresh_user_email_preferences(self, limit=None, synced_before=None):
+        """ Re-fetches the email notification preferences of users with a rocketchat account into 
+            the local mirror, starting with the users that were never or least recently fetched.
+            Needs one login and one request per user, so this is meant for background jobs.
+            @param limit: the maximum number of users to refresh
+            @param synced_before: if given, only users last fetched before this datetime are refreshed
+            @return: a tuple of (refreshed, failed) user counts """
+        links = RocketChatUserLink.objects.filter(rocket_user_id__isnull=False, user__is_active=True,
+                                                  user__in=filter_portal_users(get_user_model().objects.all()))
+        if synced_before:
+            links = links.filter(Q(email_notification_mode_synced__isnull=True) | Q(email_notification_mode_synced__lt=synced_before))
+        links = links.select_related('user', 'user__cosinnus_profile').order_by(F('email_notification_mode_synced').asc(nulls_first=True))
+        if limit:
+            links = links[:limit]
+        refreshed, failed = 0, 0
+        for link in links:
+            prefs = self.get_user_preferences(link.user)
+            if prefs is None:
+                failed += 1
+                continue
+            self._mirror_user_email_preference(link.user, prefs)
+            refreshed += 1
+        return refreshed, failed
     
     def set_user_email_preference(self, user, preference):
         """ Sets the user's email preferences to be one of the values of `ROCKETCHAT_PREFERENCES_EMAIL_NOTIFICATION`
@@ -1292,6 +1856,7 @@ class RocketChatConnection:
         if not response.get('success'):
             logger.error('RocketChat: set_user_email_preference did not receive a success response: ' + response.get('errorType', '<No Error Type>'), extra={'response': response})
             return False
+        RocketChatUserLink.objects.set_email_notification_mode(user, preference)
         return True
         
     def _get_user_connection(self, user):
@@ -1312,6 +1877,8 @@ class RocketChatConnection:
             response = self.rocket.users_update(user_id=user_id, password=user.password).json()
             if not response.get('success'):
                 logger.error('RocketChat: unread_messages did not receive a success response: ' + str(response.get('errorType', '<No Error Type>')), extra={'response': response})
+                # the account seems broken, have it checked on the user's next login
+                delete_user_sanity_verified(user)
                 return None
             user_connection = get_cached_rocket_connection(rocket_username=profile.rocket_username, password=user.password,
                                          server_url=settings.COSINNUS_CHAT_BASE_URL, reset=True,
@@ -0,0 +1,115 @@
+import logging
+import re
+
+from annoying.functions import get_object_or_None
+
+from cosinnus.conf import settings
+from cosinnus.models.group import CosinnusPortal
+from cosinnus.models.profile import PROFILE_SETTING_ROCKET_CHAT_ID
+from cosinnus.utils.group import get_cosinnus_group_model
+from cosinnus_message.models import RocketChatUserLink, RocketChatGroupRoomLink
+from cosinnus_message.rocket_chat import save_group_room_id,\
+    mark_room_membership_verified, delete_room_membership_verified,\
+    ROCKETCHAT_PREFERENCES_EMAIL_NOTIFICATION
+
+logger = logging.getLogger(__name__)
+
+
+def _get_room_data(payload):
+    """ Returns (room id, room name) from a webhook payload, which contains either a room object
+        or the flat fields of rocketchat's outgoing message integrations """
+    room = payload.get('room') or {}
+    return room.get('_id') or payload.get('channel_id'), room.get('name') or payload.get('channel_name')
+
+
+def _get_user_data(payload):
+    """ Returns (user id, username) from a webhook payload """
+    user = payload.get('user') or {}
+    return user.get('_id') or payload.get('user_id'), user.get('username') or payload.get('user_name')
+
+
+def _get_group_and_room_key_for_room_name(room_name):
+    """ Resolves a room name back to the group and room key it was created for
+        using `COSINNUS_ROCKET_GROUP_ROOM_NAMES_MAP`. Returns (None, None) if there is no such group. """
+    for room_key, room_name_code in settings.COSINNUS_ROCKET_GROUP_ROOM_NAMES_MAP.items():
+        match = re.match('^' + re.escape(room_name_code).replace('%s', '(?P<slug>.+)', 1) + '$', room_name)
+        if match:
+            group = get_object_or_None(get_cosinnus_group_model(), portal=CosinnusPortal.get_current(), slug=match.group('slug'))
+            if group:
+                return group, room_key
+    return None, None
+
+
+def handle_room_created(payload):
+    """ Links a newly created room to its group, if the group didn't know its room id yet """
+    room_id, room_name = _get_room_data(payload)
+    if not room_id or not room_name:
+        return False
+    if RocketChatGroupRoomLink.objects.filter(room_id=room_id).exists():
+        return True
+    group, room_key = _get_group_and_room_key_for_room_name(room_name)
+    if group and not group.settings.get(f'{PROFILE_SETTING_ROCKET_CHAT_ID}_{room_key}'):
+        save_group_room_id(group, room_key, room_id)
+    return True
+
+
+def handle_user_created(payload):
+    """ Mirrors the email notification preference of a user created in rocketchat.
+        The username is not mirrored, as it is always set from the portal's side. """
+    rocket_user_id, __ = _get_user_data(payload)
+    if not rocket_user_id:
+        return False
+    user = RocketChatUserLink.objects.get_user(rocket_user_id)
+    if not user:
+        return True
+    preferences = ((payload.get('user') or {}).get('settings') or {}).get('preferences') or {}
+    email_pref = preferences.get('emailNotificationMode', None)
+    if email_pref in ROCKETCHAT_PREFERENCES_EMAIL_NOTIFICATION:
+        RocketChatUserLink.objects.set_email_notification_mode(user, email_pref)
+    return True
+
+
+def _get_member_group_and_user(payload):
+    room_id, __ = _get_room_data(payload)
+    rocket_user_id, __ = _get_user_data(payload)
+    if not room_id or not rocket_user_id:
+        return None, None
+    group = RocketChatGroupRoomLink.objects.get_group(room_id)
+    user = RocketChatUserLink.objects.get_user(rocket_user_id)
+    return group, user
+
+
+def handle_member_joined(payload):
+    """ A group member joining a group room counts as a verified room membership """
+    group, user = _get_member_group_and_user(payload)
+    if group and user and group.is_member(user):
+        mark_room_membership_verified(user, group)
+    return True
+
+
+def handle_member_left(payload):
+    """ A user leaving a group room makes their room membership due for verification,
+        so group members are re-added on their next visit of the group chat """
+    group, user = _get_member_group_and_user(payload)
+    if group and user:
+        delete_room_membership_verified(user, group)
+    return True
+
+
+# rocketchat outgoing integration event name -> handler. only events that rocketchat's outgoing
+# integrations emit are handled, renamed and deleted rooms and changed users are not among them
+WEBHOOK_EVENT_HANDLERS = {
+    'roomCreated': handle_room_created,
+    'userCreated': handle_user_created,
+    'roomJoined': handle_member_joined,
+    'roomLeft': handle_member_left,
+}
+
+
+def handle_webhook_event(event, payload):
+    """ Mirrors a rocketchat event into the local link data and caches.
+        @return: True if the event was handled, False if it was unknown or malformed """
+    handler = WEBHOOK_EVENT_HANDLERS.get(event)
+    if not handler:
+        return False
+    return handler(payload)
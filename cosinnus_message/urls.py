@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import logging
+
+import django
 from django.conf import settings
 from django.conf.urls import url
 from cosinnus_message.views import *
@@ -8,11 +11,21 @@ from cosinnus_message.views import *
 app_name = 'message'
 
 if settings.COSINNUS_ROCKET_ENABLED:
+    # the async views need Django >= 3.1, and are only faster than the sync ones when served via ASGI
+    use_async_views = getattr(settings, 'COSINNUS_CHAT_ASYNC_VIEWS', False)
+    if use_async_views and django.VERSION < (3, 1):
+        logging.getLogger('cosinnus').warning('COSINNUS_CHAT_ASYNC_VIEWS is ignored, it requires Django >= 3.1.')
+        use_async_views = False
+    if use_async_views:
+        from cosinnus_message.async_views import AsyncRocketChatWriteView as RocketChatWriteView,\
+            AsyncRocketChatWriteGroupView as RocketChatWriteGroupView,\
+            AsyncRocketChatWriteGroupComposeView as RocketChatWriteGroupComposeView
     cosinnus_root_patterns = [
         url(r'^messages/$', RocketChatIndexView.as_view(), name='message-global'),
         url(r'^messages/write/(?P<username>[^/]+)/$', RocketChatWriteView.as_view(), name='message-write'),
         url(r'^messages/write/group/(?P<slug>[^/]+)/$', RocketChatWriteGroupView.as_view(), name='message-write-group'),
         url(r'^messages/write/group/(?P<slug>[^/]+)/compose/$', RocketChatWriteGroupComposeView.as_view(), name='message-write-group-compose'),
+        url(r'^messages/rocketchat/webhook/(?P<event>[A-Za-z]+)/$', RocketChatWebhookView.as_view(), name='message-rocketchat-webhook'),
     ]
     cosinnus_group_patterns = []
 else:
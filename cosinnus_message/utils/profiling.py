@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import re
+
+from postman.profiling import CommandProfiler, ProfilableCommand as BaseProfilableCommand
+
+# matches the UPDATE statements of the JSON `settings` fields of groups and profiles
+SETTINGS_UPDATE_RE = re.compile(r'^\s*UPDATE\s.*\sSET\s.*"settings"\s*=', re.IGNORECASE | re.DOTALL)
+
+
+class RocketChatCommandProfiler(CommandProfiler):
+    """ A `postman.profiling.CommandProfiler` that also counts the updates of the JSON settings fields
+        of groups and profiles separately and records the rocketchat API call counts and times by endpoint.
+        Rocketchat calls are recorded for all threads. """
+
+    def __init__(self, name):
+        super(RocketChatCommandProfiler, self).__init__(name)
+        self.rocketchat_calls = {}
+
+    def start(self):
+        try:
+            from cosinnus_message.rocket_chat import add_response_hook
+            add_response_hook(self._record_rocketchat_call)
+        except ImportError:
+            pass
+        super(RocketChatCommandProfiler, self).start()
+
+    def stop(self):
+        super(RocketChatCommandProfiler, self).stop()
+        try:
+            from cosinnus_message.rocket_chat import remove_response_hook
+            remove_response_hook(self._record_rocketchat_call)
+        except ImportError:
+            pass
+
+    def get_query_kind(self, sql):
+        if SETTINGS_UPDATE_RE.match(sql):
+            return 'settings_update'
+        return super(RocketChatCommandProfiler, self).get_query_kind(sql)
+
+    def _record_rocketchat_call(self, response):
+        path = response.request.path_url.split('?', 1)[0]
+        endpoint = path.split('/api/v1/', 1)[-1]
+        self.add(self.rocketchat_calls, endpoint, response.elapsed.total_seconds())
+
+    def get_report(self, options=None):
+        report = super(RocketChatCommandProfiler, self).get_report(options)
+        report['rocketchat_calls'] = self.summarize(self.rocketchat_calls)
+        return report
+
+
+class ProfilableCommand(BaseProfilableCommand):
+    """ The `postman.profiling.ProfilableCommand` for the message commands, which also records rocketchat calls """
+
+    profiler_class = RocketChatCommandProfiler
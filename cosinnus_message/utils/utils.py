@@ -309,12 +309,14 @@ def get_rocketchat_group_embed_url_for_user(group, user):
 def get_rocketchat_mail_notification_setting_from_user_preference(user):
     """ Retrieves the rocketchat user email preference and returns one value of
         `GlobalUserNotificationSetting.ROCKETCHAT_SETTING_CHOICES`.
+        The preference is read from the local mirror, which is kept up to date when it is saved
+        and refreshed periodically, so this makes no request to rocketchat.
         Since there are only two values, unless we specifically see that a user's settings
         is set to off, we assume that it is set to Mentions, because that's what rocketchat does as default """
     from cosinnus.models.profile import GlobalUserNotificationSetting
-    from cosinnus_message.rocket_chat import (RocketChatConnection, 
-        ROCKETCHAT_PREFERENCE_EMAIL_NOTIFICATION_OFF) 
-    pref = RocketChatConnection().get_user_email_preference(user)
+    from cosinnus_message.models import RocketChatUserLink
+    from cosinnus_message.rocket_chat import ROCKETCHAT_PREFERENCE_EMAIL_NOTIFICATION_OFF
+    pref = RocketChatUserLink.objects.get_email_notification_mode(user)
     setting = GlobalUserNotificationSetting.ROCKETCHAT_SETTING_MENTIONS
     if pref and pref == ROCKETCHAT_PREFERENCE_EMAIL_NOTIFICATION_OFF:
         setting = GlobalUserNotificationSetting.ROCKETCHAT_SETTING_OFF
@@ -2,9 +2,12 @@
 from __future__ import unicode_literals
 
 from builtins import object
+import hmac
+import json
 import six
 
 from django.urls import reverse
+from django.db import transaction
 from django.db.models import Q
 from django.http import HttpResponseRedirect
 
@@ -24,6 +27,9 @@ from cosinnus.utils.urls import safe_redirect
 from django.contrib.auth import get_user_model
 from .forms import ContactMessageForm
 from django.views.generic.edit import FormView
+from django.views.decorators.csrf import csrf_exempt
+from django.utils.decorators import method_decorator
+from django.http.response import JsonResponse
 
 try:
     from django.utils.timezone import now  # Django 1.4 aware datetimes
@@ -97,13 +103,15 @@ class UpdateMessageMixin(object):
         if pks or tpks:
             user = request.user
             filter = Q(pk__in=pks) | Q(thread__in=tpks)
-            if self.recipient_only_field_bit:
-                recipient_rows = Message.objects.as_recipient(user, filter).update(**{self.recipient_only_field_bit: self.field_value})
-            else:
-                recipient_rows = Message.objects.as_recipient(user, filter).update(**{'recipient_{0}'.format(self.field_bit): self.field_value})
-                sender_rows = Message.objects.as_sender(user, filter).update(**{'sender_{0}'.format(self.field_bit): self.field_value})
-            if not (recipient_rows or sender_rows):
-                raise Http404  # abnormal enough, like forged ids
+            with transaction.atomic():
+                if self.recipient_only_field_bit:
+                    recipient_rows = Message.objects.as_recipient(user, filter).update(**{self.recipient_only_field_bit: self.field_value})
+                else:
+                    recipient_rows = Message.objects.as_recipient(user, filter).update(**{'recipient_{0}'.format(self.field_bit): self.field_value})
+                    sender_rows = Message.objects.as_sender(user, filter).update(**{'sender_{0}'.format(self.field_bit): self.field_value})
+                if not (recipient_rows or sender_rows):
+                    raise Http404  # abnormal enough, like forged ids
+                Message.objects.refresh_folders(user, filter)
             messages.success(request, self.success_msg, fail_silently=True)
             next_url = request.GET.get('next', None)
             next_url = safe_redirect(next_url, request) if next_url else None
@@ -252,3 +260,33 @@ class RocketChatWriteGroupView(BaseRocketChatView):
         if group_name:
             return f'{self.base_url}/group/{group_name}/'
         return None
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class RocketChatWebhookView(View):
+    """ Receives events from rocketchat outgoing webhook integrations and mirrors them
+        into the local link data and caches. Each event type is configured as an integration
+        posting to the URL with its event name, e.g. `.../webhook/roomCreated/`. The handled events
+        are roomCreated, userCreated, roomJoined and roomLeft, see `WEBHOOK_EVENT_HANDLERS`.
+        Requests are authenticated by the integration's token matching `COSINNUS_CHAT_WEBHOOK_TOKEN`. """
+    
+    http_method_names = ['post']
+    
+    def post(self, request, *args, **kwargs):
+        if not settings.COSINNUS_CHAT_WEBHOOK_TOKEN:
+            raise Http404
+        try:
+            payload = json.loads(request.body.decode('utf-8'))
+        except ValueError:
+            payload = None
+        if not isinstance(payload, dict):
+            return JsonResponse({'success': False, 'error': 'Invalid JSON'}, status=400)
+        token = str(payload.get('token', ''))
+        if not hmac.compare_digest(token.encode('utf-8'), settings.COSINNUS_CHAT_WEBHOOK_TOKEN.encode('utf-8')):
+            return JsonResponse({'success': False, 'error': 'Invalid token'}, status=403)
+        
+        from cosinnus_message.rocket_webhook import handle_webhook_event
+        event = kwargs.get('event') or payload.get('event')
+        if not handle_webhook_event(event, payload):
+            return JsonResponse({'success': False, 'error': 'Unknown event or missing data'}, status=400)
+        return JsonResponse({'success': True})
@@ -53,6 +53,7 @@ def pm_broadcast(sender, recipients, subject, body='', skip_notification=False):
         message.recipient = recipient
         message.pk = None
         message.save()
+        Message.objects.refresh_folders_for_sent([message])
         if not skip_notification:
             message.notify_users(STATUS_PENDING, _get_site())
 
@@ -84,5 +85,6 @@ def pm_write(sender, recipient, subject, body='', skip_notification=False,
     if auto_delete:
         message.sender_deleted_at = now()
     message.save()
+    Message.objects.refresh_folders_for_sent([message])
     if not skip_notification:
         message.notify_users(initial_status, _get_site())
@@ -30,7 +30,7 @@ from django.db import transaction
 from django.utils.translation import ugettext, ugettext_lazy as _
 
 from .fields import CommaSeparatedUserField
-from .models import Message, get_user_name
+from .models import Message, OutgoingMessage, bulk_fan_out_enabled, get_user_name, send_later_enabled
 from .utils import WRAP_WIDTH
 
 
@@ -53,6 +53,10 @@ class BaseWriteForm(FormAttachableMixin, forms.ModelForm):
     
     # can be set on init to prevent any notifications going out
     do_not_notify_users = False
+    # can be set on init to allow storing messages to many recipients as an OutgoingMessage, sent in the background
+    send_later = False
+    # the OutgoingMessage stored by the last save, if any
+    outgoing = None
 
     def __init__(self, *args, **kwargs):
         sender = kwargs.pop('sender', None)
@@ -62,6 +66,7 @@ class BaseWriteForm(FormAttachableMixin, forms.ModelForm):
         channel = kwargs.pop('channel', None)
         self.site = kwargs.pop('site', None)
         self.do_not_notify_users = kwargs.pop('do_not_notify_users', self.do_not_notify_users)
+        self.send_later = kwargs.pop('send_later', self.send_later)
         super(BaseWriteForm, self).__init__(*args, **kwargs)
 
         self.instance.sender = sender if (sender and sender.is_authenticated) else None
@@ -181,6 +186,19 @@ class BaseWriteForm(FormAttachableMixin, forms.ModelForm):
         
         # important to clear because forms are reused
         self.extra_instances = []
+        self.outgoing = None
+        if multiconv and not do_reply_single_copy and self.send_later and not auto_moderators \
+                and send_later_enabled(recipients):
+            self.outgoing = OutgoingMessage.objects.create_outgoing(self.instance, recipients, multiconv, level,
+                parent=original_parent, notify=not self.do_not_notify_users)
+            return True
+        if multiconv and not do_reply_single_copy and bulk_fan_out_enabled(recipients):
+            self.extra_instances = Message.objects.bulk_fan_out(self.instance, recipients, multiconv, level,
+                parent=original_parent, auto_moderators=auto_moderators, site=self.site, notify=not self.do_not_notify_users)
+            self.instance = self.extra_instances[-1]
+            Message.objects.refresh_folders_for_sent(self.extra_instances)
+            return not any([m.is_rejected() for m in self.extra_instances])
+        
         for r in recipients:
             # in a multiconversation reply, find the actual parent for this recipient's message object of the conversation
             # (each recipient has their own thread, connected my a MultiConversation)
@@ -252,6 +270,7 @@ class BaseWriteForm(FormAttachableMixin, forms.ModelForm):
             self.instance.set_moderation(*initial_moderation)
             self.instance.set_dates(*initial_dates)
         
+        Message.objects.refresh_folders_for_sent(self.extra_instances)
         return is_successful
     # commit_on_success() is deprecated in Django 1.6 and will be removed in Django 1.8
     save = transaction.atomic(save) if hasattr(transaction, 'atomic') else transaction.commit_on_success(save)
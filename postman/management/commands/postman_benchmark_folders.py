@@ -0,0 +1,145 @@
+from __future__ import unicode_literals
+import random
+import time
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import CommandError
+from django.db import connection, transaction
+from django.db.models import Count, F
+from django.test.utils import override_settings
+try:
+    from django.utils.timezone import now   # Django 1.4 aware datetimes
+except ImportError:
+    from datetime import datetime
+    now = datetime.now
+
+from postman.profiling import ProfilableCommand
+from postman.models import Message, ConversationIndex, STATUS_ACCEPTED
+
+BENCHMARK_SUBJECT = 'postman_benchmark_folders'
+FOLDERS = ('inbox', 'sent', 'archives', 'trash')
+# the settings selecting each implementation of the by-conversation folders
+IMPLEMENTATIONS = (
+    ('legacy', {'POSTMAN_LEGACY_FOLDER_QUERY': True, 'POSTMAN_CONVERSATION_INDEX': False}),
+    ('subquery', {'POSTMAN_LEGACY_FOLDER_QUERY': False, 'POSTMAN_CONVERSATION_INDEX': False}),
+    ('index', {'POSTMAN_LEGACY_FOLDER_QUERY': False, 'POSTMAN_CONVERSATION_INDEX': True}),
+)
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(ProfilableCommand):
+    help = """Compares the query plans and timings of the implementations of the by-conversation folders
+  (legacy UNION join, subqueries, conversation index). Messages are seeded among existing users
+  for the benchmark and rolled back at the end, nothing is kept in the database."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('-m', '--messages', type=int, default=1000000,
+            help='Number of messages to seed [default: 1000000]')
+        parser.add_argument('-u', '--users', type=int, default=1000,
+            help='Number of existing users the seeded messages are spread over [default: 1000]')
+        parser.add_argument('--thread-ratio', type=float, default=0.7,
+            help='Ratio of seeded messages that are replies in a conversation [default: 0.7]')
+        parser.add_argument('-r', '--repeat', type=int, default=5,
+            help='Number of runs of each query, the best time is reported [default: 5]')
+        parser.add_argument('--page-size', type=int, default=50,
+            help='Number of conversations fetched per folder [default: 50]')
+        parser.add_argument('--explain', action='store_true',
+            help='Print the query plans')
+
+    def handle(self, *args, **options):
+        user_ids = list(get_user_model().objects.filter(is_active=True).order_by('id')
+                        .values_list('id', flat=True)[:options['users']])
+        if len(user_ids) < 2:
+            raise CommandError('At least two active users are needed to seed messages.')
+        try:
+            with transaction.atomic():
+                if options['messages'] > 0:
+                    with self.profile_phase('seed'):
+                        self.seed(user_ids, options['messages'], options['thread_ratio'])
+                    if connection.vendor in ('postgresql', 'sqlite'):
+                        # give the planner statistics of the seeded data, as it has in production
+                        with connection.cursor() as cursor:
+                            cursor.execute('ANALYZE %s' % Message._meta.db_table)
+                # benchmark the folders of the user with the most messages
+                user_id = Message.objects.filter(recipient__in=user_ids).values('recipient')\
+                    .annotate(cnt=Count('pk')).order_by('-cnt').values_list('recipient', flat=True).first()
+                user = get_user_model().objects.get(id=user_id)
+                started = time.time()
+                ConversationIndex.objects.rebuild(user)
+                self.stdout.write('Rebuilt the conversation index of user %d in %.3fs\n' % (user.id, time.time() - started))
+                for name, implementation_settings in IMPLEMENTATIONS:
+                    with self.profile_phase(name), override_settings(**implementation_settings):
+                        for folder in FOLDERS:
+                            self.benchmark(name, folder, user, options)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def seed(self, user_ids, count, thread_ratio, batch_size=10000):
+        """Create standalone messages and conversations with replies among the users."""
+        sent_at = now() - timedelta(days=365)
+        step = timedelta(days=365) / count
+        root_count = max(1, int(count * (1 - thread_ratio)))
+        self._bulk_create((Message(
+            subject=BENCHMARK_SUBJECT,
+            sender_id=sender_id,
+            recipient_id=recipient_id,
+            sent_at=sent_at + step * i,
+            read_at=sent_at if random.random() < 0.8 else None,
+            sender_archived=random.random() < 0.1,
+            recipient_archived=random.random() < 0.1,
+            moderation_status=STATUS_ACCEPTED,
+        ) for i, (sender_id, recipient_id) in enumerate(random.sample(user_ids, 2) for __ in range(root_count))), batch_size)
+        # half of the first messages get replies
+        root_ids = list(Message.objects.filter(subject=BENCHMARK_SUBJECT).order_by('pk').values_list('pk', flat=True))[::2]
+        for i in range(0, len(root_ids), batch_size):
+            Message.objects.filter(pk__in=root_ids[i:i + batch_size]).update(thread=F('pk'))
+        roots = list(Message.objects.filter(subject=BENCHMARK_SUBJECT, thread=F('pk')).values_list('pk', 'sender_id', 'recipient_id'))
+
+        def replies():
+            for i in range(count - root_count):
+                thread_id, sender_id, recipient_id = random.choice(roots)
+                if random.random() < 0.5:
+                    sender_id, recipient_id = recipient_id, sender_id
+                yield Message(
+                    subject=BENCHMARK_SUBJECT,
+                    sender_id=sender_id,
+                    recipient_id=recipient_id,
+                    thread_id=thread_id,
+                    parent_id=thread_id,
+                    sent_at=sent_at + step * (root_count + i),
+                    read_at=sent_at if random.random() < 0.8 else None,
+                    moderation_status=STATUS_ACCEPTED,
+                )
+        self._bulk_create(replies(), batch_size)
+        self.stdout.write('Seeded %d messages in %d conversations\n' % (count, len(roots)))
+
+    def _bulk_create(self, messages, batch_size):
+        batch = []
+        for message in messages:
+            batch.append(message)
+            if len(batch) >= batch_size:
+                Message.objects.bulk_create(batch)
+                batch = []
+        if batch:
+            Message.objects.bulk_create(batch)
+
+    def benchmark(self, name, folder, user, options):
+        qs = getattr(Message.objects, folder)(user)
+        page = qs[:options['page_size']]
+        if options['explain']:
+            self.stdout.write('--- %s %s\n%s\n' % (name, folder, page.explain()))
+        page_times, count_times = [], []
+        for __ in range(max(1, options['repeat'])):
+            started = time.time()
+            list(page.all())
+            page_times.append(time.time() - started)
+            started = time.time()
+            total = qs.count()
+            count_times.append(time.time() - started)
+        self.stdout.write('%-8s %-8s first page: %8.1fms  count: %8.1fms  (%d conversations)\n' % (
+            name, folder, min(page_times) * 1000, min(count_times) * 1000, total))
@@ -1,16 +1,16 @@
 from __future__ import unicode_literals
 import datetime
 
-from django.core.management.base import NoArgsCommand
 from django.db.models import Q, F, Count
 
+from postman.profiling import ProfilableCommand
 from postman.models import Message
 
 
-class Command(NoArgsCommand):
+class Command(ProfilableCommand):
     help = "Can be run as a cron job or directly to check-up data consistency in the database."
 
-    def handle_noargs(self, **options):
+    def handle(self, *args, **options):
         verbose = int(options.get('verbosity'))
         if verbose >= 1:
             self.stdout.write(datetime.datetime.now().strftime("%H:%M:%S ") + "Checking messages and conversations for inconsistencies...\n")
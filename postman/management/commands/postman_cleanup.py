@@ -1,8 +1,6 @@
 from __future__ import unicode_literals
 from datetime import timedelta
-from optparse import make_option
 
-from django.core.management.base import NoArgsCommand
 from django.db.models import Max, Count, F, Q
 try:
     from django.utils.timezone import now   # Django 1.4 aware datetimes
@@ -10,20 +8,21 @@ except ImportError:
     from datetime import datetime
     now = datetime.now
 
+from postman.profiling import ProfilableCommand
 from postman.models import Message
 
 
-class Command(NoArgsCommand):
+class Command(ProfilableCommand):
     help = """Can be run as a cron job or directly to clean out old data from the database:
   Messages or conversations marked as deleted by both sender and recipient,
   more than a minimal number of days ago."""
-    option_list = NoArgsCommand.option_list + (
-        make_option('-d', '--days', type='int', default=30,
+
+    def add_arguments(self, parser):
+        parser.add_argument('-d', '--days', type=int, default=30,
             help='The minimal number of days a message is kept marked as deleted, '
-                 'before to be considered for real deletion [default: %default]'),
-        )
+                 'before to be considered for real deletion [default: 30]')
 
-    def handle_noargs(self, **options):
+    def handle(self, *args, **options):
         verbose = int(options.get('verbosity'))
         days = options.get('days')
         date = now() - timedelta(days=days)
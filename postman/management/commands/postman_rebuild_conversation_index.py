@@ -0,0 +1,36 @@
+from __future__ import unicode_literals
+
+from django.contrib.auth import get_user_model
+from django.db.models import Q
+
+from postman.profiling import ProfilableCommand
+from postman.models import Message, ConversationIndex
+
+
+class Command(ProfilableCommand):
+    help = """Rebuilds the conversation index of the by-conversation folders from the messages.
+  Run this once before enabling POSTMAN_CONVERSATION_INDEX, and whenever messages were changed
+  while it was disabled."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('-u', '--user', action='append', dest='users', default=[],
+            help='Only rebuild the index of the user with this id (can be given multiple times)')
+
+    def handle(self, *args, **options):
+        verbose = int(options.get('verbosity'))
+        user_ids = [int(user_id) for user_id in options.get('users')]
+        if not user_ids:
+            with self.profile_phase('collect_users'):
+                user_ids = get_user_model().objects.filter(
+                    Q(id__in=Message.objects.values('sender')) | Q(id__in=Message.objects.values('recipient'))
+                ).order_by('id').values_list('id', flat=True)
+                # drop the entries of users without messages left
+                ConversationIndex.objects.exclude(user__in=user_ids).delete()
+                user_ids = list(user_ids)
+        with self.profile_phase('rebuild'):
+            for count, user_id in enumerate(user_ids, 1):
+                ConversationIndex.objects.rebuild(user_id)
+                if verbose >= 2 or (verbose >= 1 and count % 1000 == 0):
+                    self.stdout.write("Rebuilt the conversation index of %d of %d users\n" % (count, len(user_ids)))
+        if verbose >= 1:
+            self.stdout.write("Rebuilt the conversation index of %d users.\n" % len(user_ids))
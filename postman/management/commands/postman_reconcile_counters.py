@@ -0,0 +1,20 @@
+from __future__ import unicode_literals
+
+from postman.profiling import ProfilableCommand
+from postman.models import FolderCounters
+
+
+class Command(ProfilableCommand):
+    help = """Can be run as a cron job or directly to recount the stored unread and folder counters
+  of the users and fix those that differ from the messages."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('-u', '--user', action='append', dest='users', default=[],
+            help='Only reconcile the counters of the user with this id (can be given multiple times)')
+
+    def handle(self, *args, **options):
+        verbose = int(options.get('verbosity'))
+        users = [int(user_id) for user_id in options.get('users')] or None
+        checked, fixed = FolderCounters.objects.reconcile(users)
+        if verbose >= 1:
+            self.stdout.write("Checked the counters of %d users, fixed %d.\n" % (checked, fixed))
@@ -0,0 +1,32 @@
+from __future__ import unicode_literals
+
+from django.contrib.sites.models import Site
+
+from cosinnus.conf import settings
+from postman.profiling import ProfilableCommand
+from postman.models import OutgoingMessage, OUTGOING_FAILED, OUTGOING_PENDING
+
+
+class Command(ProfilableCommand):
+    help = """Can be run as a cron job or directly to send the messages stored for sending in the background
+  to their recipients, by batches."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('-b', '--batch-size', type=int, default=None,
+            help='Number of recipients sent to in one transaction (default: the POSTMAN_SEND_LATER_BATCH_SIZE setting, or 500)')
+        parser.add_argument('-l', '--limit', type=int, default=None,
+            help='Stop after sending this many messages (default: send all pending)')
+        parser.add_argument('--retry-failed', action='store_true',
+            help='Resume sending the messages that failed, from where they stopped')
+
+    def handle(self, *args, **options):
+        verbose = int(options.get('verbosity'))
+        if options.get('retry_failed'):
+            OutgoingMessage.objects.filter(status=OUTGOING_FAILED).update(status=OUTGOING_PENDING, error='')
+        # do not require the sites framework to be installed ; and no request object is available here
+        site = Site.objects.get_current() if Site._meta.installed else None
+        with self.profile_phase('send'):
+            batch_size = options.get('batch_size') or getattr(settings, 'POSTMAN_SEND_LATER_BATCH_SIZE', 500)
+            count = OutgoingMessage.objects.send_pending(max(1, batch_size), site=site, limit=options.get('limit'))
+        if verbose >= 1:
+            self.stdout.write("Sent %d messages.\n" % count)
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('postman', '0005_auto_20180926_1357'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationIndex',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('conversation_id', models.PositiveIntegerField(help_text='The thread id, or the message id for a standalone message')),
+                ('folder', models.CharField(choices=[('inbox', 'Inbox'), ('sent', 'Sent'), ('archives', 'Archives'), ('trash', 'Trash')], max_length=8)),
+                ('sent_at', models.DateTimeField(help_text='Copy of the sent_at of the last message, for the ordering')),
+                ('count', models.PositiveIntegerField(default=0, help_text='The number of messages of the conversation in this folder, 0 for a standalone message')),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('last_message', models.ForeignKey(help_text='The most recent message of the conversation in this folder', on_delete=django.db.models.deletion.CASCADE, related_name='conversation_index_entries', to='postman.Message')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='postman_conversation_index', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='conversationindex',
+            unique_together={('user', 'conversation_id', 'folder')},
+        ),
+        migrations.AddIndex(
+            model_name='conversationindex',
+            index=models.Index(fields=['user', 'folder', 'sent_at'], name='postman_convindex_folder_idx'),
+        ),
+    ]
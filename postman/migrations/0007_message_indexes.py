@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('postman', '0006_conversationindex'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['recipient', 'recipient_archived', 'recipient_deleted_at', 'moderation_status', 'sent_at'], name='postman_msg_inbox_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['sender', 'sender_archived', 'sender_deleted_at', 'master_for_sender', 'sent_at'], name='postman_msg_sent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['thread', 'id'], name='postman_msg_thread_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['multi_conversation', 'level', 'recipient'], name='postman_msg_multiconv_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['direct_reply_hash'], name='postman_msg_reply_hash_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('postman', '0007_message_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FolderCounters',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='postman_folder_counters', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('unread_count', models.IntegerField(default=0)),
+                ('inbox_count', models.IntegerField(default=0)),
+                ('archives_count', models.IntegerField(default=0)),
+                ('trash_count', models.IntegerField(default=0)),
+                ('reconciled_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'verbose_name_plural': 'folder counters',
+            },
+        ),
+    ]
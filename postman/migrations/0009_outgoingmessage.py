@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('cosinnus', '0022_auto_20170329_1448'),
+        ('postman', '0008_foldercounters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutgoingMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.CharField(max_length=120)),
+                ('body', models.TextField(blank=True)),
+                ('level', models.IntegerField(default=0)),
+                ('notify', models.BooleanField(default=True)),
+                ('status', models.CharField(choices=[('p', 'Sending'), ('s', 'Sent'), ('f', 'Failed')], default='p', max_length=1)),
+                ('recipient_count', models.IntegerField(default=0)),
+                ('sent_count', models.IntegerField(default=0, help_text='Number of recipients the message was sent to, in order of their ids')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, help_text='Used as the sent_at of the messages')),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+                ('attached_objects', models.ManyToManyField(blank=True, to='cosinnus.AttachedObject')),
+                ('multi_conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='postman.MultiConversation')),
+                ('parent', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='postman.Message')),
+                ('recipients', models.ManyToManyField(related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='postman_outgoing_messages', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('postman', '0009_outgoingmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outgoingmessage',
+            name='last_recipient_pk',
+            field=models.IntegerField(blank=True, help_text='Id of the last recipient the message was sent to, the recipients are sent to in order of their ids', null=True),
+        ),
+        migrations.AlterField(
+            model_name='outgoingmessage',
+            name='sent_count',
+            field=models.IntegerField(default=0, help_text='Number of recipients the message was sent to'),
+        ),
+    ]
@@ -3,15 +3,18 @@ from __future__ import division
 from builtins import str
 from builtins import object
 import hashlib
+import logging
 from django.utils.crypto import get_random_string
 from cosinnus.models.tagged import AttachableObjectModel, LastVisitedMixin
 from importlib import import_module
 import six
 
 from cosinnus.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.urls import reverse
-from django.db import models
+from django.db import connections, models, transaction
+from django.db.models.functions import Coalesce
 from django.db.models.query import QuerySet
 from django.utils.encoding import force_text
 try:
@@ -30,6 +33,9 @@ from .query import PostmanQuery
 from .utils import email_visitor, notify_user
 import uuid
 
+logger = logging.getLogger('cosinnus')
+
+
 def get_uuid():
     return uuid.uuid4().hex
 
@@ -46,6 +52,30 @@ STATUS_CHOICES = (
 ORDER_BY_KEY = 'o'  # as 'order'
 ORDER_BY_FIELDS = {}  # setting is deferred in setup()
 ORDER_BY_MAPPER = {'sender': 'f', 'recipient': 't', 'subject': 's', 'date': 'd'}  # for templatetags usage
+# cache key and timeout of the folder counters of a user
+POSTMAN_FOLDER_COUNTERS_CACHE_KEY = 'postman/folder_counters/%(user_id)s'
+POSTMAN_FOLDER_COUNTERS_CACHE_TIMEOUT = 60 * 60
+FOLDER_COUNTER_FIELDS = ('unread_count', 'inbox_count', 'archives_count', 'trash_count')
+# outgoing message status constants
+OUTGOING_PENDING = 'p'
+OUTGOING_SENT = 's'
+OUTGOING_FAILED = 'f'
+OUTGOING_STATUS_CHOICES = (
+    (OUTGOING_PENDING, _('Sending')),
+    (OUTGOING_SENT, _('Sent')),
+    (OUTGOING_FAILED, _('Failed')),
+)
+# folder constants
+FOLDER_INBOX = 'inbox'
+FOLDER_SENT = 'sent'
+FOLDER_ARCHIVES = 'archives'
+FOLDER_TRASH = 'trash'
+FOLDER_CHOICES = (
+    (FOLDER_INBOX, _('Inbox')),
+    (FOLDER_SENT, _('Sent')),
+    (FOLDER_ARCHIVES, _('Archives')),
+    (FOLDER_TRASH, _('Trash')),
+)
 
 
 def setup():
@@ -87,6 +117,48 @@ def get_order_by(query_dict):
             return order_by_field
 
 
+def conversation_index_enabled():
+    """
+    Tell if the by-conversation folders are read from the ConversationIndex table.
+    """
+    return getattr(settings, 'POSTMAN_CONVERSATION_INDEX', False)
+
+
+def folder_counters_enabled():
+    """
+    Tell if the unread and folder counts are read from the FolderCounters table.
+
+    The counters must then be reconciled regularly, by the postman_reconcile_counters command,
+    or in cosinnus by adding cosinnus_message.cron.ReconcilePostmanFolderCounters to CRON_CLASSES.
+    """
+    return getattr(settings, 'POSTMAN_FOLDER_COUNTERS', False)
+
+
+def bulk_fan_out_enabled(recipients):
+    """
+    Tell if a multi-conversation message to these recipients is saved by MessageManager.bulk_fan_out().
+
+    This needs a database returning the primary keys of bulk inserted rows, for the attachments and the notifications.
+    """
+    threshold = getattr(settings, 'POSTMAN_BULK_FANOUT_THRESHOLD', None)
+    return threshold is not None and len(recipients) >= threshold \
+        and connections[Message.objects.db].features.can_return_rows_from_bulk_insert
+
+
+def send_later_enabled(recipients):
+    """
+    Tell if a multi-conversation message to these recipients is stored as an OutgoingMessage,
+    to be fanned out by the postman_send_outgoing command, instead of being saved in the request.
+
+    The command saves the messages with MessageManager.bulk_fan_out(), which has the same database requirement.
+    It must be run every minute when POSTMAN_SEND_LATER_THRESHOLD is set, or in cosinnus by adding
+    cosinnus_message.cron.SendPostmanOutgoingMessages to CRON_CLASSES. Otherwise the messages are never sent.
+    """
+    threshold = getattr(settings, 'POSTMAN_SEND_LATER_THRESHOLD', None)
+    return threshold is not None and len(recipients) >= threshold \
+        and connections[Message.objects.db].features.can_return_rows_from_bulk_insert
+
+
 def get_user_representation(user):
     """
     Return a User representation for display, configurable through an optional setting.
@@ -155,19 +227,96 @@ class MultiConversationModel(models.Model):
 class MessageManager(models.Manager):
     """The manager for Message."""
 
-    def _folder(self, related, filters, user, option=None, order_by=None):
+    def folder_filters(self, folder, user):
+        """
+        Return the field-lookups filter(s) defining a folder for a user.
+        """
+        if folder == FOLDER_INBOX:
+            return {
+                'recipient': user,
+                'recipient_archived': False,
+                'recipient_deleted_at__isnull': True,
+                'moderation_status': STATUS_ACCEPTED,
+            }
+        if folder == FOLDER_SENT:
+            return {
+                'sender': user,
+                'sender_archived': False,
+                'sender_deleted_at__isnull': True,
+                'master_for_sender': True,
+                # allow to see pending and rejected messages as well
+            }
+        if folder == FOLDER_ARCHIVES:
+            return ({
+                'recipient': user,
+                'recipient_archived': True,
+                'recipient_deleted_at__isnull': True,
+                'master_for_sender': True,
+                'moderation_status': STATUS_ACCEPTED,
+            }, {
+                'sender': user,
+                'sender_archived': True,
+                'sender_deleted_at__isnull': True,
+            })
+        if folder == FOLDER_TRASH:
+            return ({
+                'recipient': user,
+                'recipient_deleted_at__isnull': False,
+                'master_for_sender': True,
+                'moderation_status': STATUS_ACCEPTED,
+            }, {
+                'sender': user,
+                'sender_deleted_at__isnull': False,
+            })
+        raise ValueError('Unknown folder: {0}'.format(folder))
+
+    def _folder_lookups(self, filters):
+        """Combine the filter(s) of a folder into one lookup."""
+        if isinstance(filters, (list, tuple)):
+            lookups = models.Q()
+            for filter in filters:
+                lookups |= models.Q(**filter)
+            return lookups
+        return models.Q(**filters)
+
+    def _master_lookups(self, user):
+        """
+        For conversations messages where the user is the first sender (initiator), we filter so that
+        we only show him the master_for_sender messages (otherwise they would see duplicates)
+        """
+        return models.Q(thread__isnull=True) | ~models.Q(thread__sender=user) | (models.Q(thread__sender=user) & models.Q(master_for_sender=True))
+
+    def _thread_count(self):
+        """Return a subquery of the number of messages of the thread of a message, as used by Message.better_count()."""
+        return models.Subquery(self.filter(thread=models.OuterRef('thread')).order_by().values('thread')
+            .annotate(thread_count=models.Count('pk')).values('thread_count'), output_field=models.IntegerField())
+
+    def for_display(self, qs):
+        """
+        Return a folder queryset that also fetches, in bulk, what is rendered for each row:
+        the senders and recipients with their profiles, and the participants and groups of the multi-conversations.
+        """
+        try:
+            from django.contrib.auth import get_user_model  # Django 1.5
+        except ImportError:
+            from postman.future_1_5 import get_user_model
+        return qs.select_related('sender__cosinnus_profile', 'recipient__cosinnus_profile', 'multi_conversation').prefetch_related(
+            models.Prefetch('multi_conversation__participants', queryset=get_user_model().objects.select_related('cosinnus_profile')),
+            'multi_conversation__targetted_groups',
+        )
+
+    def _folder(self, related, filters, user, option=None, order_by=None, folder=None):
         """Base code, in common to the folders."""
+        if folder and option != OPTION_MESSAGES and conversation_index_enabled():
+            return self._indexed_folder(related, folder, user, order_by)
+        if option != OPTION_MESSAGES and not getattr(settings, 'POSTMAN_LEGACY_FOLDER_QUERY', False):
+            return self._conversation_folder(related, filters, user, order_by)
         qs = self.all() if option == OPTION_MESSAGES else QuerySet(self.model, PostmanQuery(self.model), using=self._db)
         if related:
             qs = qs.select_related(*related)
         if order_by:
             qs = qs.order_by(order_by)
-        if isinstance(filters, (list, tuple)):
-            lookups = models.Q()
-            for filter in filters:
-                lookups |= models.Q(**filter)
-        else:
-            lookups = models.Q(**filters)
+        lookups = self._folder_lookups(filters)
         if option == OPTION_MESSAGES:
             qs = qs.filter(lookups)
             # Adding a 'count' attribute, to be similar to the by-conversation case,
@@ -185,24 +334,61 @@ class MessageManager(models.Manager):
                     .values_list('id', 'count').order_by(),
             ))
         
-        # for conversations messages where the user is the first sender (initiator), we filter so that
-        # we only show him the master_for_sender messages (otherwise they would see duplicates)
-        qs = qs.filter(models.Q(thread__isnull=True) | ~models.Q(thread__sender=user) | (models.Q(thread__sender=user) & models.Q(master_for_sender=True)))
+        qs = qs.filter(self._master_lookups(user))
         
         return qs
 
+    def _conversation_folder(self, related, filters, user, order_by=None):
+        """
+        By-conversation folder built with subqueries: the standalone messages, and the latest message
+        of each thread, annotated with the number of messages of the thread in the folder.
+
+        On PostgreSQL, the latest messages are selected with DISTINCT ON, elsewhere with
+        a MAX() grouped by thread.
+        """
+        lookups = self._folder_lookups(filters)
+        threaded = self.filter(lookups, thread__isnull=False)
+        if connections[self.db].vendor == 'postgresql':
+            latest = threaded.order_by('thread', '-pk').distinct('thread').values('pk')
+        else:
+            latest = threaded.order_by().values('thread').annotate(latest=models.Max('pk')).values('latest')
+        conversations = models.Q(thread__isnull=True) | models.Q(pk__in=latest)
+        in_thread = self.filter(lookups, thread=models.OuterRef('thread'))
+        folder_count = in_thread.order_by().values('thread').annotate(folder_count=models.Count('pk')).values('folder_count')
+        qs = self.filter(lookups).filter(conversations).annotate(count=models.Case(
+            models.When(thread__isnull=True, then=models.Value(0)),
+            default=models.Subquery(folder_count),
+            output_field=models.IntegerField(),
+        ), thread_count=self._thread_count())
+        if related:
+            qs = qs.select_related(*related)
+        if order_by:
+            qs = qs.order_by(order_by)
+        return qs.filter(self._master_lookups(user))
+
+    def _indexed_folder(self, related, folder, user, order_by=None):
+        """
+        By-conversation folder read from the ConversationIndex: one indexed range scan
+        on the entries of the user, joined to the last message of each conversation.
+        """
+        qs = self.filter(conversation_index_entries__user=user, conversation_index_entries__folder=folder)\
+            .annotate(count=models.F('conversation_index_entries__count'),
+                      index_sent_at=models.F('conversation_index_entries__sent_at'),
+                      thread_count=self._thread_count())
+        if related:
+            qs = qs.select_related(*related)
+        if order_by:
+            qs = qs.order_by(order_by)
+        else:
+            qs = qs.order_by('-index_sent_at', '-conversation_index_entries__last_message')
+        return qs
+
     def inbox(self, user, related=True, **kwargs):
         """
         Return accepted messages received by a user but not marked as archived or deleted.
         """
         related = ('sender',) if related else None
-        filters = {
-            'recipient': user,
-            'recipient_archived': False,
-            'recipient_deleted_at__isnull': True,
-            'moderation_status': STATUS_ACCEPTED,
-        }
-        return self._folder(related, filters, user, **kwargs)
+        return self._folder(related, self.folder_filters(FOLDER_INBOX, user), user, folder=FOLDER_INBOX, **kwargs)
 
     def inbox_unread_count(self, user):
         """
@@ -211,6 +397,8 @@ class MessageManager(models.Manager):
         Designed for context_processors.py and templatetags/postman_tags.py
 
         """
+        if folder_counters_enabled():
+            return FolderCounters.objects.get_counts(user)['unread_count']
         return self.inbox(user, related=False, option=OPTION_MESSAGES).filter(read_at__isnull=True).count()
 
     def sent(self, user, **kwargs):
@@ -218,48 +406,21 @@ class MessageManager(models.Manager):
         Return all messages sent by a user but not marked as archived or deleted.
         """
         related = ('recipient',)
-        filters = {
-            'sender': user,
-            'sender_archived': False,
-            'sender_deleted_at__isnull': True,
-            'master_for_sender': True,
-            # allow to see pending and rejected messages as well
-        }
-        return self._folder(related, filters, user, **kwargs)
+        return self._folder(related, self.folder_filters(FOLDER_SENT, user), user, folder=FOLDER_SENT, **kwargs)
 
     def archives(self, user, **kwargs):
         """
         Return messages belonging to a user and marked as archived.
         """
         related = ('sender', 'recipient')
-        filters = ({
-            'recipient': user,
-            'recipient_archived': True,
-            'recipient_deleted_at__isnull': True,
-            'master_for_sender': True,
-            'moderation_status': STATUS_ACCEPTED,
-        }, {
-            'sender': user,
-            'sender_archived': True,
-            'sender_deleted_at__isnull': True,
-        })
-        return self._folder(related, filters, user, **kwargs)
+        return self._folder(related, self.folder_filters(FOLDER_ARCHIVES, user), user, folder=FOLDER_ARCHIVES, **kwargs)
 
     def trash(self, user, **kwargs):
         """
         Return messages belonging to a user and marked as deleted.
         """
         related = ('sender', 'recipient')
-        filters = ({
-            'recipient': user,
-            'recipient_deleted_at__isnull': False,
-            'master_for_sender': True,
-            'moderation_status': STATUS_ACCEPTED,
-        }, {
-            'sender': user,
-            'sender_deleted_at__isnull': False,
-        })
-        return self._folder(related, filters, user, **kwargs)
+        return self._folder(related, self.folder_filters(FOLDER_TRASH, user), user, folder=FOLDER_TRASH, **kwargs)
 
     def thread(self, user, filter):
         """
@@ -270,6 +431,22 @@ class MessageManager(models.Manager):
             (models.Q(recipient=user) & models.Q(moderation_status=STATUS_ACCEPTED)) | models.Q(sender=user) | models.Q(multi_conversation__participants=user),
         ).order_by('sent_at').distinct()
 
+    def conversation(self, user, thread_id):
+        """
+        Return a conversation for display, like thread() but without the join on the participants.
+
+        The multi-conversations of the thread the user takes part in are looked up beforehand,
+        so the messages can be filtered on their own columns and no distinct is needed.
+        """
+        visible = (models.Q(recipient=user) & models.Q(moderation_status=STATUS_ACCEPTED)) | models.Q(sender=user)
+        multi_conversation_ids = list(MultiConversation.objects.filter(
+            participants=user,
+            pk__in=self.filter(thread=thread_id).values('multi_conversation'),
+        ).values_list('pk', flat=True))
+        if multi_conversation_ids:
+            visible |= models.Q(multi_conversation__in=multi_conversation_ids)
+        return self.select_related('sender', 'recipient').filter(visible, thread=thread_id).order_by('sent_at', 'pk')
+
     def as_recipient(self, user, filter):
         """
         Return messages matching a filter AND being visible to a user as the recipient.
@@ -295,12 +472,146 @@ class MessageManager(models.Manager):
         """
         Set messages as read.
         """
-        return self.filter(
+        qs = self.filter(
             filter,
             recipient=user,
             moderation_status=STATUS_ACCEPTED,
             read_at__isnull=True,
-        ).update(read_at=now())
+        )
+        if not (conversation_index_enabled() or folder_counters_enabled()):
+            return qs.update(read_at=now())
+        with transaction.atomic():
+            conversation_ids = get_conversation_ids(qs) if conversation_index_enabled() else None
+            rows = qs.update(read_at=now())
+            if rows:
+                if conversation_ids:
+                    ConversationIndex.objects.refresh(user, conversation_ids)
+                if folder_counters_enabled():
+                    FolderCounters.objects.recount(user)
+        return rows
+
+    def refresh_folders(self, user, filter):
+        """
+        Update the ConversationIndex entries and the FolderCounters of a user, if enabled,
+        after the messages matching a filter were archived, deleted, undeleted or read.
+        """
+        if conversation_index_enabled():
+            ConversationIndex.objects.refresh(user, get_conversation_ids(self.filter(filter)))
+        if folder_counters_enabled():
+            FolderCounters.objects.recount(user)
+
+    def refresh_folders_for_sent(self, messages):
+        """
+        Update the ConversationIndex entries and the FolderCounters of the senders and recipients
+        of newly sent messages, if enabled.
+        """
+        if conversation_index_enabled():
+            ConversationIndex.objects.refresh_for_messages(messages)
+        if folder_counters_enabled():
+            FolderCounters.objects.add_sent(messages)
+
+    def fan_out_parents(self, multi_conversation, sender, recipients):
+        """
+        Return the parent message of each recipient of a reply in a multi-conversation, by recipient id.
+
+        As for one recipient in BaseWriteForm.save(), the parent is the message of the first level either
+        received by the recipient, or sent by the recipient to the sender if the recipient was the first sender.
+        """
+        received, sent = {}, {}
+        for message in self.select_related('thread').filter(
+                models.Q(recipient__in=recipients) | models.Q(sender__in=recipients, recipient=sender),
+                multi_conversation=multi_conversation, level=0):
+            if message.recipient_id == sender.pk:
+                sent[message.sender_id] = message
+            else:
+                received[message.recipient_id] = message
+        parents = {}
+        for r in recipients:
+            parent = received.get(r.pk) or sent.get(r.pk)
+            if not parent:
+                raise Exception('Programming Error: No parent found for %s' % str({'sender': sender, 'recipient': r, 'multiconv': multi_conversation}))
+            parents[r.pk] = parent
+        return parents
+
+    def bulk_fan_out(self, template, recipients, multi_conversation, level, parent=None, auto_moderators=[], site=None, notify=True,
+            has_master=False):
+        """
+        Save a copy of a message for each recipient of a multi-conversation, in a few queries.
+
+        This is the bulk equivalent of the per-recipient loop of BaseWriteForm.save(): the parents of all
+        recipients are fetched in one query, the messages are built in memory and inserted by batches,
+        the parents are marked as replied in one update, and the notifications are sent after commit.
+
+        Arguments:
+        ``template``: an unsaved message with the sender, subject, body and initial moderation status
+        ``parent``: the message replied to, if it is a reply
+        ``has_master``: if a previous batch of the same message already has the master message for the sender
+
+        Return the list of saved messages, in the order of the recipients.
+
+        """
+        sender = template.sender
+        parents = self.fan_out_parents(multi_conversation, sender, recipients) if parent else {}
+        # at the very first reply, make it a conversation
+        unthreaded = [p for p in parents.values() if not p.thread_id]
+        if unthreaded:
+            self.filter(pk__in=[p.pk for p in unthreaded]).update(thread=models.F('pk'))
+            for p in unthreaded:
+                p.thread = p
+        initial_status = template.moderation_status
+        messages = []
+        is_master = not has_master
+        for r in recipients:
+            message = self.model(**dict([(f.attname, getattr(template, f.attname)) for f in self.model._meta.concrete_fields]))
+            message.pk = None
+            message.recipient = r
+            message.multi_conversation = multi_conversation
+            message.level = level
+            # bulk_create() bypasses Message.save()
+            message.direct_reply_hash = get_random_string(32)
+            if parent:
+                message.parent = parents[r.pk]
+                message.thread = message.parent.thread
+                # the master_for_sender flag is on the message to the sender of the first (thread) message
+                message.master_for_sender = (r.pk == message.thread.sender_id)
+            else:
+                # otherwise, the first message will be master
+                message.master_for_sender = is_master
+                is_master = False
+            message.auto_moderate(auto_moderators)
+            message.clean_moderation(initial_status)
+            message.clean_for_visitor()
+            messages.append(message)
+        self.bulk_create(messages, batch_size=getattr(settings, 'POSTMAN_BULK_FANOUT_BATCH_SIZE', 500))
+
+        moderated = [m for m in messages if m.parent_id and m.moderation_status != initial_status]
+        accepted_parent_ids = [m.parent_id for m in moderated if m.is_accepted()]
+        if accepted_parent_ids:
+            # keep the very first date, as in update_parent()
+            self.filter(models.Q(replied_at__isnull=True) | models.Q(replied_at__gt=template.sent_at),
+                        pk__in=accepted_parent_ids).update(replied_at=template.sent_at)
+        for message in moderated:
+            if not message.is_accepted():
+                message.update_parent(initial_status)
+        if notify:
+            def notify_users():
+                for message in messages:
+                    message.notify_users(initial_status, site)
+            transaction.on_commit(notify_users)
+        return messages
+
+
+def get_conversation_ids(messages):
+    """
+    Return the ids of the conversations of messages: the thread id, or the message id for a standalone message.
+
+    Argument:
+    ``messages``: a queryset or an iterable of messages
+
+    """
+    if isinstance(messages, QuerySet):
+        return set([thread_id or pk for thread_id, pk in messages.values_list('thread_id', 'pk')])
+    return set([message.thread_id or message.pk for message in messages])
 
 
 @six.python_2_unicode_compatible
@@ -342,6 +653,19 @@ class Message(AttachableObjectModel, LastVisitedMixin, MultiConversationModel):
         verbose_name = _("message")
         verbose_name_plural = _("messages")
         ordering = ['-sent_at', '-id']
+        indexes = [
+            # the folders
+            models.Index(fields=['recipient', 'recipient_archived', 'recipient_deleted_at', 'moderation_status', 'sent_at'],
+                         name='postman_msg_inbox_idx'),
+            models.Index(fields=['sender', 'sender_archived', 'sender_deleted_at', 'master_for_sender', 'sent_at'],
+                         name='postman_msg_sent_idx'),
+            # the latest message and the message count of each thread
+            models.Index(fields=['thread', 'id'], name='postman_msg_thread_idx'),
+            # the parents of a multi conversation reply in BaseWriteForm.save()
+            models.Index(fields=['multi_conversation', 'level', 'recipient'], name='postman_msg_multiconv_idx'),
+            # the direct replies by email
+            models.Index(fields=['direct_reply_hash'], name='postman_msg_reply_hash_idx'),
+        ]
 
     def __str__(self):
         return "{0}:: {1}>{2}:{3}".format(self.id, self.obfuscated_sender, self.obfuscated_recipient, Truncator(self.subject).words(5))
@@ -381,9 +705,11 @@ class Message(AttachableObjectModel, LastVisitedMixin, MultiConversationModel):
     
     @property
     def better_count(self):
-        """ Expensive, but conversation-accurate message count for this thread. """
+        """ Conversation-accurate message count for this thread. Expensive, unless annotated by the folder queryset. """
         if not self.thread_id:
             return 0
+        if getattr(self, 'thread_count', None) is not None:
+            return self.thread_count
         return self._meta.model.objects.filter(thread_id=self.thread_id).count()
 
     def _obfuscated_email(self):
@@ -604,6 +930,349 @@ class Message(AttachableObjectModel, LastVisitedMixin, MultiConversationModel):
             self.moderation_reason = final_reason
 
 
+class ConversationIndexManager(models.Manager):
+    """The manager for ConversationIndex."""
+
+    def refresh(self, user, conversation_ids):
+        """
+        Recompute the entries of a user for some conversations, in all folders.
+
+        Arguments:
+        ``user``: a user or a user id
+        ``conversation_ids``: thread ids, or message ids for standalone messages
+
+        """
+        if not conversation_ids or user is None:
+            return
+        user_id = getattr(user, 'pk', user)
+        conversation_ids = list(conversation_ids)
+        entries = []
+        for folder, __ in FOLDER_CHOICES:
+            lookups = Message.objects._folder_lookups(Message.objects.folder_filters(folder, user_id))
+            rows = list(Message.objects.filter(lookups)\
+                .filter(models.Q(thread__in=conversation_ids) | models.Q(thread__isnull=True, pk__in=conversation_ids))\
+                .annotate(conversation=Coalesce('thread_id', 'id', output_field=models.IntegerField()))\
+                .values('conversation')\
+                .annotate(last_id=models.Max('pk'), message_count=models.Count('pk'),
+                          unread_count=models.Count('pk', filter=models.Q(recipient=user_id, read_at__isnull=True)))\
+                .order_by())
+            last_messages = Message.objects.select_related('thread').in_bulk([row['last_id'] for row in rows])
+            for row in rows:
+                message = last_messages[row['last_id']]
+                if message.thread_id and not message.master_for_sender and message.thread.sender_id == user_id:
+                    # same as the master filter of the folders: the conversation initiator only sees it
+                    # through the master_for_sender messages
+                    continue
+                entries.append(self.model(
+                    user_id=user_id,
+                    conversation_id=row['conversation'],
+                    folder=folder,
+                    last_message=message,
+                    sent_at=message.sent_at,
+                    count=row['message_count'] if message.thread_id else 0,
+                    unread_count=row['unread_count'],
+                ))
+        with transaction.atomic():
+            self.filter(user_id=user_id, conversation_id__in=conversation_ids).delete()
+            self.bulk_create(entries)
+
+    def refresh_for_messages(self, messages):
+        """
+        Recompute the entries of the senders and recipients of some messages for their conversations.
+        """
+        affected = {}
+        for message in messages:
+            for user_id in (message.sender_id, message.recipient_id):
+                if user_id is not None:
+                    affected.setdefault(user_id, set()).add(message.thread_id or message.pk)
+        # always in the same order, to not deadlock with concurrent refreshes
+        for user_id in sorted(affected):
+            self.refresh(user_id, affected[user_id])
+
+    def rebuild(self, user):
+        """
+        Recompute all the entries of a user.
+        """
+        user_id = getattr(user, 'pk', user)
+        conversation_ids = get_conversation_ids(Message.objects.filter(models.Q(sender=user_id) | models.Q(recipient=user_id)))
+        with transaction.atomic():
+            self.filter(user_id=user_id).exclude(conversation_id__in=conversation_ids).delete()
+            self.refresh(user_id, conversation_ids)
+
+
+class ConversationIndex(models.Model):
+    """
+    A denormalized entry of a conversation (or standalone message) in a folder of a user.
+
+    The by-conversation folders are read from these entries instead of aggregating over all the messages
+    of the user, if the POSTMAN_CONVERSATION_INDEX setting is enabled. The entries are kept up to date
+    wherever messages are sent, read, archived, deleted or undeleted.
+    A conversation may be listed in several folders of a user at the same time, e.g. when a new message
+    arrives in an archived conversation, so there is one entry per folder.
+
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='postman_conversation_index', on_delete=models.CASCADE)
+    conversation_id = models.PositiveIntegerField(help_text='The thread id, or the message id for a standalone message')
+    folder = models.CharField(max_length=8, choices=FOLDER_CHOICES)
+    last_message = models.ForeignKey(Message, related_name='conversation_index_entries', on_delete=models.CASCADE,
+        help_text='The most recent message of the conversation in this folder')
+    sent_at = models.DateTimeField(help_text='Copy of the sent_at of the last message, for the ordering')
+    count = models.PositiveIntegerField(default=0, help_text='The number of messages of the conversation in this folder, 0 for a standalone message')
+    unread_count = models.PositiveIntegerField(default=0)
+
+    objects = ConversationIndexManager()
+
+    class Meta(object):
+        unique_together = (('user', 'conversation_id', 'folder'),)
+        indexes = [models.Index(fields=['user', 'folder', 'sent_at'], name='postman_convindex_folder_idx')]
+
+    def __str__(self):
+        return 'ConversationIndex <{0}>: user {1}, conversation {2} in {3}'.format(self.pk, self.user_id, self.conversation_id, self.folder)
+
+
+class FolderCountersManager(models.Manager):
+    """The manager for FolderCounters."""
+
+    def _cache_key(self, user_id):
+        return POSTMAN_FOLDER_COUNTERS_CACHE_KEY % {'user_id': user_id}
+
+    def _invalidate(self, user_ids):
+        """Drop the cached counts of users, once the changes are committed."""
+        keys = [self._cache_key(user_id) for user_id in user_ids]
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+    def count_for_user(self, user):
+        """
+        Count the unread messages and the messages of the folders of a user, in one query.
+        """
+        user_id = getattr(user, 'pk', user)
+        folders = {}
+        for folder, __ in FOLDER_CHOICES:
+            folders[folder] = Message.objects._folder_lookups(Message.objects.folder_filters(folder, user_id))
+        return Message.objects.filter(models.Q(sender=user_id) | models.Q(recipient=user_id))\
+            .filter(Message.objects._master_lookups(user_id))\
+            .aggregate(
+                unread_count=models.Count('pk', filter=folders[FOLDER_INBOX] & models.Q(read_at__isnull=True)),
+                inbox_count=models.Count('pk', filter=folders[FOLDER_INBOX]),
+                archives_count=models.Count('pk', filter=folders[FOLDER_ARCHIVES]),
+                trash_count=models.Count('pk', filter=folders[FOLDER_TRASH]),
+            )
+
+    def recount(self, user):
+        """
+        Recount and store the counters of a user.
+        @return: the counts as a dict
+        """
+        user_id = getattr(user, 'pk', user)
+        counts = self.count_for_user(user_id)
+        self.update_or_create(user_id=user_id, defaults=counts)
+        self._invalidate([user_id])
+        return counts
+
+    def get_counts(self, user):
+        """
+        Return the counters of a user as a dict, from the cache if possible.
+        Counters that do not exist yet are counted.
+        """
+        key = self._cache_key(user.pk)
+        counts = cache.get(key)
+        if counts is None:
+            counts = self.filter(user=user).values(*FOLDER_COUNTER_FIELDS).first() or self.recount(user)
+            cache.set(key, counts, POSTMAN_FOLDER_COUNTERS_CACHE_TIMEOUT)
+        return counts
+
+    def add_sent(self, messages):
+        """
+        Count newly sent messages in the counters of their recipients, and recount the counters of their senders.
+        """
+        deltas = {}
+        sender_ids = set()
+        for message in messages:
+            if message.sender_id is not None:
+                sender_ids.add(message.sender_id)
+            if message.recipient_id is not None and message.is_accepted() \
+                    and not message.recipient_archived and not message.recipient_deleted_at:
+                inbox, unread = deltas.get(message.recipient_id, (0, 0))
+                deltas[message.recipient_id] = (inbox + 1, unread + (1 if message.read_at is None else 0))
+        # recipients of a multi conversation message all get the same increments, in a single update
+        by_delta = {}
+        for user_id, delta in deltas.items():
+            by_delta.setdefault(delta, []).append(user_id)
+        for (inbox, unread), user_ids in by_delta.items():
+            self.filter(user__in=user_ids).update(inbox_count=models.F('inbox_count') + inbox,
+                                                  unread_count=models.F('unread_count') + unread)
+        self._invalidate(deltas.keys())
+        for user_id in sorted(sender_ids - set(deltas)):
+            self.recount(user_id)
+
+    def reconcile(self, users=None):
+        """
+        Recount the stored counters, of all users or only of the given ones.
+        @return: a tuple of the number of counters checked and of those that were wrong
+        """
+        checked, fixed = 0, 0
+        qs = self.all() if users is None else self.filter(user__in=users)
+        for counters in qs.iterator():
+            with transaction.atomic():
+                counts = self.count_for_user(counters.user_id)
+                if any([getattr(counters, field) != counts[field] for field in FOLDER_COUNTER_FIELDS]):
+                    self.filter(pk=counters.pk).update(**counts)
+                    self._invalidate([counters.user_id])
+                    fixed += 1
+                self.filter(pk=counters.pk).update(reconciled_at=now())
+            checked += 1
+        return checked, fixed
+
+
+class FolderCounters(models.Model):
+    """
+    The number of unread messages and the number of messages in the folders of a user, counted by message.
+
+    These are read instead of counting the messages, if the POSTMAN_FOLDER_COUNTERS setting is enabled,
+    for the unread badge shown on every page. The counters of recipients are incremented on send,
+    all others are recounted whenever messages of the user are read, archived, deleted or undeleted.
+    They are created on first use and regularly reconciled with the messages, see folder_counters_enabled().
+
+    """
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, primary_key=True, related_name='postman_folder_counters',
+        on_delete=models.CASCADE)
+    unread_count = models.IntegerField(default=0)
+    inbox_count = models.IntegerField(default=0)
+    archives_count = models.IntegerField(default=0)
+    trash_count = models.IntegerField(default=0)
+    reconciled_at = models.DateTimeField(default=now)
+
+    objects = FolderCountersManager()
+
+    class Meta(object):
+        verbose_name_plural = 'folder counters'
+
+    def __str__(self):
+        return 'FolderCounters: user {0}, {1} unread'.format(self.user_id, self.unread_count)
+
+
+class OutgoingMessageManager(models.Manager):
+    """The manager for OutgoingMessage."""
+
+    def create_outgoing(self, template, recipients, multi_conversation, level, parent=None, notify=True):
+        """
+        Store a multi-conversation message to be fanned out later to its recipients.
+
+        The arguments are those of MessageManager.bulk_fan_out().
+        """
+        outgoing = self.create(sender=template.sender, subject=template.subject, body=template.body,
+            multi_conversation=multi_conversation, level=level, parent=parent, notify=notify,
+            recipient_count=len(recipients))
+        outgoing.recipients.add(*recipients)
+        return outgoing
+
+    def in_progress(self, user):
+        """
+        Return the outgoing messages of a user that are not completely sent, to show their progress.
+        """
+        return self.filter(sender=user).exclude(status=OUTGOING_SENT).order_by('created_at')
+
+    def send_pending(self, batch_size, site=None, limit=None):
+        """
+        Send the pending outgoing messages, batch by batch, oldest first.
+
+        Each batch is sent in its own transaction, together with the update of the progress,
+        so the sending can be interrupted and resumed at any time, and run by concurrent workers.
+        A message that fails is marked as failed and skipped.
+
+        Return the number of messages sent.
+
+        """
+        skip_locked = connections[self.db].features.has_select_for_update_skip_locked
+        count = 0
+        while limit is None or count < limit:
+            size = batch_size if limit is None else min(batch_size, limit - count)
+            outgoing = None
+            try:
+                with transaction.atomic():
+                    outgoing = self.select_for_update(skip_locked=skip_locked)\
+                        .filter(status=OUTGOING_PENDING).order_by('created_at', 'pk').first()
+                    if not outgoing:
+                        break
+                    count += len(outgoing.send_batch(size, site))
+            except Exception as e:
+                if outgoing is None:
+                    raise
+                logger.exception('Sending the outgoing postman message %s failed.', outgoing.pk)
+                self.filter(pk=outgoing.pk).update(status=OUTGOING_FAILED, error=force_text(e))
+        return count
+
+
+class OutgoingMessage(AttachableObjectModel):
+    """
+    A multi-conversation message accepted from its sender, but not yet fanned out to its recipients.
+
+    If the POSTMAN_SEND_LATER_THRESHOLD setting is set, messages to that many recipients or more are stored
+    as an OutgoingMessage in the request. The postman_send_outgoing command (see send_later_enabled()
+    for its scheduling) then saves the messages of the recipients by batches,
+    with MessageManager.bulk_fan_out(), and links the attachments to them.
+    The sender sees the progress in the folders until it is done.
+
+    """
+    sender = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='postman_outgoing_messages', on_delete=models.CASCADE)
+    subject = models.CharField(max_length=Message.SUBJECT_MAX_LENGTH)
+    body = models.TextField(blank=True)
+    recipients = models.ManyToManyField(settings.AUTH_USER_MODEL, related_name='+')
+    multi_conversation = models.ForeignKey(MultiConversation, on_delete=models.CASCADE)
+    level = models.IntegerField(default=0)
+    parent = models.ForeignKey(Message, null=True, blank=True, related_name='+', on_delete=models.CASCADE)
+    notify = models.BooleanField(default=True)
+    status = models.CharField(max_length=1, choices=OUTGOING_STATUS_CHOICES, default=OUTGOING_PENDING)
+    recipient_count = models.IntegerField(default=0)
+    sent_count = models.IntegerField(default=0, help_text='Number of recipients the message was sent to')
+    last_recipient_pk = models.IntegerField(null=True, blank=True,
+        help_text='Id of the last recipient the message was sent to, the recipients are sent to in order of their ids')
+    created_at = models.DateTimeField(default=now, help_text='Used as the sent_at of the messages')
+    finished_at = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+
+    objects = OutgoingMessageManager()
+
+    def __str__(self):
+        return 'OutgoingMessage: {0}, {1} of {2} sent'.format(self.subject, self.sent_count, self.recipient_count)
+
+    def is_failed(self):
+        """Tell if the sending failed."""
+        return self.status == OUTGOING_FAILED
+
+    def send_batch(self, batch_size, site=None):
+        """
+        Send the message to the next batch of recipients. To be called in a transaction.
+
+        Return the list of saved messages.
+        """
+        recipients = self.recipients.order_by('pk')
+        if self.last_recipient_pk is not None:
+            # not an offset, recipients deleted in the meantime would make it skip others
+            recipients = recipients.filter(pk__gt=self.last_recipient_pk)
+        recipients = list(recipients[:batch_size])
+        template = Message(sender=self.sender, subject=self.subject, body=self.body, sent_at=self.created_at)
+        messages = Message.objects.bulk_fan_out(template, recipients, self.multi_conversation, self.level,
+            parent=self.parent, site=site, notify=self.notify, has_master=self.sent_count > 0) if recipients else []
+        attached_objects = list(self.attached_objects.all())
+        if attached_objects:
+            Through = Message.attached_objects.through
+            Through.objects.bulk_create([Through(message_id=message.pk, attachedobject_id=attached_object.pk)
+                for message in messages for attached_object in attached_objects])
+            # attachments are private, tag the recipients so they can see them
+            for attached_object in attached_objects:
+                attached_object.target_object.media_tag.persons.add(*recipients)
+        Message.objects.refresh_folders_for_sent(messages)
+        self.sent_count += len(recipients)
+        if recipients:
+            self.last_recipient_pk = recipients[-1].pk
+        if len(recipients) < batch_size or not self.recipients.filter(pk__gt=self.last_recipient_pk).exists():
+            self.status = OUTGOING_SENT
+            self.finished_at = now()
+        self.save()
+        return messages
+
+
 class PendingMessageManager(models.Manager):
     """The manager for PendingMessage."""
 
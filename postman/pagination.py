@@ -0,0 +1,65 @@
+"""
+Keyset (cursor) pagination of the folders.
+
+A page is fetched by comparing with the (sent_at, id) of the last message of the previous page,
+instead of skipping an offset, so any page costs the same as the first one and no total count
+is needed. This requires the default ordering of the folders, by descending (sent_at, id).
+"""
+from __future__ import unicode_literals
+import base64
+import binascii
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+# query string keys of the cursors to the older and newer pages
+CURSOR_AFTER_KEY = 'after'
+CURSOR_BEFORE_KEY = 'before'
+
+
+def encode_cursor(message):
+    """Return an opaque token of the position of a message."""
+    value = '{0}|{1}'.format(message.sent_at.isoformat(), message.pk)
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """Return the (sent_at, id) position of a token, or None for an invalid token."""
+    try:
+        value = base64.urlsafe_b64decode((token + '=' * (-len(token) % 4)).encode()).decode()
+        sent_at, pk = value.split('|')
+        sent_at = parse_datetime(sent_at)
+        return (sent_at, int(pk)) if sent_at else None
+    except (ValueError, TypeError, binascii.Error, UnicodeDecodeError):
+        return None
+
+
+def get_keyset_page(qs, query_dict, page_size):
+    """
+    Return a page of a queryset ordered by descending (sent_at, id), positioned by the cursors found in a query dict.
+
+    Return a tuple of the list of messages, the token to the newer page and the token to the older page.
+    The tokens are None if there is no such page.
+
+    """
+    # compare with the copy of sent_at in the conversation index, if the folder is read from it
+    field = 'index_sent_at' if 'index_sent_at' in qs.query.annotations else 'sent_at'
+    before = decode_cursor(query_dict.get(CURSOR_BEFORE_KEY, ''))
+    after = decode_cursor(query_dict.get(CURSOR_AFTER_KEY, ''))
+    if before:
+        sent_at, pk = before
+        rows = list(qs.filter(Q(**{field + '__gt': sent_at}) | Q(**{field: sent_at, 'pk__gt': pk})).reverse()[:page_size + 1])
+        has_newer = len(rows) > page_size
+        rows = list(reversed(rows[:page_size]))
+        has_older = True
+    else:
+        if after:
+            sent_at, pk = after
+            qs = qs.filter(Q(**{field + '__lt': sent_at}) | Q(**{field: sent_at, 'pk__lt': pk}))
+        rows = list(qs[:page_size + 1])
+        has_older = len(rows) > page_size
+        rows = rows[:page_size]
+        has_newer = bool(after)
+    if not rows:
+        return rows, None, None
+    return rows, encode_cursor(rows[0]) if has_newer else None, encode_cursor(rows[-1]) if has_older else None
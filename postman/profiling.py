@@ -0,0 +1,179 @@
+"""
+Profiling of management commands.
+
+Commands derived from ProfilableCommand accept a --profile option, which runs them under a CommandProfiler
+and writes its report into --profile-dir. Applications building on postman can record more kinds of calls
+by subclassing CommandProfiler and setting it as the profiler_class of their commands.
+"""
+from __future__ import unicode_literals
+from contextlib import contextmanager
+import cProfile
+import io
+import json
+import os
+import pstats
+from threading import Lock
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.utils.timezone import now
+
+# the number of functions listed in the report, by cumulative time
+PROFILE_REPORT_TOP_FUNCTIONS = 40
+
+
+class CommandProfiler(object):
+    """
+    Collect a profile of a management command run.
+
+    The profile holds the cProfile stats of the main thread, the wall time of named phases,
+    and the database query counts and times by statement type, which are recorded for all threads.
+
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.profile = cProfile.Profile()
+        self.phases = []
+        self.queries = {}
+        self._lock = Lock()
+        self._started = None
+        self.total_time = None
+
+    def start(self):
+        self._started = time.time()
+        for connection in connections.all():
+            self._install_query_wrapper(connection)
+        connection_created.connect(self._on_connection_created)
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self.total_time = time.time() - self._started
+        connection_created.disconnect(self._on_connection_created)
+        for connection in connections.all():
+            if self._record_query in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self._record_query)
+
+    @contextmanager
+    def phase(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.time() - started))
+
+    def _on_connection_created(self, sender, connection, **kwargs):
+        # connections are per thread, this also covers those opened by worker threads
+        self._install_query_wrapper(connection)
+
+    def _install_query_wrapper(self, connection):
+        if self._record_query not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self._record_query)
+
+    def get_query_kind(self, sql):
+        """Return the key under which a query is counted: the statement type."""
+        return sql.lstrip().split(' ', 1)[0].lower() or 'other'
+
+    def _record_query(self, execute, sql, params, many, context):
+        started = time.time()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.add(self.queries, self.get_query_kind(sql), time.time() - started)
+
+    def add(self, stats, key, duration):
+        """Count a call and its duration under a key of the stats. Thread-safe."""
+        with self._lock:
+            entry = stats.setdefault(key, {'count': 0, 'time': 0.0})
+            entry['count'] += 1
+            entry['time'] += duration
+
+    def summarize(self, stats):
+        return {
+            'count': sum([entry['count'] for entry in stats.values()]),
+            'time': sum([entry['time'] for entry in stats.values()]),
+            'by_type': dict(sorted(stats.items(), key=lambda item: -item[1]['time'])),
+        }
+
+    def get_top_functions(self):
+        top = []
+        stats = pstats.Stats(self.profile, stream=io.StringIO())
+        entries = sorted(stats.stats.items(), key=lambda item: -item[1][3])
+        for (filename, lineno, function), (__, calls, total, cumulative, __) in entries[:PROFILE_REPORT_TOP_FUNCTIONS]:
+            top.append({
+                'function': '{0}:{1}({2})'.format(filename, lineno, function),
+                'calls': calls,
+                'total_time': total,
+                'cumulative_time': cumulative,
+            })
+        return top
+
+    def get_report(self, options=None):
+        return {
+            'command': self.name,
+            'options': dict([(key, value) for key, value in (options or {}).items()
+                             if isinstance(value, (str, int, float, bool, list, type(None)))]),
+            'total_time': self.total_time,
+            'phases': [{'name': name, 'time': duration} for name, duration in self.phases],
+            'db_queries': self.summarize(self.queries),
+            'top_functions': self.get_top_functions(),
+        }
+
+    def dump(self, directory, options=None):
+        """
+        Write the report as JSON and the cProfile stats as .pstats file into the given directory.
+
+        Return the paths of the JSON report and the .pstats file.
+
+        """
+        base_path = os.path.join(directory, '{0}-{1}'.format(self.name, now().strftime('%Y%m%d-%H%M%S')))
+        self.profile.dump_stats(base_path + '.pstats')
+        with open(base_path + '.json', 'w') as report_file:
+            json.dump(self.get_report(options), report_file, indent=2)
+        return base_path + '.json', base_path + '.pstats'
+
+
+class ProfilableCommand(BaseCommand):
+    """
+    Base class for management commands that adds a --profile option.
+
+    The option runs the command under a profiler_class instance and writes its report into --profile-dir.
+    Commands can mark phases of their run with `with self.profile_phase('name'): ...`.
+
+    """
+    profiler_class = CommandProfiler
+    profiler = None
+
+    def create_parser(self, prog_name, subcommand, **kwargs):
+        parser = super(ProfilableCommand, self).create_parser(prog_name, subcommand, **kwargs)
+        parser.add_argument('--profile', action='store_true',
+                            help='Profile the command and write a JSON report and a .pstats file')
+        parser.add_argument('--profile-dir', default='.', help='Directory for the profiling output (default: current directory)')
+        return parser
+
+    def execute(self, *args, **options):
+        if not options.get('profile'):
+            return super(ProfilableCommand, self).execute(*args, **options)
+
+        name = self.__class__.__module__.rsplit('.', 1)[-1]
+        self.profiler = self.profiler_class(name)
+        self.profiler.start()
+        try:
+            return super(ProfilableCommand, self).execute(*args, **options)
+        finally:
+            self.profiler.stop()
+            json_path, pstats_path = self.profiler.dump(options.get('profile_dir') or '.', options)
+            self.stderr.write('Profile written to {0} and {1}'.format(json_path, pstats_path))
+            self.profiler = None
+
+    @contextmanager
+    def profile_phase(self, name):
+        """Record the wall time of a phase of the command if it is being profiled."""
+        if self.profiler is None:
+            yield
+            return
+        with self.profiler.phase(name):
+            yield
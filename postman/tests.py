@@ -35,8 +35,10 @@ from __future__ import unicode_literals
 from builtins import str
 import copy
 from datetime import datetime, timedelta
+import random
 import re
 import sys
+from unittest import skipUnless
 
 from django.conf import settings
 from django.contrib.auth import REDIRECT_FIELD_NAME
@@ -47,12 +49,15 @@ except ImportError:
 from django.contrib.auth.models import AnonymousUser
 from django.contrib.sites.models import Site
 from django.core import mail
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.urls import reverse, clear_url_caches, get_resolver, get_urlconf
-from django.db.models import Q
+from django.db import connection
+from django.db.models import F, Q
 from django.http import QueryDict
 from django.template import Template, Context, TemplateSyntaxError, TemplateDoesNotExist
 from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils.encoding import force_text
 from django.utils.formats import localize
 from django.utils import six
@@ -67,9 +72,11 @@ from . import OPTION_MESSAGES
 from .api import pm_broadcast, pm_write
 # because of reload()'s, do "from postman.fields import CommaSeparatedUserField" just before needs
 # because of reload()'s, do "from postman.forms import xxForm" just before needs
-from .models import ORDER_BY_KEY, ORDER_BY_MAPPER, Message, PendingMessage,\
+from .models import ORDER_BY_KEY, ORDER_BY_MAPPER, Message, PendingMessage, ConversationIndex, FolderCounters, MultiConversation,\
+        OutgoingMessage, OUTGOING_PENDING, OUTGOING_SENT,\
         STATUS_PENDING, STATUS_ACCEPTED, STATUS_REJECTED,\
         get_order_by, get_user_representation, get_user_name
+from .pagination import decode_cursor, encode_cursor, get_keyset_page
 # because of reload()'s, do "from postman.utils import notification" just before needs
 from .utils import format_body, format_subject
 
@@ -263,6 +270,31 @@ class ViewTest(BaseTest):
         url = reverse('postman:' + action + '_template', args=args)
         self.assertRaises(TemplateDoesNotExist, self.client.get, url)
 
+    def test_folder_query_budget(self):
+        "Test that the number of queries of a folder page does not grow with its number of rows."
+        def create_conversations(n):
+            for i in range(n):
+                m1 = self.c12()
+                m1.thread = m1; m1.save()
+                self.c12(parent=m1, thread=m1)
+                multi_conversation = MultiConversation.objects.create()
+                multi_conversation.participants.set([self.user1, self.user2, self.user3])
+                self.c12(multi_conversation=multi_conversation)
+        url = reverse('postman:inbox')
+        self.assertTrue(self.client.login(username='bar', password='pass'))
+        create_conversations(2)
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(url)
+        create_conversations(8)
+        with self.assertNumQueries(len(context)):
+            response = self.client.get(url)
+        msgs = list(response.context['pm_messages'])
+        self.assertEqual(len(msgs), 20)
+        with self.assertNumQueries(0):
+            self.assertEqual(sorted(m.better_count for m in msgs), [0] * 10 + [2] * 10)
+            for m in msgs:
+                m.other_participants(self.user2)
+
     def test_template(self):
         "Test the 'template_name' parameter."
         m1 = self.c12()
@@ -408,6 +440,67 @@ class ViewTest(BaseTest):
         self.assertTrue(self.client.login(username='foo', password='pass'))
         self.check_write_post()
 
+    @skipUnless(connection.features.can_return_rows_from_bulk_insert, "needs the primary keys of bulk inserted rows")
+    def test_write_post_bulk_fan_out(self):
+        "Test that a multi-conversation message saved in bulk matches the one saved per recipient."
+        url = reverse('postman:write')
+        data = {'subject': 's', 'body': 'b', 'recipients': '{0}, {1}'.format(self.user2.get_username(), self.user3.get_username())}
+        fields = ('sender', 'recipient', 'level', 'master_for_sender', 'moderation_status', 'thread', 'parent')
+        self.assertTrue(self.client.login(username='foo', password='pass'))
+        self.client.post(url, data)
+        expected = list(Message.objects.order_by('recipient').values_list(*fields))
+        Message.objects.all().delete()
+        with self.settings(POSTMAN_BULK_FANOUT_THRESHOLD=2):
+            self.client.post(url, data)
+        self.assertEqual(list(Message.objects.order_by('recipient').values_list(*fields)), expected)
+        self.assertEqual(len(set(Message.objects.values_list('direct_reply_hash', flat=True))), 2)
+        # a reply to all, from one of the recipients
+        m2 = Message.objects.get(recipient=self.user2)
+        m3 = Message.objects.get(recipient=self.user3)
+        replies = Message.objects.bulk_fan_out(Message(sender=self.user2, subject='s', body='b', moderation_status=STATUS_ACCEPTED),
+            [self.user1, self.user3], m2.multi_conversation, 1, parent=m2, notify=False)
+        self.assertEqual([(r.parent_id, r.thread_id, r.master_for_sender) for r in replies], [(m2.pk, m2.pk, True), (m3.pk, m3.pk, False)])
+        self.assertEqual(Message.objects.filter(thread__isnull=False).count(), 4)
+
+    @skipUnless(connection.features.can_return_rows_from_bulk_insert, "needs the primary keys of bulk inserted rows")
+    def test_write_post_send_later(self):
+        "Test that a message to many recipients is stored, then sent by batches in the background."
+        url = reverse('postman:write')
+        data = {'subject': 's', 'body': 'b', 'recipients': '{0}, {1}'.format(self.user2.get_username(), self.user3.get_username())}
+        self.assertTrue(self.client.login(username='foo', password='pass'))
+        with self.settings(POSTMAN_SEND_LATER_THRESHOLD=2):
+            self.client.post(url, data)
+            self.assertFalse(Message.objects.exists())
+            outgoing = OutgoingMessage.objects.get()
+            self.assertEqual((outgoing.sender, outgoing.recipient_count, outgoing.status), (self.user1, 2, OUTGOING_PENDING))
+            response = self.client.get(reverse('postman:sent'))
+            self.assertEqual(list(response.context['pm_outgoing_messages']), [outgoing])
+            self.assertEqual(OutgoingMessage.objects.send_pending(1, limit=1), 1)
+            self.assertEqual(OutgoingMessage.objects.get().sent_count, 1)
+            self.assertEqual(OutgoingMessage.objects.send_pending(1), 1)
+            self.assertEqual(OutgoingMessage.objects.get().status, OUTGOING_SENT)
+            response = self.client.get(reverse('postman:sent'))
+            self.assertEqual(list(response.context['pm_outgoing_messages']), [])
+        self.assertEqual(sorted(Message.objects.values_list('recipient', 'master_for_sender')), [(self.user2.pk, True), (self.user3.pk, False)])
+        self.assertEqual(set(Message.objects.values_list('sent_at', flat=True)), set([outgoing.created_at]))
+
+    @skipUnless(connection.features.can_return_rows_from_bulk_insert, "needs the primary keys of bulk inserted rows")
+    def test_send_later_recipient_deleted(self):
+        "Test that a recipient deleted while a message is being sent makes no other recipient be skipped."
+        user4 = get_user_model().objects.create_user('qux', 'qux@domain.com', 'pass')
+        url = reverse('postman:write')
+        data = {'subject': 's', 'body': 'b', 'recipients': ', '.join(
+            [user.get_username() for user in (self.user2, self.user3, user4)])}
+        self.assertTrue(self.client.login(username='foo', password='pass'))
+        with self.settings(POSTMAN_SEND_LATER_THRESHOLD=2):
+            self.client.post(url, data)
+            self.assertEqual(OutgoingMessage.objects.send_pending(1, limit=1), 1)
+            self.user2.delete()
+            self.assertEqual(OutgoingMessage.objects.send_pending(1), 2)
+        outgoing = OutgoingMessage.objects.get()
+        self.assertEqual((outgoing.status, outgoing.sent_count, outgoing.last_recipient_pk), (OUTGOING_SENT, 3, user4.pk))
+        self.assertEqual(sorted(Message.objects.values_list('recipient', flat=True)), [self.user3.pk, user4.pk])
+
     def test_write_post_multirecipient(self):
         "Test number of recipients constraint."
         from postman.fields import CommaSeparatedUserField
@@ -792,6 +885,32 @@ class ViewTest(BaseTest):
         response = self.client.get(url)
         self.assertEqual(len(response.context['pm_messages']), 2)
 
+    def test_view_conversation_window(self):
+        "Test the window of the latest messages, the chunks of older messages and set-as-read."
+        m1 = self.c12()
+        m1.thread = m1; m1.save()
+        msgs = [m1] + [self.c12(parent=m1, thread=m1) for i in range(4)]
+        url = reverse('postman:view_conversation', args=[m1.pk])
+        self.assertTrue(self.client.login(username='bar', password='pass'))
+        with self.settings(POSTMAN_CONVERSATION_WINDOW=2):
+            response = self.client.get(url)
+            self.assertEqual([m.pk for m in response.context['pm_messages']], [m.pk for m in msgs[3:]])
+            self.assertEqual(response.context['reply_to_pk'], msgs[4].pk)
+            self.assertEqual(Message.objects.filter(recipient=self.user2, read_at__isnull=True).count(), 3)
+            response = self.client.get(response.context['pm_older_url'])
+            self.assertTemplateUsed(response, 'postman/inc_conversation_messages.html')
+            self.assertEqual([m.pk for m in response.context['pm_messages']], [m.pk for m in msgs[1:3]])
+            response = self.client.get(response.context['pm_older_url'])
+            self.assertEqual([m.pk for m in response.context['pm_messages']], [m1.pk])
+            self.assertIsNone(response.context['pm_older_url'])
+            self.assertEqual(Message.objects.filter(recipient=self.user2, read_at__isnull=True).count(), 0)
+            # a cursor is required
+            self.check_404('postman:view_conversation_older', m1.pk)
+        # not yours
+        self.assertTrue(self.client.login(username='baz', password='pass'))
+        with self.settings(POSTMAN_CONVERSATION_WINDOW=2):
+            self.check_view_conversation_404(m1.pk)
+
     def check_update(self, view_name, success_msg, field_bit, pk, field_value=None):
         "Check permission, redirection, field updates, invalid cases."
         url = reverse(view_name)
@@ -1030,6 +1149,63 @@ class MessageManagerTest(BaseTest):
         self.assertEqual(qs.count(), 1)  # param '*', must stay at the beginning
         self.assertListEqual(list(qs.filter(recipient_id=2)), [m])  # param 2, must stay at the end
 
+    def test_legacy_folder_query(self):
+        "Test that the subquery and the legacy implementations of the folders give the same conversations."
+        m1 = self.c12()
+        m1.thread = m1; m1.save()
+        m2 = self.c21(parent=m1, thread=m1)
+        m3 = self.c12(parent=m2, thread=m1, sender_archived=True)
+        m4 = self.c12()
+        m5 = self.c21(recipient_deleted_at=now())
+        def pk_cnt(x): return (x.pk, x.count)
+        for folder in ('inbox', 'sent', 'archives', 'trash'):
+            for u in (self.user1, self.user2):
+                qs = getattr(Message.objects, folder)(u)
+                with self.settings(POSTMAN_LEGACY_FOLDER_QUERY=True):
+                    self.assertQuerysetEqual(getattr(Message.objects, folder)(u), [pk_cnt(m) for m in qs], transform=pk_cnt)
+                self.assertEqual(qs.count(), len(qs))
+
+    def test_conversation_index(self):
+        "Test that the folders read from the conversation index match the aggregated ones."
+        m1 = self.c12()
+        m1.thread = m1; m1.save()
+        m2 = self.c21(parent=m1, thread=m1)
+        m3 = self.c12(parent=m2, thread=m1)
+        m4 = self.c12()
+        m5 = self.c21(recipient_archived=True)
+        m6 = self.c12(sender_deleted_at=now())
+        def pk_cnt(x): return (x.pk, x.count)
+        folders = ('inbox', 'sent', 'archives', 'trash')
+        expected = dict([((folder, u.pk), [pk_cnt(m) for m in getattr(Message.objects, folder)(u)])
+            for folder in folders for u in (self.user1, self.user2)])
+        for u in (self.user1, self.user2):
+            ConversationIndex.objects.rebuild(u)
+        with self.settings(POSTMAN_CONVERSATION_INDEX=True):
+            for folder in folders:
+                for u in (self.user1, self.user2):
+                    self.assertQuerysetEqual(getattr(Message.objects, folder)(u), expected[(folder, u.pk)], transform=pk_cnt)
+            self.assertEqual(ConversationIndex.objects.get(user=self.user2, folder='inbox', conversation_id=m1.pk).unread_count, 2)
+            self.assertEqual(Message.objects.set_read(self.user2, Q(thread=m1.pk)), 2)
+            self.assertEqual(ConversationIndex.objects.get(user=self.user2, folder='inbox', conversation_id=m1.pk).unread_count, 0)
+        self.assertQuerysetEqual(ConversationIndex.objects.filter(user=self.user1, conversation_id=m6.pk).values_list('folder', flat=True), ['trash'], transform=str)
+
+    def test_folder_counters(self):
+        "Test that the folder counters follow sending, reading and archiving, and match a recount."
+        cache.clear()
+        with self.settings(POSTMAN_FOLDER_COUNTERS=True):
+            self.assertEqual(Message.objects.inbox_unread_count(self.user2), 0)
+            messages = [self.c12(), self.c13(), self.c12(read_at=now())]
+            Message.objects.refresh_folders_for_sent(messages)
+            self.assertEqual(Message.objects.inbox_unread_count(self.user2), 1)
+            self.assertEqual(FolderCounters.objects.get_counts(self.user2)['inbox_count'], 2)
+            self.assertEqual(Message.objects.set_read(self.user2, Q(pk=messages[0].pk)), 1)
+            self.assertEqual(Message.objects.inbox_unread_count(self.user2), 0)
+            Message.objects.filter(pk=messages[2].pk).update(recipient_archived=True)
+            Message.objects.refresh_folders(self.user2, Q(pk=messages[2].pk))
+            for user in (self.user1, self.user2, self.user3):
+                self.assertEqual(FolderCounters.objects.get_counts(user), FolderCounters.objects.count_for_user(user))
+            self.assertEqual(FolderCounters.objects.reconcile(), (3, 0))
+
     def test(self):
         """
               user1       user2
@@ -1158,6 +1334,72 @@ class MessageManagerTest(BaseTest):
         self.check_now(m.read_at)
 
 
+@skipUnless(connection.vendor == 'postgresql', "Query plans are only checked on PostgreSQL.")
+class QueryPlanTest(TestCase):
+    """
+    Test that the manager methods do not scan the whole message table, on a large amount of messages.
+    """
+    user_count = 200
+    message_count = 50000
+
+    @classmethod
+    def setUpTestData(cls):
+        rnd = random.Random(0)
+        user_model = get_user_model()
+        user_model.objects.bulk_create([user_model(username='user{0}'.format(i), email='user{0}@domain.com'.format(i))
+            for i in range(cls.user_count)])
+        user_ids = list(user_model.objects.values_list('id', flat=True))
+        cls.user = user_model.objects.get(id=user_ids[0])
+        cls.multi_conversation = MultiConversation.objects.create()
+
+        def message(i, **kwargs):
+            sender_id, recipient_id = rnd.sample(user_ids, 2)
+            kwargs.setdefault('sender_id', sender_id)
+            kwargs.setdefault('recipient_id', recipient_id)
+            return Message(subject='s', moderation_status=STATUS_ACCEPTED, direct_reply_hash='hash{0}'.format(i),
+                read_at=now() if i % 2 else None, sender_archived=i % 7 == 0, recipient_deleted_at=now() if i % 11 == 0 else None,
+                multi_conversation=cls.multi_conversation if i % 1000 == 0 else None, level=i % 5, **kwargs)
+        roots = Message.objects.bulk_create([message(i) for i in range(cls.message_count // 3)], batch_size=5000)
+        Message.objects.filter(pk__in=[root.pk for root in roots]).update(thread=F('pk'))
+        replies = []
+        for i in range(cls.message_count // 3, cls.message_count):
+            root = rnd.choice(roots)
+            replies.append(message(i, sender_id=root.recipient_id, recipient_id=root.sender_id, parent_id=root.pk, thread_id=root.pk))
+        Message.objects.bulk_create(replies, batch_size=5000)
+        cls.thread_id = roots[0].pk
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE {0}'.format(Message._meta.db_table))
+
+    def check_plan(self, qs):
+        plan = qs.explain()
+        self.assertIsNone(re.search(r'Seq Scan on {0}\b'.format(Message._meta.db_table), plan), plan)
+
+    def test_folders(self):
+        for folder in ('inbox', 'sent', 'archives', 'trash'):
+            for option in (None, OPTION_MESSAGES):
+                self.check_plan(getattr(Message.objects, folder)(self.user, option=option)[:50])
+
+    def test_inbox_unread_count(self):
+        self.check_plan(Message.objects.inbox(self.user, related=False, option=OPTION_MESSAGES).filter(read_at__isnull=True))
+
+    def test_thread(self):
+        self.check_plan(Message.objects.thread(self.user, Q(thread=self.thread_id)))
+        self.check_plan(Message.objects.thread(self.user, Q(pk=self.thread_id)))
+
+    def test_updates(self):
+        filter = Q(pk__in=[self.thread_id]) | Q(thread__in=[self.thread_id])
+        self.check_plan(Message.objects.as_recipient(self.user, filter))
+        self.check_plan(Message.objects.as_sender(self.user, filter))
+        self.check_plan(Message.objects.filter(Q(thread=self.thread_id), recipient=self.user,
+            moderation_status=STATUS_ACCEPTED, read_at__isnull=True))  # as in set_read()
+
+    def test_multi_conversation_parent(self):
+        self.check_plan(Message.objects.filter(multi_conversation=self.multi_conversation, level=0, recipient=self.user))
+
+    def test_direct_reply_hash(self):
+        self.check_plan(Message.objects.filter(direct_reply_hash='hash{0}'.format(self.message_count - 1)))
+
+
 class MessageTest(BaseTest):
     """
     Test the Message model.
@@ -1773,6 +2015,31 @@ class UtilsTest(BaseTest):
         self.assertEqual(get_user_name(self.user1), "foo@domain.com")
 
 
+class PaginationTest(BaseTest):
+    """
+    Test the keyset pagination.
+    """
+    def test_cursor(self):
+        m = self.c12()
+        self.assertEqual(decode_cursor(encode_cursor(m)), (m.sent_at, m.pk))
+        self.assertIsNone(decode_cursor('garbage'))
+        self.assertIsNone(decode_cursor(''))
+
+    def test_pages(self):
+        msgs = [self.c12() for i in range(5)]
+        expected = [m.pk for m in Message.objects.inbox(self.user2)]
+        rows, newer, older = get_keyset_page(Message.objects.inbox(self.user2), QueryDict(), 2)
+        self.assertEqual([m.pk for m in rows], expected[:2])
+        self.assertIsNone(newer)
+        rows, newer, older = get_keyset_page(Message.objects.inbox(self.user2), QueryDict('after=' + older), 2)
+        self.assertEqual([m.pk for m in rows], expected[2:4])
+        rows, newer, last = get_keyset_page(Message.objects.inbox(self.user2), QueryDict('after=' + older), 2)
+        self.assertEqual([m.pk for m in rows], expected[4:])
+        self.assertIsNone(last)
+        rows, newer, older = get_keyset_page(Message.objects.inbox(self.user2), QueryDict('before=' + newer), 2)
+        self.assertEqual([m.pk for m in rows], expected[2:4])
+
+
 class ApiTest(BaseTest):
     """
     Test the API functions.
@@ -93,7 +93,7 @@ from django.views.generic.base import RedirectView
 
 from . import OPTIONS
 from .views import (InboxView, SentView, ArchivesView, TrashView,
-        WriteView, ReplyView, MessageView, ConversationView,
+        WriteView, ReplyView, MessageView, ConversationView, ConversationOlderView,
         ArchiveView, DeleteView, UndeleteView)
 
 
@@ -106,6 +106,7 @@ urlpatterns = [
     url(r'^reply/(?P<message_id>[\d]+)/$', ReplyView.as_view(), name='reply'),
     url(r'^view/(?P<message_id>[\d]+)/$', MessageView.as_view(), name='view'),
     url(r'^view/t/(?P<thread_id>[\d]+)/$', ConversationView.as_view(), name='view_conversation'),
+    url(r'^view/t/(?P<thread_id>[\d]+)/older/$', ConversationOlderView.as_view(), name='view_conversation_older'),
     url(r'^archive/$', ArchiveView.as_view(), name='archive'),
     url(r'^delete/$', DeleteView.as_view(), name='delete'),
     url(r'^undelete/$', UndeleteView.as_view(), name='undelete'),
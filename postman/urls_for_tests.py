@@ -11,7 +11,7 @@ from django.views.generic.base import RedirectView
 
 from . import OPTIONS
 from .views import (InboxView, SentView, ArchivesView, TrashView,
-        WriteView, ReplyView, MessageView, ConversationView,
+        WriteView, ReplyView, MessageView, ConversationView, ConversationOlderView,
         ArchiveView, DeleteView, UndeleteView)
 from django.contrib.auth.views import LoginView
 
@@ -67,6 +67,7 @@ postman_patterns = [
     url(r'^reply/(?P<message_id>[\d]+)/$', ReplyView.as_view(), name='reply'),
     url(r'^view/(?P<message_id>[\d]+)/$', MessageView.as_view(), name='view'),
     url(r'^view/t/(?P<thread_id>[\d]+)/$', ConversationView.as_view(), name='view_conversation'),
+    url(r'^view/t/(?P<thread_id>[\d]+)/older/$', ConversationOlderView.as_view(), name='view_conversation_older'),
     url(r'^archive/$', ArchiveView.as_view(), name='archive'),
     url(r'^delete/$', DeleteView.as_view(), name='delete'),
     url(r'^undelete/$', UndeleteView.as_view(), name='undelete'),
@@ -15,6 +15,7 @@ from django.core.exceptions import PermissionDenied
 from django.contrib.auth import get_user_model
 from django.contrib.sites.shortcuts import get_current_site
 from django.urls import reverse
+from django.db import transaction
 from django.db.models import Q
 from django.http import Http404
 from django.shortcuts import get_object_or_404, redirect
@@ -27,7 +28,8 @@ from django.views.generic import FormView, TemplateView, View
 from . import OPTION_MESSAGES
 from .fields import autocompleter_app
 from .forms import WriteForm, AnonymousWriteForm, QuickReplyForm, FullReplyForm
-from .models import Message, get_order_by
+from .models import Message, OutgoingMessage, get_order_by
+from .pagination import CURSOR_AFTER_KEY, CURSOR_BEFORE_KEY, decode_cursor, get_keyset_page
 from .utils import format_subject, format_body
 from django.http.response import HttpResponseForbidden
 
@@ -76,11 +78,15 @@ class FolderMixin(NamespaceMixin, object):
         order_by = get_order_by(self.request.GET)
         if order_by:
             params['order_by'] = order_by
-        msgs = getattr(Message.objects, self.folder_name)(self.request.user, **params)
+        msgs = Message.objects.for_display(getattr(Message.objects, self.folder_name)(self.request.user, **params))
         viewname = 'postman:' + self.view_name
         current_instance = self.request.resolver_match.namespace
+        # keyset pagination relies on the default ordering
+        if getattr(settings, 'POSTMAN_KEYSET_PAGINATION', False) and not order_by:
+            context.update(self.get_keyset_page_context(msgs))
+        else:
+            context['pm_messages'] = msgs  # avoid 'messages', already used by contrib.messages
         context.update({
-            'pm_messages': msgs,  # avoid 'messages', already used by contrib.messages
             'by_conversation': option is None,
             'by_message': option == OPTION_MESSAGES,
             'by_conversation_url': reverse(viewname, current_app=current_instance),
@@ -88,9 +94,30 @@ class FolderMixin(NamespaceMixin, object):
             'current_url': self.request.get_full_path(),
             'gets': self.request.GET,  # useful to postman_order_by template tag
         })
+        if getattr(settings, 'POSTMAN_SEND_LATER_THRESHOLD', None) is not None:
+            context['pm_outgoing_messages'] = OutgoingMessage.objects.in_progress(self.request.user)
         return context
 
 
+    def get_keyset_page_context(self, msgs):
+        """Return the context of a page of the folder, and the urls to the newer and older pages."""
+        page_size = getattr(settings, 'POSTMAN_KEYSET_PAGE_SIZE', 50)
+        msgs, newer_cursor, older_cursor = get_keyset_page(msgs, self.request.GET, page_size)
+
+        def page_url(key, cursor):
+            gets = self.request.GET.copy()
+            for name in (CURSOR_BEFORE_KEY, CURSOR_AFTER_KEY):
+                gets.pop(name, None)
+            gets[key] = cursor
+            return '?' + gets.urlencode()
+        return {
+            'pm_messages': msgs,
+            'pm_keyset_pagination': True,
+            'pm_newer_url': page_url(CURSOR_BEFORE_KEY, newer_cursor) if newer_cursor else None,
+            'pm_older_url': page_url(CURSOR_AFTER_KEY, older_cursor) if older_cursor else None,
+        }
+
+
 class InboxView(FolderMixin, TemplateView):
     """
     Display the list of received messages for the current user.
@@ -190,6 +217,7 @@ class ComposeMixin(AttachableViewMixin, NamespaceMixin, object):
                 'exchange_filter': self.exchange_filter,
                 'max': self.max,
                 'site': get_current_site(self.request),
+                'send_later': True,
             })
         return kwargs
 
@@ -201,6 +229,12 @@ class ComposeMixin(AttachableViewMixin, NamespaceMixin, object):
         if hasattr(self, 'parent'):  # only in the ReplyView case
             params['parent'] = self.parent
         is_successful = form.save(**params)
+        if form.outgoing:
+            # the attachments are linked to the outgoing message, and to each message as it is sent
+            form.instance = form.outgoing
+            super(ComposeMixin, self).form_valid(form)
+            messages.success(self.request, _("Message accepted, it is being sent in the background."), fail_silently=True)
+            return redirect(self.get_success_url())
         super(ComposeMixin, self).form_valid(form)
         
         # if we have uploaded any attachments, then those are set to private
@@ -209,8 +243,7 @@ class ComposeMixin(AttachableViewMixin, NamespaceMixin, object):
         all_recipients.extend([msg.recipient for msg in getattr(form, 'extra_instances', [])])
         all_recipients = list(set(all_recipients))
         for attached_object in form.instance.attached_objects.all():
-            for recipient in all_recipients:
-                attached_object.target_object.media_tag.persons.add(recipient)
+            attached_object.target_object.media_tag.persons.add(*all_recipients)
         
         if is_successful:
             messages.success(self.request, _("Message successfully sent."), fail_silently=True)
@@ -376,39 +409,51 @@ class DisplayMixin(NamespaceMixin, RestrictRecipientMixin, object):
 
     def get(self, request, *args, **kwargs):
         user = request.user
-        self.msgs = Message.objects.thread(user, self.filter)
+        self.msgs = self.get_messages(user)
         if not self.msgs:
             raise Http404
-        Message.objects.set_read(user, self.filter)
+        Message.objects.set_read(user, self.get_read_filter())
         # Mark root message as LastVisited
-        self.msgs[0].mark_visited(user)
+        self.get_root_message().mark_visited(user)
         return super(DisplayMixin, self).get(request, *args, **kwargs)
 
-    def get_context_data(self, **kwargs):
-        context = super(DisplayMixin, self).get_context_data(**kwargs)
-        user = self.request.user
-        # are all messages archived ?
+    def get_messages(self, user):
+        """Return the messages to display."""
+        return Message.objects.thread(user, self.filter)
+
+    def get_read_filter(self):
+        """Return the filter of the messages to mark as read."""
+        return self.filter
+
+    def get_root_message(self):
+        """Return the first message of the conversation."""
+        return self.msgs[0]
+
+    def is_archived(self, user):
+        """Tell if all messages are archived."""
         for m in self.msgs:
             if not getattr(m, ('sender' if m.sender == user else 'recipient') + '_archived'):
-                archived = False
-                break
-        else:
-            archived = True
-        # look for the most recent received message (and non-deleted to comply with the future perms() control), if any
+                return False
+        return True
+
+    def get_last_received(self, user):
+        """Return the most recent received message (and non-deleted to comply with the future perms() control), if any."""
         for m in reversed(self.msgs):
             if m.recipient == user and not m.recipient_deleted_at:
-                received = m
-                break
-        else:
-            received = None
-            
+                return m
+        return None
+
+    def get_context_data(self, **kwargs):
+        context = super(DisplayMixin, self).get_context_data(**kwargs)
+        user = self.request.user
+        received = self.get_last_received(user)
         context.update({
             'pm_messages': self.msgs,
-            'archived': archived,
+            'archived': self.is_archived(user),
             'reply_to_pk': received.pk if received else None,
             'form': self.form_class(initial=received.quote(*self.formatters)) if received else None,
             'next_url': self.request.GET.get('next') or reverse('postman:inbox', current_app=self.request.resolver_match.namespace),
-            'disable_reply_all': self.check_restricted_recipient(self.msgs[0]),
+            'disable_reply_all': self.check_restricted_recipient(self.get_root_message()),
         })
         return context
 
@@ -421,13 +466,110 @@ class MessageView(DisplayMixin, TemplateView):
         return super(MessageView, self).get(request, *args, **kwargs)
 
 
+def get_conversation_window(user, thread_id, query_dict):
+    """
+    Return the latest messages of a conversation, or those older than the cursor found in a query dict.
+
+    Return a tuple of the queryset of the visible messages of the conversation, the list of messages
+    in chronological order and the token to the older messages, None if there are none.
+
+    """
+    conversation = Message.objects.conversation(user, thread_id)
+    msgs, __, older_cursor = get_keyset_page(conversation.order_by('-sent_at', '-pk'), query_dict,
+        getattr(settings, 'POSTMAN_CONVERSATION_WINDOW', None))
+    return conversation, msgs[::-1], older_cursor
+
+
 class ConversationView(DisplayMixin, TemplateView):
-    """Display a conversation."""
+    """
+    Display a conversation.
+
+    If the POSTMAN_CONVERSATION_WINDOW setting is set, only that many of the latest messages are displayed,
+    the older ones are fetched by chunks from ConversationOlderView.
+
+    """
+    conversation = None
+    older_cursor = None
 
     def get(self, request, thread_id, *args, **kwargs):
+        self.thread_id = thread_id
         self.filter = Q(thread=thread_id)
         return super(ConversationView, self).get(request, *args, **kwargs)
 
+    def get_messages(self, user):
+        if not getattr(settings, 'POSTMAN_CONVERSATION_WINDOW', None):
+            return super(ConversationView, self).get_messages(user)
+        self.conversation, msgs, self.older_cursor = get_conversation_window(user, self.thread_id, {})
+        return msgs
+
+    def get_read_filter(self):
+        if self.conversation is None:
+            return super(ConversationView, self).get_read_filter()
+        return self.filter & Q(pk__in=[m.pk for m in self.msgs])
+
+    def get_root_message(self):
+        if not self.older_cursor:
+            return super(ConversationView, self).get_root_message()
+        if not hasattr(self, '_root_message'):
+            self._root_message = self.conversation.first()
+        return self._root_message
+
+    def is_archived(self, user):
+        if not self.older_cursor:
+            return super(ConversationView, self).is_archived(user)
+        return not self.conversation.filter(
+            Q(sender=user, sender_archived=False) | (~Q(sender=user) & Q(recipient_archived=False))
+        ).exists()
+
+    def get_last_received(self, user):
+        received = super(ConversationView, self).get_last_received(user)
+        if received or not self.older_cursor:
+            return received
+        return self.conversation.filter(recipient=user, recipient_deleted_at__isnull=True).last()
+
+    def get_context_data(self, **kwargs):
+        context = super(ConversationView, self).get_context_data(**kwargs)
+        context['pm_older_url'] = get_older_messages_url(self.request, self.thread_id, self.older_cursor)
+        return context
+
+
+def get_older_messages_url(request, thread_id, older_cursor):
+    """Return the url of the chunk of messages older than a cursor, or None if there are none."""
+    if not older_cursor:
+        return None
+    return '{0}?{1}={2}'.format(
+        reverse('postman:view_conversation_older', args=[thread_id], current_app=request.resolver_match.namespace),
+        CURSOR_AFTER_KEY, older_cursor)
+
+
+class ConversationOlderView(NamespaceMixin, TemplateView):
+    """Display a chunk of older messages of a conversation, as a fragment to insert into the conversation page."""
+    http_method_names = ['get']
+    template_name = 'postman/inc_conversation_messages.html'
+
+    @login_required_m
+    def dispatch(self, *args, **kwargs):
+        return super(ConversationOlderView, self).dispatch(*args, **kwargs)
+
+    def get(self, request, thread_id, *args, **kwargs):
+        if not getattr(settings, 'POSTMAN_CONVERSATION_WINDOW', None) or not decode_cursor(request.GET.get(CURSOR_AFTER_KEY, '')):
+            raise Http404
+        user = request.user
+        __, self.msgs, older_cursor = get_conversation_window(user, thread_id, request.GET)
+        if not self.msgs:
+            raise Http404
+        Message.objects.set_read(user, Q(thread=thread_id) & Q(pk__in=[m.pk for m in self.msgs]))
+        self.older_url = get_older_messages_url(request, thread_id, older_cursor)
+        return super(ConversationOlderView, self).get(request, *args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        context = super(ConversationOlderView, self).get_context_data(**kwargs)
+        context.update({
+            'pm_messages': self.msgs,
+            'pm_older_url': self.older_url,
+        })
+        return context
+
 
 class UpdateMessageMixin(object):
     """
@@ -457,10 +599,12 @@ class UpdateMessageMixin(object):
         if pks or tpks:
             user = request.user
             filter = Q(pk__in=pks) | Q(thread__in=tpks)
-            recipient_rows = Message.objects.as_recipient(user, filter).update(**{'recipient_{0}'.format(self.field_bit): self.field_value})
-            sender_rows = Message.objects.as_sender(user, filter).update(**{'sender_{0}'.format(self.field_bit): self.field_value})
-            if not (recipient_rows or sender_rows):
-                raise Http404  # abnormal enough, like forged ids
+            with transaction.atomic():
+                recipient_rows = Message.objects.as_recipient(user, filter).update(**{'recipient_{0}'.format(self.field_bit): self.field_value})
+                sender_rows = Message.objects.as_sender(user, filter).update(**{'sender_{0}'.format(self.field_bit): self.field_value})
+                if not (recipient_rows or sender_rows):
+                    raise Http404  # abnormal enough, like forged ids
+                Message.objects.refresh_folders(user, filter)
             messages.success(request, self.success_msg, fail_silently=True)
             return redirect(request.GET.get('next') or self.success_url or next_url)
         else:
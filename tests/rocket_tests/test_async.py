@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
+
+from django.test import SimpleTestCase
+
+from cosinnus.models.profile import PROFILE_SETTING_ROCKET_CHAT_ID, PROFILE_SETTING_ROCKET_CHAT_USERNAME
+from cosinnus_message.rocket_async import AsyncRocketChatConnection
+
+
+class _DictCache(dict):
+
+    def set(self, key, value, timeout=None):
+        self[key] = value
+
+    def delete(self, key):
+        self.pop(key, None)
+
+
+def _client(auth_token, rocket_user_id):
+    client = Mock(headers={'X-Auth-Token': auth_token})
+    client.me.return_value.status_code = 200
+    client.users_info.return_value.json.return_value = {'success': True, 'user': {'_id': rocket_user_id}}
+    return client
+
+
+def _save_user_rocket_chat_id(profile, rocket_chat_id):
+    profile.settings[PROFILE_SETTING_ROCKET_CHAT_ID] = rocket_chat_id
+
+
+def _user():
+    return SimpleNamespace(cosinnus_profile=SimpleNamespace(settings={PROFILE_SETTING_ROCKET_CHAT_USERNAME: 'user1'}))
+
+
+@patch('cosinnus_message.rocket_chat.save_user_rocket_chat_id', _save_user_rocket_chat_id)
+@patch('cosinnus_message.rocket_chat.CosinnusPortal.get_current', Mock(return_value=SimpleNamespace(id=1)))
+class AsyncRocketChatConnectionTests(SimpleTestCase):
+
+    async def test_expired_connection_is_renewed(self):
+        expired, renewed = _client('token1', 'abc'), _client('token2', 'def')
+        with patch('cosinnus_message.rocket_chat.cache', _DictCache()), \
+                patch('cosinnus_message.rocket_chat.RocketChat', side_effect=[expired, renewed]) as login:
+            self.assertEqual(await AsyncRocketChatConnection().get_user_id(_user()), 'abc')
+            # the auth token of the cached connection stops working
+            expired.me.return_value.status_code = 401
+            self.assertEqual(await AsyncRocketChatConnection().get_user_id(_user()), 'def')
+        self.assertEqual(login.call_count, 2)
+        self.assertEqual(renewed.users_info.call_count, 1)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
+
+from django.db import transaction
+from django.test import TestCase, override_settings
+
+from cosinnus.models.group_extra import CosinnusSociety
+from cosinnus_message.rocket_batch import RocketTransactionBatch, defer_to_transaction,\
+    get_transaction_batch
+
+
+def _o(pk):
+    return SimpleNamespace(pk=pk)
+
+
+class MergedOperationsTests(TestCase):
+    """ The batch records its changes as commit callbacks, so these tests rely on running
+        inside the transaction of the TestCase """
+
+    def _merged(self, *operations):
+        batch = RocketTransactionBatch()
+        for object_type, action, instance in operations:
+            batch.record('operation', (object_type, action, instance, instance.pk))
+        return [(object_type, action, pk) for object_type, action, __, pk in batch.get_merged_operations()]
+
+    def test_create_and_updates_are_one_create(self):
+        group = _o(1)
+        self.assertEqual(self._merged(('group', 'create', group), ('group', 'update', group), ('group', 'update', group)),
+                         [('group', 'create', 1)])
+
+    def test_create_and_delete_are_nothing(self):
+        group = _o(1)
+        self.assertEqual(self._merged(('group', 'create', group), ('group', 'update', group), ('group', 'delete', group)), [])
+
+    def test_delete_supersedes_update_and_state(self):
+        group = _o(1)
+        self.assertEqual(self._merged(('group', 'update', group), ('group', 'archive', group), ('group', 'delete', group)),
+                         [('group', 'delete', 1)])
+
+    def test_last_state_action_counts(self):
+        user = _o(1)
+        self.assertEqual(self._merged(('user', 'disable', user), ('user', 'enable', user), ('user', 'disable', user)),
+                         [('user', 'disable', 1)])
+
+    def test_objects_are_kept_apart_and_ordered(self):
+        group1, group2, user = _o(1), _o(2), _o(1)
+        self.assertEqual(self._merged(('group', 'archive', group1), ('user', 'disable', user), ('group', 'update', group2),
+                                      ('group', 'create', group1), ('group', 'update', group1)),
+                         [('group', 'update', 2), ('group', 'create', 1), ('group', 'archive', 1), ('user', 'disable', 1)])
+
+    def test_created_object_without_pk_is_skipped(self):
+        self.assertEqual(self._merged(('group', 'create', _o(None))), [])
+
+    def test_pk_of_created_object_is_read_on_merge(self):
+        group = _o(None)
+        batch = RocketTransactionBatch()
+        batch.record('operation', ('group', 'create', group, group.pk))
+        group.pk = 3
+        self.assertEqual([(action, pk) for __, action, __, pk in batch.get_merged_operations()], [('create', 3)])
+
+
+@override_settings(COSINNUS_CHAT_TRANSACTION_BATCH_ENABLED=True)
+class TransactionBatchTests(TestCase):
+
+    def test_operations_of_rolled_back_savepoint_are_dropped(self):
+        group = _o(1)
+        self.assertTrue(defer_to_transaction('group', 'update', group))
+        try:
+            with transaction.atomic():
+                self.assertTrue(defer_to_transaction('group', 'archive', group))
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual([action for __, action, __, __ in get_transaction_batch().get_merged_operations()], ['update'])
+
+    def test_operations_run_on_commit(self):
+        group = _o(1)
+        with patch.object(RocketTransactionBatch, 'flush') as flush:
+            with self.captureOnCommitCallbacks(execute=True):
+                defer_to_transaction('group', 'update', group)
+                defer_to_transaction('group', 'archive', group)
+        self.assertEqual(flush.call_count, 1)
+        operations, memberships = flush.call_args[0]
+        self.assertEqual([action for __, action, __, __ in operations], ['update', 'archive'])
+        self.assertEqual(memberships, {})
+
+    @override_settings(COSINNUS_CHAT_TRANSACTION_BATCH_ENABLED=False)
+    def test_disabled(self):
+        self.assertFalse(defer_to_transaction('group', 'update', _o(1)))
+
+    def test_delete_runs_with_recorded_pk(self):
+        with patch('cosinnus_message.hooks.RocketChatConnection'):
+            group = CosinnusSociety.objects.create(name='Deleted group')
+            pk = group.pk
+            group.delete()
+        rocket = Mock()
+        RocketTransactionBatch()._run_operation(rocket, 'group', 'delete', group, pk)
+        self.assertEqual(rocket.groups_delete.call_args[0][0].pk, pk)
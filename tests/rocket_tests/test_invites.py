@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from unittest.mock import Mock
+
+from django.test import SimpleTestCase, override_settings
+
+from cosinnus_message.rocket_chat import RocketChatConnection
+
+
+def _response(success, **data):
+    return Mock(json=Mock(return_value=dict(success=success, **data)))
+
+
+@override_settings(COSINNUS_CHAT_BULK_INVITE_RETRIES=1, COSINNUS_CHAT_BULK_INVITE_RETRY_DELAY=0)
+class RoomsInviteBulkTests(SimpleTestCase):
+
+    def setUp(self):
+        # a connection without logging in, with a mocked rocketchat client
+        self.connection = RocketChatConnection.__new__(RocketChatConnection)
+        self.connection.rocket = Mock()
+        self.connection.rocket.groups_invite_many.side_effect = \
+            lambda room_id, user_ids: _response('bad' not in user_ids)
+        self.connection.rocket.groups_invite.side_effect = \
+            lambda room_id, user_id: _response(user_id != 'bad', errorType='error-invalid-user')
+
+    def test_chunks(self):
+        counts = self.connection.rooms_invite_bulk('room1', ['u1', 'u2', 'u3', 'u4', 'u5'], chunk_size=2, existing_ids=set())
+        self.assertEqual(counts, (5, 0, 0))
+        self.assertEqual([call[1]['user_ids'] for call in self.connection.rocket.groups_invite_many.call_args_list],
+                         [['u1', 'u2'], ['u3', 'u4'], ['u5']])
+        self.assertFalse(self.connection.rocket.groups_invite.called)
+
+    def test_existing_and_duplicate_members_are_skipped(self):
+        counts = self.connection.rooms_invite_bulk('room1', ['u1', 'u2', 'u2', None, 'u3'], chunk_size=10, existing_ids={'u1'})
+        self.assertEqual(counts, (2, 1, 0))
+        self.assertEqual(self.connection.rocket.groups_invite_many.call_args[1]['user_ids'], ['u2', 'u3'])
+
+    def test_existing_members_are_fetched(self):
+        self.connection.get_room_member_ids = Mock(return_value={'u2'})
+        self.assertEqual(self.connection.rooms_invite_bulk('room1', ['u1', 'u2'], chunk_size=10), (1, 1, 0))
+        self.connection.get_room_member_ids.assert_called_once_with('room1')
+
+    def test_failed_chunk_is_retried_then_invited_one_by_one(self):
+        counts = self.connection.rooms_invite_bulk('room1', ['u1', 'u2', 'bad', 'u3'], chunk_size=2, existing_ids=set())
+        self.assertEqual(counts, (3, 0, 1))
+        # the chunk with the broken account is tried twice, then its users are invited one by one
+        self.assertEqual([call[1]['user_ids'] for call in self.connection.rocket.groups_invite_many.call_args_list],
+                         [['u1', 'u2'], ['bad', 'u3'], ['bad', 'u3']])
+        self.assertEqual([call[1]['user_id'] for call in self.connection.rocket.groups_invite.call_args_list], ['bad', 'u3'])
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import unittest
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.test import TestCase, TransactionTestCase
+
+from cosinnus.conf import settings
+from cosinnus.models.group_extra import CosinnusSociety
+from cosinnus.models.profile import PROFILE_SETTING_ROCKET_CHAT_ID
+from cosinnus_message.models import RocketChatUserLink, RocketChatGroupRoomLink,\
+    RocketChatContactRoomLink
+from cosinnus_message.rocket_chat import save_group_room_id
+
+
+def fake_groups_create(group):
+    """ Stands in for `RocketChatConnection.groups_create`, which saves a room id for each room key """
+    for room_key in settings.COSINNUS_ROCKET_GROUP_ROOM_KEYS:
+        save_group_room_id(group, room_key, 'room-%s' % room_key)
+
+
+class GroupCreateLinkTests(TransactionTestCase):
+
+    @unittest.skipUnless(settings.COSINNUS_ROCKET_ENABLED, 'the rocketchat hooks are only connected if rocketchat is enabled')
+    def test_group_created_in_autocommit_is_linked(self):
+        with patch('cosinnus_message.hooks.RocketChatConnection') as connection:
+            connection.return_value.groups_create.side_effect = fake_groups_create
+            group = CosinnusSociety.objects.create(name='Linked group')
+        self.assertEqual(connection.return_value.groups_create.call_count, 1)
+        expected = dict([(room_key, 'room-%s' % room_key) for room_key in settings.COSINNUS_ROCKET_GROUP_ROOM_KEYS])
+        self.assertEqual(dict(RocketChatGroupRoomLink.objects.filter(group=group).values_list('room_key', 'room_id')), expected)
+        group.refresh_from_db()
+        for room_key, room_id in expected.items():
+            self.assertEqual(group.settings.get(f'{PROFILE_SETTING_ROCKET_CHAT_ID}_{room_key}'), room_id)
+
+
+class LinkTests(TestCase):
+
+    def setUp(self):
+        # no rocketchat requests for the users and groups created here
+        patcher = patch('cosinnus_message.hooks.RocketChatConnection')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user1 = User.objects.create(username='user1', email='user1@example.com')
+        self.user2 = User.objects.create(username='user2', email='user2@example.com')
+        self.group1 = CosinnusSociety.objects.create(name='group1')
+        self.group2 = CosinnusSociety.objects.create(name='group2')
+        self.room_key = settings.COSINNUS_ROCKET_GROUP_ROOM_KEYS[0]
+
+    def test_save_group_room_id(self):
+        save_group_room_id(self.group1, self.room_key, 'room1')
+        self.assertEqual(RocketChatGroupRoomLink.objects.get_group_and_room_key('room1'), (self.group1, self.room_key))
+        self.group1.refresh_from_db()
+        self.assertEqual(self.group1.settings.get(f'{PROFILE_SETTING_ROCKET_CHAT_ID}_{self.room_key}'), 'room1')
+        save_group_room_id(self.group1, self.room_key, 'room2')
+        self.assertIsNone(RocketChatGroupRoomLink.objects.get_group('room1'))
+        self.assertEqual(RocketChatGroupRoomLink.objects.get_group('room2'), self.group1)
+
+    def test_group_room_link_replaces_stale_link(self):
+        RocketChatGroupRoomLink.objects.set_link(self.group1, self.room_key, 'room1')
+        RocketChatGroupRoomLink.objects.set_link(self.group2, self.room_key, 'room1')
+        self.assertEqual(RocketChatGroupRoomLink.objects.filter(room_id='room1').count(), 1)
+        self.assertEqual(RocketChatGroupRoomLink.objects.get_group('room1'), self.group2)
+
+    def test_user_link_replaces_stale_user_id(self):
+        RocketChatUserLink.objects.set_link(self.user1, rocket_user_id='abc', rocket_username='user1')
+        RocketChatUserLink.objects.set_link(self.user2, rocket_user_id='abc', rocket_username='user2')
+        self.assertEqual(RocketChatUserLink.objects.get_user('abc'), self.user2)
+        self.assertIsNone(RocketChatUserLink.objects.get(user=self.user1).rocket_user_id)
+        # links without a user id don't clear those of other users
+        RocketChatUserLink.objects.set_link(self.user1, rocket_user_id=None)
+        self.assertEqual(RocketChatUserLink.objects.get_user('abc'), self.user2)
+
+    def test_contact_room_link_replaces_stale_room_name(self):
+        RocketChatContactRoomLink.objects.set_link(self.user1, self.group1, 'contact-room', room_id='room1')
+        RocketChatContactRoomLink.objects.set_link(self.user2, self.group1, 'contact-room', room_id='room2')
+        self.assertEqual(RocketChatContactRoomLink.objects.get_user_and_group('room2'), (self.user2, self.group1))
+        self.assertEqual(RocketChatContactRoomLink.objects.get_user_and_group('room1'), (None, None))
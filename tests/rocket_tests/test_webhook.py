@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.http import Http404
+from django.test import TestCase, RequestFactory, override_settings
+
+from cosinnus_message.models import RocketChatUserLink
+from cosinnus_message.views import RocketChatWebhookView
+
+
+@override_settings(COSINNUS_CHAT_WEBHOOK_TOKEN='secret')
+class RocketChatWebhookViewTests(TestCase):
+
+    def _post(self, event, payload):
+        body = payload if isinstance(payload, str) else json.dumps(payload)
+        request = RequestFactory().post('/messages/rocketchat/webhook/%s/' % event, body, content_type='application/json')
+        return RocketChatWebhookView.as_view()(request, event=event)
+
+    def _json(self, response):
+        return json.loads(response.content.decode('utf-8'))
+
+    @override_settings(COSINNUS_CHAT_WEBHOOK_TOKEN=None)
+    def test_disabled_without_token(self):
+        self.assertRaises(Http404, self._post, 'roomJoined', {'token': ''})
+
+    def test_bad_token(self):
+        self.assertEqual(self._post('roomJoined', {'token': 'wrong'}).status_code, 403)
+        self.assertEqual(self._post('roomJoined', {}).status_code, 403)
+
+    def test_bad_json(self):
+        self.assertEqual(self._post('roomJoined', '{"token": ').status_code, 400)
+        self.assertEqual(self._post('roomJoined', '["secret"]').status_code, 400)
+
+    def test_unknown_event(self):
+        response = self._post('roomDeleted', {'token': 'secret', 'room': {'_id': 'room1'}})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(self._json(response)['success'])
+
+    def test_malformed_event(self):
+        self.assertEqual(self._post('roomCreated', {'token': 'secret'}).status_code, 400)
+
+    def test_unknown_room(self):
+        response = self._post('roomLeft', {'token': 'secret', 'room': {'_id': 'room1'}, 'user': {'_id': 'abc'}})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(self._json(response)['success'])
+
+    def test_user_created_mirrors_email_preference(self):
+        with patch('cosinnus_message.hooks.RocketChatConnection'):
+            user = User.objects.create(username='user1', email='user1@example.com')
+        RocketChatUserLink.objects.set_link(user, rocket_user_id='abc', rocket_username='user1')
+        payload = {'token': 'secret', 'user': {'_id': 'abc', 'username': 'renamed',
+                                               'settings': {'preferences': {'emailNotificationMode': 'nothing'}}}}
+        self.assertEqual(self._post('userCreated', payload).status_code, 200)
+        link = RocketChatUserLink.objects.get(user=user)
+        self.assertEqual((link.email_notification_mode, link.rocket_username), ('nothing', 'user1'))